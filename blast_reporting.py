@@ -86,9 +86,31 @@ python blast_reporting.py in_file out_tabular_file out_html_file out_format
 """
 import sys
 import re
+import copy
+import shlex
+import itertools
+import traceback
+import StringIO
 import os.path
+import time
+import multiprocessing
+import hashlib
 import common
 import reference_bins
+import alignment_stats
+import numeric_batch
+import column_store
+import report_pages
+import report_database
+import report_progress
+import follow_input
+import iteration_index
+import report_checkpoint
+import report_preview
+import query_summary
+import hit_aggregate
+import record_cache
+import result_cache
 #import templates.html_report
 
 if __name__ == '__main__' and __package__ is None:
@@ -102,6 +124,17 @@ else:
     import pkg_resources; pkg_resources.require( "elementtree" )
     from elementtree import ElementTree
 
+# Maximum number of distinct subject ids whose derived fields are memoized by XMLRecordScan.processRecord()
+SUBJECT_CACHE_SIZE = 10000
+
+# Numeric fields derived from raw XML values by XMLRecordScan.getNumericFields() or numeric_batch.NumericBatch
+NUMERIC_FIELDS = ['evalue', 'bitscore', 'pident', 'ppos', 'pcov']
+# Engine modules whose code shapes report outputs; their content is part of the result cache key (see codeHash()).
+RESULT_CODE_FILES = ['blast_reporting.py', 'common.py', 'column_store.py', 'query_summary.py', 'reference_bins.py']
+
+# Raw values the record cache keeps besides XMLRecordScan.columns_in, so that getNumericValues() works on replayed records.
+RAW_NUMERIC_FIELDS = ['_evalue', '_bitscore', '_qlen']
+
 class GenericRecord(object): pass
 
 class XMLRecordScan(object): 
@@ -219,15 +252,163 @@ class XMLRecordScan(object):
 		self.binManager = reference_bins.ReferenceBins()
 		self.binManager.build_bins(options.reference_bins, self.columns)
 
+		# Aligned sequence fields stored out-of-line, see setSequenceSidecar()
+		self.sequence_sidecar = None
+		self.sidecar_fields = []
+
+		# Subject-derived fields keyed on raw <Hit_id>, <Hit_def>, <Hit_accession> text; subjects recur across queries.
+		self.subject_cache = common.LRUCache(SUBJECT_CACHE_SIZE)
+
+	def clone(self):
+		""" @return XMLRecordScan with this one's columns, field spec and reference bins, but its own record,
+		 subject cache and no sequence sidecar.  Spares reports with the same options from re-reading them (see batch mode).
+		"""
+		other = copy.copy(self)
+		other.record = GenericRecord()
+		other.columns = [dict(field) for field in self.columns]
+		other.sequence_sidecar = None
+		other.sidecar_fields = []
+		other.subject_cache = common.LRUCache(SUBJECT_CACHE_SIZE)
+		return other
+
+	def setSequenceSidecar(self, file_path, offset = 0):
+		""" Store aligned sequence columns out-of-line in a common.SequenceSidecar file.
+		 Sequence columns that are sorted on stay in the tabular file.
+		 @param offset integer	Sidecar size at a checkpoint being resumed from
+		"""
+		self.sidecar_fields = [col['field'] for col in self.columns if col['field'] in common.SEQUENCE_FIELDS and not col['sort']]
+		if len(self.sidecar_fields):
+			self.sequence_sidecar = common.SequenceSidecar(file_path, offset)
+
 	def setRecordAttr(self, tag, text):
 		#self.record is a class object (not a dictionary) so using setattr()
 		setattr(self.record, self.tags[tag], text) 
 
+	def getRawValues(self):
+		""" @return dictionary of the current record's raw XML tag values, for processing later via setRawValues() """
+		values = self.record.__dict__
+		return dict((name, values[name]) for name in self.tags.itervalues() if name in values)
+
+	def setRawValues(self, raw_values):
+		self.record.__dict__.update(raw_values)
+
 	# Called after set() has processed a bunch of <hit> ...</hit> tags
-	def processRecord(self) :
+	# numeric_fields: NUMERIC_FIELDS values if these were already calculated (see numeric_batch.py)
+	def processRecord(self, numeric_fields = None) :
+
+		bline = self.record
+		
+		self.setIdFields()
+
+		# Unformatted values are kept for the column store (-C); numeric_batch only provides formatted ones.
+		numeric_values = None
+		if numeric_fields == None:
+			numeric_values = self.getNumericValues(bline)
+			numeric_fields = self.formatNumericFields(numeric_values)
+		self.record.numeric_values = numeric_values
+		for field in NUMERIC_FIELDS:
+			setattr(self.record, field, numeric_fields[field])
+
+		# gapopen, mismatch and any other alignment_stats.COLUMNS fields, from one scan of the aligned sequences.
+		#assert len(bline._qseq) == len(bline._sseq) == len(bline._mseq) == int(bline._length)
+		stats = alignment_stats.AlignmentStats(bline._qseq, bline._sseq, bline._mseq)
+		for (field, getValue) in alignment_stats.COLUMNS:
+			setattr(self.record, field, getValue(stats))
+
+		qframe = bline._qframe
+		sframe = bline._sframe 
+		if bline._blast_program == "blastp":
+			#Probably a bug in BLASTP that they use 0 or 1 depending on format
+			if qframe == "0": qframe = "1" 
+			if sframe == "0": sframe = "1" 
+		
+		self.record.qframe = qframe
+		self.record.sframe = sframe
+		self.record.slen = str(int(bline._hit_len))
+		self.record.qlen = str(int(bline._qlen))
+
+		return True # One may return false anywhere above to filter out current <Hsp> record.
+
 
+	def setIdFields(self):
+		""" Set qseqid and the subject fields (sseqid, accessionid, sallseqid, salltitles, stitle, bins) of the current record.
+		 These are all that FieldFilter.markMatch() needs.
+		"""
 		bline = self.record
+
+		# sseqid, accessionid, sallseqid, salltitles, stitle and reference bin columns depend only on the subject.
+		subject_key = (bline._hit_id, bline._hit_def, bline._hit_acc)
+		subject = self.subject_cache.get(subject_key)
+		if subject == None:
+			subject = self.getSubjectFields(bline)
+			self.subject_cache.set(subject_key, subject)
+
+		(self.record.sseqid, self.record.accessionid, self.record.sallseqid, self.record.salltitles, self.record.stitle, bin_values) = subject
+		for (field, value) in bin_values:
+			setattr(self.record, field, value)
+
+		# NCBI notes: Expecting either this, from BLAST 2.2.25+ using FASTA vs FASTA
+		# <Iteration_query-ID>sp|Q9BS26|ERP44_HUMAN</Iteration_query-ID>
+		# <Iteration_query-def>Endoplasmic reticulum resident protein 44 OS=Homo sapiens GN=ERP44 PE=1 SV=1</Iteration_query-def>
+		# <Iteration_query-len>406</Iteration_query-len>
+		# <Iteration_hits></Iteration_hits>
+		#
+		#Or, from BLAST 2.2.24+ run online
+		# <Iteration_query-ID>Query_1</Iteration_query-ID>
+		# <Iteration_query-def>Sample</Iteration_query-def>
+		# <Iteration_query-len>516</Iteration_query-len>
+		# <Iteration_hits>...
+
+		# Note BioPython's approach http://biopython.org/DIST/docs/api/Bio.SearchIO.BlastIO.blast_xml-pysrc.html
+		# ... if hit_id.startswith('gnl|BL_ORD_ID|'): ...
 		
+		# Place holder ID: take the first word of the query definition
+		self.record.qseqid = common.queryId(bline._qseqid, bline._qdef)
+
+
+	def getNumericFields(self, bline):
+		""" Calculate and format the numeric fields of an HSP that are derived from raw XML values.
+		 numeric_batch.NumericBatch produces identical values for a batch of HSPs at once.
+
+		 @param bline object	record holding raw XML tag values
+		 @return dictionary of NUMERIC_FIELDS values
+		"""
+		return self.formatNumericFields(self.getNumericValues(bline))
+
+
+	def getNumericValues(self, bline):
+		""" @return dictionary of an HSP's NUMERIC_FIELDS values as numbers, unformatted """
+		# NCBI notes on bitscore formatting (see common.NUMERIC_FORMATS):
+		#   if bline._bitscore < 100:
+		#       #Seems to show one decimal place for lower scores
+		#       bitscore = "%0.1f" % bline._bitscore
+		#   else:
+		#       #Note BLAST does not round to nearest int, it truncates
+		#       bitscore = "%i" % bline._bitscore
+
+		#NCBI DOCUMENTATION ON qcovs == pcov == pct_coverage == http://www.ncbi.nlm.nih.gov/IEB/ToolBox/CPP_DOC/lxr/source/include/objects/seqalign/Seq_align.hpp#L54
+		#pcov is extended+
+		return {
+			'evalue': float(bline._evalue),
+			'bitscore': float(bline._bitscore),
+			'pident': 100*float(bline._nident)/float(bline._length),
+			'ppos': 100*float(bline._positive)/float(bline._length),
+			'pcov': float(int(bline._qend) - int(bline._qstart) + 1)/int(bline._qlen) * 100
+		}
+
+
+	def formatNumericFields(self, numeric_values):
+		""" @return dictionary of NUMERIC_FIELDS values formatted as text, from getNumericValues() """
+		formats = common.NUMERIC_FORMATS
+		return dict((field, formats[field](numeric_values[field])) for field in NUMERIC_FIELDS)
+
+
+	def getSubjectFields(self, bline):
+		""" Derive the subject id fields and reference bin column values of a <Hit>.
+
+		 @param bline object	record holding raw _hit_id, _hit_def, _hit_acc values
+		 @return tuple (sseqid, accessionid, sallseqid, salltitles, stitle, [[bin field, value],...])
+		"""
 		# NCBI notes: Expecting either this,
 		# <Hit_id>gi|3024260|sp|P56514.1|OPSD_BUFBU</Hit_id>
 		# <Hit_def>RecName: Full=Rhodopsin</Hit_def>
@@ -242,7 +423,7 @@ class XMLRecordScan(object):
 		# <Hit_accession>Subject_1</Hit_accession>
 		#apparently depending on the parse_deflines switch            
 
-		sseqid = self.record._hit_id.split(None,1)[0]
+		sseqid = bline._hit_id.split(None,1)[0]
 
 		# If Hit_id == Hit_accession AND it is a default "Subject_1" ...   
 		# OR Hit_accession IN Hit_id and BL_ORD_ID|XXXX contains hit_accession
@@ -254,96 +435,29 @@ class XMLRecordScan(object):
 		else:
 			hit_def = sseqid + " " + bline._hit_def
 		
-		self.record.sseqid = sseqid
-		
 		if common.re_default_ncbi_id.match(sseqid):
-			self.record.accessionid = sseqid.split('|')[3] 
+			accessionid = sseqid.split('|')[3] 
 		elif common.re_default_ref_id.match(sseqid):
-			self.record.accessionid = sseqid.split('|')[1] 
+			accessionid = sseqid.split('|')[1] 
 		else: 
 			# Have to use the whole string.
-			self.record.accessionid = sseqid
-			
-		
-		# NCBI notes: Expecting either this, from BLAST 2.2.25+ using FASTA vs FASTA
-		# <Iteration_query-ID>sp|Q9BS26|ERP44_HUMAN</Iteration_query-ID>
-		# <Iteration_query-def>Endoplasmic reticulum resident protein 44 OS=Homo sapiens GN=ERP44 PE=1 SV=1</Iteration_query-def>
-		# <Iteration_query-len>406</Iteration_query-len>
-		# <Iteration_hits></Iteration_hits>
-		#
-		#Or, from BLAST 2.2.24+ run online
-		# <Iteration_query-ID>Query_1</Iteration_query-ID>
-		# <Iteration_query-def>Sample</Iteration_query-def>
-		# <Iteration_query-len>516</Iteration_query-len>
-		# <Iteration_hits>...
-
-		# Note BioPython's approach http://biopython.org/DIST/docs/api/Bio.SearchIO.BlastIO.blast_xml-pysrc.html
-		# ... if hit_id.startswith('gnl|BL_ORD_ID|'): ...
-		
-		if common.re_default_query_id.match(bline._qseqid): 
-		#Place holder ID, take the first word of the query definition
-			qseqid = bline._qdef.split(None,1)[0]
-		else:
-			qseqid = bline._qseqid
-
-		self.record.qseqid = qseqid
-		
-		self.record.evalue = "0.0" if bline._evalue == "0" else "%0.0e" % float(bline._evalue)
-
-		# NCBI notes:
-		#   if bline._bitscore < 100:
-		#       #Seems to show one decimal place for lower scores
-		#       bitscore = "%0.1f" % bline._bitscore
-		#   else:
-		#       #Note BLAST does not round to nearest int, it truncates
-		#       bitscore = "%i" % bline._bitscore
-		bitscore = float(bline._bitscore)
-		self.record.bitscore = "%0.1f" % bitscore if bitscore < 100 else "%i" % bitscore
-
-		self.record.pident = "%0.2f" % (100*float(bline._nident)/float(bline._length))
-
-		self.record.gapopen = str(len(bline._qseq.replace('-', ' ').split())-1 + \
-			len(bline._sseq.replace('-', ' ').split())-1)
-
-		mismatch = bline._mseq.count(' ') + bline._mseq.count('+') \
-		     - bline._qseq.count('-') - bline._sseq.count('-')
-		#assert len(bline._qseq) == len(bline._sseq) == len(bline._mseq) == int(bline._length)
-		self.record.mismatch = str(mismatch)
+			accessionid = sseqid
 
 		# Extended fields
 		#sallseqid gets ";" delimited list of first words in each hit_def "x>y>z" expression. 
 		#Nov 7 2013 fix: https://github.com/peterjc/galaxy_blast/blob/master/tools/ncbi_blast_plus/blastxml_to_tabular.py
 		hit_def_array = hit_def.split(" >") #Note: elem.text below converts escaped "&gt;" back to ">"
 		try: 
-			self.record.sallseqid = ";".join(name.split(None,1)[0] for name in hit_def_array)
+			sallseqid = ";".join(name.split(None,1)[0] for name in hit_def_array)
 		except IndexError as e:
 			common.stop_err("Problem splitting multiple hit ids?\n%r\n--> %s" % (hit_def, e))
 
-		# Calculate accession ids, and check bin(s) for them, update record accordingly.
-		self.binManager.setStatus(self.record)
-
-		self.record.ppos = "%0.2f" % (100*float(bline._positive)/float(bline._length))
-		qframe = bline._qframe
-		sframe = bline._sframe 
-		if bline._blast_program == "blastp":
-			#Probably a bug in BLASTP that they use 0 or 1 depending on format
-			if qframe == "0": qframe = "1" 
-			if sframe == "0": sframe = "1" 
-		
-		self.record.qframe = qframe
-		self.record.sframe = sframe
-		self.record.slen = str(int(bline._hit_len))
-		self.record.qlen = str(int(bline._qlen))
+		# Check bin(s) for accession ids.
+		(bin_values, excluded) = self.binManager.getStatus(sseqid, sallseqid)
 
-		#NCBI DOCUMENTATION ON qcovs == pcov == pct_coverage == http://www.ncbi.nlm.nih.gov/IEB/ToolBox/CPP_DOC/lxr/source/include/objects/seqalign/Seq_align.hpp#L54
-		#extended+
-		self.record.pcov = "%0.2f" % (float(int(bline._qend) - int(bline._qstart) + 1)/int(bline._qlen) * 100)
-		
 		titlesArray = self.getSalltitles(hit_def_array)
-		self.record.salltitles = "<>".join(titlesArray)
-		self.record.stitle = titlesArray[0]
 
-		return True # One may return false anywhere above to filter out current <Hsp> record.
+		return (sseqid, accessionid, sallseqid, "<>".join(titlesArray), titlesArray[0], bin_values)
 
 
 	def getSalltitles(self, hit_def_array):
@@ -365,23 +479,404 @@ class XMLRecordScan(object):
 	#
 	# @uses .record object with field attributes
 	# @uses .prelim_columns (used before final column selection)
-	def outputTabDelimited(self):
+	def outputValues(self):
 		values = []
-		
+
 		for col in self.columns:
-			values.append(getattr(self.record, col['field']))
+			if col['field'] in self.sidecar_fields:
+				values.append(self.sequence_sidecar.store(getattr(self.record, col['field'])))
+			else:
+				values.append(getattr(self.record, col['field']))
+
+		return values
 
-		return '\t'.join(values) + '\n'
+	def outputTabDelimited(self):
+		return '\t'.join(self.outputValues()) + '\n'
 
 
 
 class ReportEngine(object):
 
-	def __init__(self): pass
+	def __init__(self):
+		self.column_store = None
+		self.progress = None
+		self.checkpoint = None
+		self.preview = None
+		self.summary = None
+		self.database = None
+		self.hitAggregate = None
+
+	def writeRecord(self, outfile, tagGroup, query_stat):
+		""" Output current record to the work file, or to the column store in columnar (-C) mode
+		 @param query_stat dictionary	query_stats entry of the record's query
+		"""
+		if self.column_store != None:
+			self.column_store.add(tagGroup.record)
+		else:
+			outfile.write(tagGroup.outputTabDelimited())
+		if self.progress != None:
+			self.progress.add()
+		if self.summary != None:
+			self.summary.add(tagGroup.record, query_stat)
+		if self.database != None:
+			self.database.add(tagGroup.record)
+
+	def writeBatch(self, numericBatch, tagGroup, fieldFilter, outfile, query_stat, row_limit):
+		""" Process and write a batch of HSPs of one query, as the unbatched parse loop does one HSP at a time.
+
+		 @param query_stat dictionary	rows, filtered_rows counts of query that batch belongs to.
+		"""
+		for (raw_values, numeric_fields) in numericBatch.compute():
+			if row_limit and query_stat['filtered_rows'] >= row_limit: break
+
+			tagGroup.setRawValues(raw_values)
+			# Certainly fails a numeric filter, but must still be noted as a seen match, as FieldFilter.process() would.
+			if numeric_fields == None:
+				if fieldFilter.drop_redundant_hits:
+					tagGroup.setIdFields()
+					fieldFilter.markMatch(tagGroup.record)
 
-	def __main__(self):
+			elif tagGroup.processRecord(numeric_fields) and fieldFilter.process(tagGroup.record):
+				query_stat['filtered_rows'] += 1
+				self.writeRecord(outfile, tagGroup, query_stat)
+
+
+	def inputSource(self, in_file, options):
+		""" @return file path or file-like object for ElementTree.iterparse(): the BLAST XML input, followed (-F option),
+		 read from a checkpoint (-R option), sampled for a preview (-p option), or just its selected queries (-Q option),
+		 read via its iteration index.
+		"""
+		if options.follow:
+			return follow_input.openInput(in_file)
+
+		if self.checkpoint != None:
+			return self.checkpoint.openInput(in_file)
+
+		if options.preview:
+			(rows, seconds) = report_preview.parseBudget(options.preview)
+			self.preview = report_preview.PreviewReader(in_file, rows, seconds)
+			return self.preview
+
+		if options.query_list:
+			if os.path.isfile(options.query_list):
+				with open(options.query_list, 'rb') as fp_in:
+					names = [line.strip() for line in fp_in if len(line.strip())]
+			else:
+				names = [name.strip() for name in options.query_list.split(',') if len(name.strip())]
+
+			index = iteration_index.IterationIndex(in_file)
+			try:
+				index.load()
+			except (IOError, OSError) as e:
+				common.stop_err("Unable to index BLAST XML input: %s" % e.strerror)
+
+			(iterations, missing) = index.select(names)
+			print 'Queries: %i of %i selected' % (len(iterations), len(index.iterations))
+			if len(missing):
+				print 'Queries not found: ' + ', '.join(missing)
+			return index.reader(iterations)
+
+		return in_file
+
+
+	def parseRecords(self, in_file, tagGroup, fieldFilter, numericBatch, outfile, options, recordCache = None):
+		""" Parse BLAST XML input, processing, filtering and writing each <Hsp> record, or each <Hit> in hit mode (-H).
+
+		 @param recordCache object	record_cache.RecordCache recording every processed record, or None
+		 @return query_stats array of {'id', 'rows', 'filtered_rows'} per query
+		"""
+		source = self.inputSource(in_file, options)
+		try: 
+			# Get an iterable, see http://effbot.org/zone/element-iterparse.htm
+			context = ElementTree.iterparse(source, events=("start","end")) # By default only does end events. 
+			context = iter(context)
+			event, root = context.next() # Creates reference to root element on 'start' event, for housecleaning below.
+		except:
+			common.stop_err("Invalid data format. !!")
+
+		row_count = 0
+		row_count_filtered = 0
+		query_stats = self.checkpoint.queryStats() if self.checkpoint != None else []
+
+
+		for event, elem in context:
+
+			# Alternative is to wipe Hit/Hsp fields on event == "start".		
+			tag = elem.tag
+			if event == 'end':
+				if tag in tagGroup.tags : #Content of these tags fills a tabular line with column info.
+					tagGroup.setRecordAttr(tag, elem.text)
+					if tag == 'Iteration_query-def':
+						row_count = 0
+						row_count_filtered = 0
+						query_stats.append({'id':elem.text, 'rows' : 0, 'filtered_rows' : 0})
+
+				# In hit mode (-H) each processed <Hsp> is added to its hit's aggregate, written at </Hit>.
+				elif tag == 'Hsp' and self.hitAggregate != None:
+					if options.row_limit == 0 or row_count_filtered < options.row_limit:
+						if tagGroup.processRecord(): self.hitAggregate.add(tagGroup.record)
+					root.clear()
+
+				# Process each </hsp> record
+				elif tag == 'Hsp':	
+					row_count += 1
+					query_stats[-1]['rows'] = row_count # real rows, not clipped
+					if numericBatch != None:
+						numericBatch.add(tagGroup.getRawValues())
+						if numericBatch.full():
+							self.writeBatch(numericBatch, tagGroup, fieldFilter, outfile, query_stats[-1], options.row_limit)
+						root.clear()
+
+					elif options.row_limit == 0 or row_count_filtered < options.row_limit: 
+					
+						# Transform <Hsp> record & add field info.
+						if tagGroup.processRecord(): 
+							if recordCache != None: recordCache.add(tagGroup.record)
+
+							#if tagGroup.processFilters():
+							if fieldFilter.process(tagGroup.record):
+								row_count_filtered +=1
+								query_stats[-1]['filtered_rows'] = row_count_filtered 
+								self.writeRecord(outfile, tagGroup, query_stats[-1])
+								
+						root.clear() # Clears references from root to (now unused) children to keep iterated datastructure small ???
+
+					# The record cache needs every HSP, including those past the row limit.
+					elif recordCache != None:
+						if tagGroup.processRecord(): recordCache.add(tagGroup.record)
+						root.clear()
+
+				elif tag == 'Hit' and self.hitAggregate != None:
+					row_count += 1
+					query_stats[-1]['rows'] = row_count # hits, in hit mode
+					if self.hitAggregate.apply(tagGroup.record) and fieldFilter.process(tagGroup.record):
+						row_count_filtered += 1
+						query_stats[-1]['filtered_rows'] = row_count_filtered
+						self.writeRecord(outfile, tagGroup, query_stats[-1])
+
+				elif tag == 'Iteration':
+					# Batched HSPs never span queries.
+					if numericBatch != None:
+						self.writeBatch(numericBatch, tagGroup, fieldFilter, outfile, query_stats[-1], options.row_limit)
+					if self.progress != None:
+						self.progress.endQuery()
+					if self.checkpoint != None and self.checkpoint.endIteration():
+						self.saveCheckpoint(outfile, tagGroup, fieldFilter, query_stats)
+					if self.preview != None:
+						self.preview.endIteration(query_stats)
+
+				elem.clear() # I think root.clear() cover this case.
+
+		if numericBatch != None and len(query_stats):
+			self.writeBatch(numericBatch, tagGroup, fieldFilter, outfile, query_stats[-1], options.row_limit)
+
+		root.clear() 
+
+		return query_stats
+
+
+	def saveCheckpoint(self, outfile, tagGroup, fieldFilter, query_stats):
+		""" Flush the work file and sequence sidecar, and save a checkpoint of the parse (see report_checkpoint.py). """
+		outfile.flush()
+		if self.summary != None:
+			self.summary.close()
+		sidecar_size = 0
+		if tagGroup.sequence_sidecar != None:
+			tagGroup.sequence_sidecar.flush()
+			sidecar_size = tagGroup.sequence_sidecar.offset
+
+		database_rows = self.database.checkpoint() if self.database != None else 0
+
+		self.checkpoint.save({'work_size': os.path.getsize(self.work_file), 'sidecar_size': sidecar_size,
+			'database_rows': database_rows, 'query_stats': query_stats, 'matches': fieldFilter.matches.keys()})
+
+
+	def checkpointSignature(self, in_file, args, options):
+		""" @return string	Identifies the input file version and the report settings that a checkpoint is valid for. """
+		stat = os.stat(in_file)
+		settings = dict(vars(options))
+		for name in ['checkpoint_seconds', 'resume']: del settings[name]
+		return repr([stat.st_size, stat.st_mtime, args, sorted(settings.items())])
+
+
+	def startQuery(self, query_id, rows = 0):
+		""" Start a query's statistics for records added with addRecord().
+		 @return dictionary	{'id', 'rows', 'filtered_rows'} of the query, also appended to self.query_stats
+		"""
+		query_stat = {'id': query_id, 'rows': rows, 'filtered_rows': 0}
+		self.query_stats.append(query_stat)
+		return query_stat
 
 
+	def addRecord(self, query_stat):
+		""" Filter and write a processed record that doesn't have this report's reference bin columns yet,
+		 i.e. one replayed from the record cache or shared by several reports.  Bin columns are looked up here.
+
+		 @param query_stat dictionary	from startQuery(), of the query the record belongs to.
+		"""
+		if self.options.row_limit and query_stat['filtered_rows'] >= self.options.row_limit: return
+
+		record = self.tagGroup.record
+		bin_key = (record.sseqid, record.sallseqid)
+		bin_values = self.bin_cache.get(bin_key)
+		if bin_values == None:
+			(bin_values, excluded) = self.tagGroup.binManager.getStatus(record.sseqid, record.sallseqid)
+			self.bin_cache.set(bin_key, bin_values)
+		for (field, value) in bin_values:
+			setattr(record, field, value)
+
+		if self.fieldFilter.process(record):
+			query_stat['filtered_rows'] += 1
+			self.writeRecord(self.outfile, self.tagGroup, query_stat)
+
+
+	def replayRecords(self, cached, record, reports):
+		""" Feed records from the record cache to one or more reports, in input order.
+
+		 @param cached array	[query_stats, records iterator] from record_cache.RecordCache.load()
+		 @param record object	Record object shared by the reports' XMLRecordScan instances.
+		 @param reports array	ReportEngine instances set up with setup()
+		"""
+		(cached_stats, records) = cached
+
+		for (query_id, hsp_count) in cached_stats:
+			query_stats = [report.startQuery(query_id, hsp_count) for report in reports]
+
+			for ptr in xrange(hsp_count):
+				record.__dict__.update(records.next())
+				for (report, query_stat) in zip(reports, query_stats):
+					report.addRecord(query_stat)
+
+
+	def parseShared(self, source, tagGroup, reports, recordCache = None):
+		""" Parse BLAST XML input once for several reports: each <Hsp> record's fields are derived once by
+		 tagGroup, into a record object the reports share, then each report filters and writes it.
+
+		 @param source string or object	BLAST XML input path, or an inputSource() object
+		 @param tagGroup object	XMLRecordScan without custom columns or bins; its record is shared by the reports.
+		 @param reports array	ReportEngine instances set up with setup()
+		 @param recordCache object	record_cache.RecordCache recording every processed record, or None
+		"""
+		try: 
+			context = ElementTree.iterparse(source, events=("start","end"))
+			context = iter(context)
+			event, root = context.next() # Creates reference to root element on 'start' event, for housecleaning below.
+		except:
+			common.stop_err("Invalid data format. !!")
+
+		query_stats = []
+		for event, elem in context:
+			tag = elem.tag
+			if event == 'end':
+				if tag in tagGroup.tags:
+					tagGroup.setRecordAttr(tag, elem.text)
+					if tag == 'Iteration_query-def':
+						query_stats = [report.startQuery(elem.text) for report in reports]
+
+				elif tag == 'Hsp':
+					for query_stat in query_stats:
+						query_stat['rows'] += 1
+
+					if tagGroup.processRecord():
+						if recordCache != None: recordCache.add(tagGroup.record)
+						for (report, query_stat) in zip(reports, query_stats):
+							report.addRecord(query_stat)
+
+					root.clear()
+
+				elif tag == 'Iteration':
+					for report in reports:
+						if report.progress != None: report.progress.endQuery()
+
+				elem.clear()
+
+		root.clear()
+
+
+	def resultOutputs(self, args, options):
+		""" @return [name, file path] of the tabular, HTML, selection and summary outputs named on the command line """
+		outputs = [['tabular', args[2]]]
+		if len(args) > 3:
+			outputs.append(['html', args[3]])
+		if len(args) > 4 and args[4] != 'None:None:None:None':
+			selection_file = args[4].split(':')[0]
+			if selection_file != 'None':
+				outputs.append(['selection', selection_file])
+		if options.summary_file:
+			outputs.append(['summary', options.summary_file])
+		return outputs
+
+
+	def resultSettings(self, input_hash, output_format, args, options):
+		""" Everything that determines the content of a report's outputs, for result_cache.ResultCache.
+
+		 @param input_hash string	record_cache.fileHash() hex digest of the BLAST XML input
+		 @return array	[name, value] pairs
+		"""
+		html_template = ''
+		if len(args) > 3:
+			html_template = 'templates.html_report'
+			if len(args) > 5 and not args[5].strip() in ['', 'None']:
+				html_template = args[5].strip()
+
+		selection_id = ''
+		if len(args) > 4:
+			sel_file_fields = args[4].split(':')
+			if len(sel_file_fields) > 3: selection_id = sel_file_fields[3]
+
+		field_spec_path = os.path.join(os.path.dirname(__file__), 'blast_reporting_fields.tab')
+		settings = [
+			['input', input_hash],
+			['field_spec', record_cache.fileHash(field_spec_path).hexdigest()],
+			['format', output_format],
+			['filters', result_cache.normalizeSpec(options.filters)],
+			['columns', result_cache.normalizeSpec(options.custom_fields)],
+			['bins', result_cache.normalizeSpec(options.reference_bins)],
+			['labels', options.column_labels or ''],
+			['row_limit', options.row_limit],
+			['redundant', options.drop_redundant_hits],
+			['columnar', options.columnar],
+			['compression', options.compression],
+			# Output file suffixes select compression; file names are otherwise irrelevant.
+			['outputs', [[name, os.path.splitext(file_path)[1]] for (name, file_path) in self.resultOutputs(args, options)]],
+			['template', html_template],
+			['selection_id', selection_id],
+			['code', self.codeHash(args)]
+		]
+
+		binManager = reference_bins.ReferenceBins()
+		for bin_spec in result_cache.normalizeSpec(options.reference_bins).split(';'):
+			bin_name = bin_spec.split(':')[0]
+			if bin_name != '':
+				settings.append(['bin ' + bin_name, binManager.binVersion(bin_name)])
+
+		return settings
+
+
+	def codeHash(self, args):
+		""" @return string	Hex digest of the engine modules in RESULT_CODE_FILES and of the HTML template's folder (its module,
+		 the modules it imports from there, and its header and footer files), so that cached outputs of older code aren't reused.
+		"""
+		folder = os.path.dirname(os.path.abspath(__file__))
+		file_paths = [os.path.join(folder, name) for name in RESULT_CODE_FILES]
+
+		template_module = self.templateModule(args)
+		if template_module != None:
+			template_folder = os.path.dirname(os.path.abspath(template_module.__file__))
+			for name in sorted(os.listdir(template_folder)):
+				file_path = os.path.join(template_folder, name)
+				if os.path.isfile(file_path) and not name.endswith(('.pyc', '.pyo')):
+					file_paths.append(file_path)
+
+		digest = hashlib.sha1()
+		for file_path in file_paths:
+			digest.update(os.path.basename(file_path) + '\n')
+			record_cache.fileHash(file_path, digest)
+		return digest.hexdigest()
+
+
+	def commandParser(self):
+
 		## *************************** Parse Command Line *****************************
 		parser = common.MyParser(
 			description = 'Generates tab-delimited table report based on BLAST XML results.',
@@ -450,12 +945,74 @@ class ReportEngine(object):
 		parser.add_option('-B', '--refbins', type='string', dest='refbins', 
 			help='Testing library_data form input.')
 
+		parser.add_option('-N', '--batch', type='int', dest='batch_size', default=0,
+			help='Calculate numeric fields (evalue, bitscore, pident, ppos, pcov) and their filters with numpy for up to N HSPs of a query at a time.  The default 0=one HSP at a time.')
+
+		parser.add_option('-S', '--sidecar', dest='sequence_sidecar', default=False, action='store_true',
+			help='Store aligned sequences (qseq, sseq, mseq) in a temporary sidecar file while sorting, rather than in the tabular file.  Speeds up large reports that include sequences.')
+
+		parser.add_option('-P', '--pages', type='string', dest='html_pages', 
+			help='Split the HTML report into pages: "query" for one page per query, or a number of rows per page.  The HTML output file becomes an index of the pages.')
+
+		parser.add_option('-D', '--pagedir', type='string', dest='html_page_dir', 
+			help='Folder for HTML report pages.  The default is the HTML output file path without extension, plus "_files".')
+
+		parser.add_option('-W', '--workers', type='int', dest='html_workers', default=0,
+			help='Number of processes rendering HTML report pages, or processing batch (-M) inputs.  The default 0=$GALAXY_SLOTS if set, otherwise the number of CPUs.')
+
+		parser.add_option('-z', '--compress', type='string', dest='compression', default='',
+			help='Compress the tabular, HTML and selection outputs as they are written: gzip, zstd (multithreaded), or none.  By default files named with a .gz or .zst suffix are compressed accordingly.')
+
+		parser.add_option('-w', '--writer', dest='background_writer', default=False, action='store_true',
+			help='Write output files from background threads, so that XML parsing and report rendering don\'t wait on slow (e.g. network) file systems.')
+
+		parser.add_option('-C', '--columnar', dest='columnar', default=False, action='store_true',
+			help='Keep processed records in memory in a typed columnar store, and sort them there, instead of in a tab-delimited work file sorted by the linux "sort" command.  Rows are sorted in the same order either way.  For reports whose rows fit in memory.')
+
+		parser.add_option('-d', '--database', type='string', dest='database_file',
+			help='Also load the report rows into an indexed SQLite database file, along with per-query counts and the report options.')
+
+		parser.add_option('-K', '--cache', type='string', dest='cache_dir',
+			help='Cache folder.  The processed records of each BLAST XML input are cached there, so that later reports on the same input with other filters, columns, bins or templates skip the XML parse.  The outputs of each report are cached too, and linked to the output paths of an identical later report.')
+
+		parser.add_option('-m', '--reports', type='string', dest='report_list',
+			help='File listing several report configurations to produce from one parse of the BLAST XML input, one per line: the command line arguments and options that would follow the input file.  Options given on the command line are defaults for every report.')
+
+		parser.add_option('-M', '--manifest', type='string', dest='manifest',
+			help='Batch mode: tab-delimited file listing BLAST XML inputs and their outputs, one input per line: input file, tabular output file, and optionally HTML output file and selection file.  The command line then gives just the out format and optional HTML template, and its options apply to every input.')
+
+		parser.add_option('-F', '--follow', dest='follow', default=False, action='store_true',
+			help='Follow a BLAST XML input file that is still being written, or read a FIFO or standard input ("-").  As each query is completed, its rows are appended to the tabular output and to a progressive HTML report; the final sorted outputs are written when the XML document is complete.')
+
+		parser.add_option('-Q', '--queries', type='string', dest='query_list',
+			help='Report only these queries: a comma-delimited list of query ids (qseqid), or a file listing one per line.  Queries are read directly from their byte ranges, found with an index of the BLAST XML file\'s <Iteration> elements that is stored next to it (as [input file].iterations).')
+
+		parser.add_option('-k', '--checkpoint', type='float', dest='checkpoint_seconds', default=0,
+			help='Save a checkpoint of the XML parse every CHECKPOINT_SECONDS seconds, at the end of a query, so that a stopped run can be resumed (-R).  The default 0=no checkpoints.')
+
+		parser.add_option('-R', '--resume', dest='resume', default=False, action='store_true',
+			help='Resume from the checkpoint of an earlier run of this report with the same input and options, if there is one, and save checkpoints as it goes (every 600 seconds unless -k is given).  The outputs are the same as those of an uninterrupted run.')
+
+		parser.add_option('-p', '--preview', type='string', dest='preview',
+			help='Preview the report from a sample of queries spread across the BLAST XML input, up to a budget of report rows (e.g. 1000) or seconds (e.g. 30s).  The outputs are labeled as a preview, with estimates of the full report\'s rows and parse time.')
+
+		parser.add_option('-s', '--summary', type='string', dest='summary_file',
+			help='Also write a table of per-query summary statistics to this file: best hit by bitscore, minimum, mean and maximum % identity, coverage quartiles and rows per reference bin.  The HTML report shows it in its header.')
+
+		parser.add_option('-H', '--hits', dest='hit_rows', default=False, action='store_true',
+			help='Report one row per subject hit rather than per HSP: the hit\'s query coverage (pcov) over all its HSPs, as BLAST\'s qcovs, its summed bitscore and best evalue, and the other fields of its top-scoring HSP.  Filters and the row limit apply to hit rows.')
+
 		parser.add_option('-r', '--redundant', dest='drop_redundant_hits', default=False, action='store_true', 
 			help='Return only first match to a gene bank id result.')
 
+		return parser
+
+
+	def __main__(self):
+
+		parser = self.commandParser()
 		options, args = parser.parse_args()
 
-		import time
 		time_start = time.time()
 
 		# "info" command provides a dump of all the fields that can be displayed from the Blast search.
@@ -475,21 +1032,78 @@ class ReportEngine(object):
 
 			sys.exit(1)	
 
+		if options.manifest:
+			self.runBatch(options, args)
+		elif options.report_list:
+			self.runReports(parser, options, args)
+		else:
+			self.runReport(options, args)
+
+		print('Execution time (seconds): ' + str(int(time.time()-time_start)))
+
+
+	def inputHash(self, in_file):
+		""" @return string	record_cache.fileHash() hex digest of the BLAST XML input, which keys the caches """
+		try:
+			return record_cache.fileHash(in_file).hexdigest()
+		except IOError as e:
+			common.stop_err("Unable to read BLAST XML input: %s" % e.strerror)
+
+
+	def setup(self, options, args, input_hash = None, tagGroup = None):
+		""" Prepare a report's fields, filters, work file and caches from its command line options and arguments.
+
+		 @param input_hash string	inputHash() of the input, if already known.
+		 @param tagGroup object	XMLRecordScan built with the same options, to clone() rather than build anew.
+		 @return boolean	False if the report's outputs were linked from the result cache, so there's nothing to do.
+		"""
+		if not options.compression in ['', 'gzip', 'zstd', 'none']:
+			common.stop_err("Output compression should be gzip, zstd or none: " + options.compression)
+
 		try:
 			in_file, output_format, out_tabular_file = args[0:3]
 		
 		except:
 			common.stop_err("Expecting 3 arguments: input BLAST XML file, out format (std | std+seqs | ext | ext+ | custom), and output tabular file")
 
-		try: 
-			# Get an iterable, see http://effbot.org/zone/element-iterparse.htm
-			context = ElementTree.iterparse(in_file, events=("start","end")) # By default only does end events. 
-			context = iter(context)
-			event, root = context.next() # Creates reference to root element on 'start' event, for housecleaning below.
-		except:
-			common.stop_err("Invalid data format. !!")
+		if options.query_list and (options.follow or in_file == '-'):
+			common.stop_err("Queries (-Q) can only be selected from a complete BLAST XML file, not a followed one or standard input.")
+
+		if options.preview:
+			if options.follow or options.query_list or options.report_list or in_file == '-':
+				common.stop_err("A preview (-p) samples a complete BLAST XML file; it can't be combined with the follow (-F), queries (-Q) or reports (-m) options, or read standard input.")
+			report_preview.parseBudget(options.preview)
+
+		if options.hit_rows and options.report_list:
+			common.stop_err("Hit rows (-H) can't be combined with the reports (-m) option, whose reports share HSP records.")
+
+		if (options.follow or options.query_list or options.preview or options.hit_rows) and options.cache_dir:
+			print 'Record and result caches are not used when following input, selecting queries, previewing or reporting hit rows.'
+			options.cache_dir = None
+
+		# Set for previews, which label their outputs as such.
+		options.report_notice = ''
+
+		resultCache = None
+		result_outputs = []
+		if options.cache_dir:
+			if input_hash == None:
+				input_hash = self.inputHash(in_file)
 
-		tagGroup = XMLRecordScan(options, output_format)
+			if options.html_pages or options.database_file:
+				print 'Result cache: not used with paged HTML or database output.'
+			else:
+				result_outputs = self.resultOutputs(args, options)
+				resultCache = result_cache.ResultCache(options.cache_dir, self.resultSettings(input_hash, output_format, args, options))
+				if resultCache.fetch(result_outputs):
+					print 'Result cache: outputs of an identical report linked from cache.'
+					return False
+
+				# Outputs may be hard links into the cache from an earlier run; replace rather than overwrite them.
+				for (name, file_path) in result_outputs:
+					if os.path.lexists(file_path): os.remove(file_path)
+
+		tagGroup = tagGroup.clone() if tagGroup != None else XMLRecordScan(options, output_format)
 		fieldFilter = common.FieldFilter(tagGroup, options) # .filter list field names are changed above.
 
 		if options.reference_bins: 		print 'Database bins: %s' % str([bin.name for (ptr, bin) in enumerate(tagGroup.binManager.reference_bins) ]).translate(None, "[']")
@@ -497,52 +1111,301 @@ class ReportEngine(object):
 		if options.filters:				print 'Filters: ' + options.filters
 		if options.drop_redundant_hits:	print 'Throwing out redundant hits...'
 
+		# Unsorted, then sorted rows are kept in a work file; final outputs are all written from it in one pass.
+		work_file = out_tabular_file + '.sort'
+
+		checkpoint_state = None
+		if options.checkpoint_seconds or options.resume:
+			if options.columnar or options.follow or options.query_list or options.preview or options.report_list or options.cache_dir:
+				print 'Checkpoints are not used with the columnar (-C), follow (-F), queries (-Q), preview (-p), reports (-m) or cache (-K) options.'
+			else:
+				interval = options.checkpoint_seconds or report_checkpoint.CHECKPOINT_DEFAULT_SECONDS
+				self.checkpoint = report_checkpoint.ReportCheckpoint(out_tabular_file, self.checkpointSignature(in_file, args, options), interval)
+				if options.resume:
+					checkpoint_state = self.checkpoint.load()
+
+			# The work file, sidecar and database must still hold what they did at the checkpoint.
+			if checkpoint_state != None:
+				sidecar_file = out_tabular_file + '.seqs'
+				if not os.path.exists(work_file) or os.path.getsize(work_file) < checkpoint_state['work_size'] \
+					or (checkpoint_state['sidecar_size'] and (not os.path.exists(sidecar_file) or os.path.getsize(sidecar_file) < checkpoint_state['sidecar_size'])) \
+					or (options.database_file and not report_database.rowCount(options.database_file) >= checkpoint_state['database_rows']):
+					print 'Checkpoint work files are missing or incomplete, starting from the beginning.'
+					checkpoint_state = self.checkpoint.state = None
+
+		if options.columnar:
+			# The column store keeps aligned sequences out-of-line itself.
+			self.column_store = column_store.ColumnStore(tagGroup.columns, out_tabular_file + '.cols')
+
+		elif options.sequence_sidecar:
+			tagGroup.setSequenceSidecar(out_tabular_file + '.seqs', checkpoint_state['sidecar_size'] if checkpoint_state != None else 0)
+
+		if options.database_file:
+			resume_rows = checkpoint_state['database_rows'] if checkpoint_state != None else None
+			self.database = report_database.ReportDatabase(options.database_file, tagGroup, resume_rows, self.checkpoint != None)
+
 		# ************************ FILE OUTPUT *****************************
 		# IT IS CRITICAL THAT EVERY <HIT>/<HSP> RETURN A COMPLETE XML SET OF TAGS OTHERWISE PREV. RECORD VALUES PERSIST
 		# NOTE: GALAXY 2012 has bug in html data display - it will show duplicate records OCCASIONALLY (at least on some browsers).  You have to download data file to verify there are no duplicates
 		
-		row_count = 0
-		row_count_filtered = 0
-		outfile = open(out_tabular_file, 'w')
-		query_stats = []
+		if checkpoint_state != None:
+			with open(work_file, 'r+b') as fp_work:
+				fp_work.truncate(checkpoint_state['work_size'])
+			outfile = common.openOutput(work_file, 'none', options.background_writer, True)
+			fieldFilter.matches = dict.fromkeys(checkpoint_state['matches'], True)
+			print 'Resuming from checkpoint: %i queries done.' % len(checkpoint_state['query_stats'])
+		else:
+			outfile = common.openOutput(work_file, 'none', options.background_writer)
+
+		self.options = options
+		self.args = args
+		self.in_file = in_file
+		self.input_hash = input_hash
+		self.output_format = output_format
+		self.out_tabular_file = out_tabular_file
+		self.tagGroup = tagGroup
+		self.fieldFilter = fieldFilter
+		self.work_file = work_file
+		self.outfile = outfile
+		self.resultCache = resultCache
+		self.result_outputs = result_outputs
+		self.query_stats = []
+		self.bin_cache = common.LRUCache(SUBJECT_CACHE_SIZE)
+		if options.summary_file:
+			self.summary = query_summary.QuerySummary(tagGroup, 'Hits' if options.hit_rows else 'HSPs')
+		if options.hit_rows:
+			self.hitAggregate = hit_aggregate.HitAggregate()
+
+		if options.follow:
+			out_html_file = args[3] if len(args) > 3 else None
+			self.progress = report_progress.ProgressReport(tagGroup, options, out_tabular_file, self.templateModule(args), out_html_file)
+
+		return True
+
+
+	def runReport(self, options, args, tagGroup = None):
+		""" Produce one report, parsing the input or replaying it from the record cache.
+		 @param tagGroup object	Optional XMLRecordScan prototype, see setup().
+		"""
+		if not self.setup(options, args, None, tagGroup): return
 
-		for event, elem in context:
+		(in_file, tagGroup, fieldFilter) = (self.in_file, self.tagGroup, self.fieldFilter)
 
-			# Alternative is to wipe Hit/Hsp fields on event == "start".		
-			tag = elem.tag
-			if event == 'end':
-				if tag in tagGroup.tags : #Content of these tags fills a tabular line with column info.
-					tagGroup.setRecordAttr(tag, elem.text)
-					if tag == 'Iteration_query-def':
-						row_count = 0
-						row_count_filtered = 0
-						query_stats.append({'id':elem.text, 'rows' : 0, 'filtered_rows' : 0})
+		numericBatch = None
+		if options.batch_size > 0:
+			if options.hit_rows:
+				print 'Batch mode is not used with hit rows (-H); processing HSPs one at a time.'
+			elif numeric_batch.numpy == None:
+				print 'Batch mode needs numpy, which is not installed; processing HSPs one at a time.'
+			else:
+				numericBatch = numeric_batch.NumericBatch(fieldFilter, options.batch_size)
 
-				# Process each </hsp> record
-				elif tag == 'Hsp':	
-					row_count += 1
-					query_stats[-1]['rows'] = row_count # real rows, not clipped
-					if options.row_limit == 0 or row_count_filtered < options.row_limit: 
-					
-						# Transform <Hsp> record & add field info.
-						if tagGroup.processRecord(): 
+		recordCache = None
+		cached = None
+		if options.cache_dir:
+			field_spec_path = os.path.join(os.path.dirname(__file__), 'blast_reporting_fields.tab')
+			recordCache = record_cache.RecordCache(options.cache_dir, self.input_hash, field_spec_path)
+			cached = recordCache.load()
 
-							#if tagGroup.processFilters():
-							if fieldFilter.process(tagGroup.record):
-								row_count_filtered +=1
-								query_stats[-1]['filtered_rows'] = row_count_filtered 
-								outfile.write(tagGroup.outputTabDelimited())
-								
-						root.clear() # Clears references from root to (now unused) children to keep iterated datastructure small ???
+		if cached != None:
+			print 'Record cache: replaying processed records, skipping XML parse.'
+			self.replayRecords(cached, tagGroup.record, [self])
 
-				elem.clear() # I think root.clear() cover this case.
+		else:
+			if recordCache != None:
+				recordCache.startRecording(tagGroup.columns_in + RAW_NUMERIC_FIELDS)
+				numericBatch = None # The cache needs every HSP's fields, not just those passing filters.
 
-		root.clear() 
-		outfile.close()
+			self.query_stats = self.parseRecords(in_file, tagGroup, fieldFilter, numericBatch, self.outfile, options, recordCache)
+			if self.preview != None:
+				options.report_notice = self.preview.notice(self.query_stats)
+				print options.report_notice
+			print('Subject id cache: ' + str(tagGroup.subject_cache))
+
+			if recordCache != None:
+				recordCache.save(self.query_stats)
+
+		self.finish()
+
+
+	def runReports(self, parser, options, args):
+		""" Produce several reports, listed in options.report_list, from one parse (or record cache replay) of the input.
+		 Each line of the list holds a report's command line arguments and options, less the input file;
+		 blank lines and lines starting with "#" are skipped.
+		"""
+		if len(args) < 1:
+			common.stop_err("Expecting the input BLAST XML file argument.")
+		in_file = args[0]
+
+		try:
+			with open(options.report_list) as fp_in:
+				lines = [line.strip() for line in fp_in]
+		except IOError as e:
+			common.stop_err("Unable to read report list: %s" % e.strerror)
+
+		input_hash = self.inputHash(in_file) if options.cache_dir and not (options.follow or options.query_list) else None
+
+		# One tagGroup derives every field of every <Hsp> record; each report adds its own bins, filters and columns.
+		shared_options = copy.copy(options)
+		(shared_options.custom_fields, shared_options.reference_bins) = (None, None)
+		tagGroup = XMLRecordScan(shared_options, 'custom')
+
+		reports = []
+		for line in lines:
+			if line == '' or line[0] == '#': continue
+			(report_options, report_args) = parser.parse_args(shlex.split(line), copy.copy(options))
+			print 'Report: ' + line
+			report = ReportEngine()
+			if report.setup(report_options, [in_file] + report_args, input_hash):
+				report.tagGroup.record = tagGroup.record
+				reports.append(report)
+
+		if len(reports) == 0: return
+
+		recordCache = None
+		cached = None
+		if options.cache_dir:
+			field_spec_path = os.path.join(os.path.dirname(__file__), 'blast_reporting_fields.tab')
+			recordCache = record_cache.RecordCache(options.cache_dir, input_hash, field_spec_path)
+			cached = recordCache.load()
+
+		if cached != None:
+			print 'Record cache: replaying processed records, skipping XML parse.'
+			self.replayRecords(cached, tagGroup.record, reports)
+
+		else:
+			if recordCache != None:
+				recordCache.startRecording(tagGroup.columns_in + RAW_NUMERIC_FIELDS)
+
+			self.parseShared(self.inputSource(in_file, options), tagGroup, reports, recordCache)
+			print('Subject id cache: ' + str(tagGroup.subject_cache))
+
+			if recordCache != None:
+				recordCache.save(reports[0].query_stats)
+
+		for report in reports:
+			print 'Report: ' + report.out_tabular_file
+			report.finish()
+
+
+	def runBatch(self, options, args):
+		""" Produce a report for each input listed in the options.manifest file, all with the same options, in a pool
+		 of worker processes.  The field spec and reference bins are loaded once, before the pool starts.
+		 Manifest lines are tab-delimited: input file, tabular output file, and optionally HTML output file and
+		 selection file.  Blank lines and lines starting with "#" are skipped.
+		"""
+		global _batch_tag_group
+
+		if len(args) < 1:
+			common.stop_err("Expecting the out format argument (std | std+seqs | ext | ext+ | custom).")
+		output_format = args[0]
+		html_template = args[1] if len(args) > 1 else 'None'
+
+		# Batch inputs are the unit of parallelism; HTML pages of each are rendered in its own worker.
+		job_options = copy.copy(options)
+		job_options.html_workers = 1
+
+		jobs = []
+		try:
+			with open(options.manifest) as fp_in:
+				for line in fp_in:
+					if line.strip() == '' or line[0] == '#': continue
+					files = [item.strip() for item in line.rstrip('\r\n').split('\t')]
+					if len(files) < 2:
+						common.stop_err("Expecting an input file and tabular output file on batch manifest line: " + line)
+					job_args = [files[0], output_format, files[1]]
+					if len(files) > 2:
+						job_args.extend([files[2], files[3] if len(files) > 3 else 'None:None:None:None', html_template])
+					jobs.append([job_options, job_args])
+		except IOError as e:
+			common.stop_err("Unable to read batch manifest: %s" % e.strerror)
+
+		# Worker processes inherit the prototype when the pool forks.
+		_batch_tag_group = XMLRecordScan(copy.copy(options), output_format)
+
+		pool = None
+		workers = min(self.workerCount(options), len(jobs))
+		if workers > 1:
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap(runBatchJob, jobs)
+		else:
+			results = itertools.imap(runBatchJob, jobs)
+
+		failed = 0
+		for ((job_options, job_args), (log, error)) in itertools.izip(jobs, results):
+			print 'Input: ' + job_args[0]
+			sys.stdout.write(log)
+			if error != None:
+				failed += 1
+				print 'Failed: ' + error
+
+		if pool != None:
+			pool.close()
+			pool.join()
+
+		if failed:
+			common.stop_err('%i of %i batch inputs failed.' % (failed, len(jobs)))
+
+
+	def templateModule(self, args):
+		""" @return module	HTML report template module named by args[5], or None if there's no HTML output (args[3]) """
+		if len(args) < 4: return None
+
+		# args[5] = html_template, default from galaxy xml is 'templates.html_report', but testing can receive 'None' value
+		if len(args) > 5 and len(args[5].strip()) > 0 and not args[5].strip() == 'None': 
+				
+			html_template = args[5] #User-selected
+			if not html_template.translate(None, "._-" ).isalnum():
+				common.stop_err("The HTML Report template name is not correct.  It should be a python class path like templates.html_report)! : " + html_template)
+			
+		else:
+			html_template = 'templates.html_report'
+		
+		try:
+			# See http://stackoverflow.com/questions/769534/dynamic-loading-of-python-modules
+			return __import__(html_template, fromlist=['does not in fact matter what goes here!'])
+			
+		except ImportError:
+			common.stop_err("Unable to locate HTML Report template! : " + html_template)
+
+
+	def workerCount(self, options):
+		""" @return int	Number of worker processes: the -W option, else $GALAXY_SLOTS, else the number of CPUs. """
+		return options.html_workers or int(os.environ.get('GALAXY_SLOTS', 0)) or multiprocessing.cpu_count()
+
+
+	def finish(self):
+		""" Sort the report's work file or column store, and write all outputs. """
+		(options, args, in_file, output_format, out_tabular_file) = (self.options, self.args, self.in_file, self.output_format, self.out_tabular_file)
+		(tagGroup, work_file, query_stats) = (self.tagGroup, self.work_file, self.query_stats)
+
+		self.outfile.close()
+		if self.progress != None:
+			self.progress.close()
+		# The work file is sorted in place below, so a checkpoint of it can't be resumed from any more.
+		if self.checkpoint != None:
+			self.checkpoint.remove()
+
+		if self.summary != None:
+			self.summary.close()
+			self.summary.write(options.summary_file, query_stats, options.compression)
 
 
 		# Use fast Linux "sort" after filtering & file write
-		common.fileSort(out_tabular_file, tagGroup.columns)
+		time_sort = time.time()
+		if self.column_store != None:
+			self.column_store.sort()
+		else:
+			common.fileSort(work_file, tagGroup.columns)
+		timings = [['sort', time.time() - time_sort]]
+
+		if self.database != None:
+			time_database = time.time()
+			settings = dict(vars(options), input_file = in_file, output_format = output_format)
+			self.database.close(query_stats, settings)
+			timings.append(['sqlite', time.time() - time_database])
+
+		sinks = [common.TabularSink(out_tabular_file, tagGroup, options)]
 
 		"""
 		The "Selection file" option is meant for galaxy UI use in conjunction 
@@ -572,8 +1435,8 @@ class ReportEngine(object):
 					
 				if sel_requisites == 4:	
 					options.dataset_selection_id = sel_file_fields[3]
-					common.fileSelections(out_tabular_file, selection_file, tagGroup, options)
-				
+					sinks.append(common.SelectionSink(selection_file, tagGroup, options.compression))
+
 		
 		"""
 		We must have a template in order to write anything to above html output file.
@@ -586,35 +1449,87 @@ class ReportEngine(object):
 			- The new folder must be in python's sys.path, which is achieved by adding a .pth file to python's site-packages folder..  E.g. set up /usr/lib/python2.6/site-packages/galaxy-custom-modules.pth to contain "/usr/local/galaxy/shared/python2.6_galaxy_custom_modules" 
 		, and place 'templates_custom/html_report.py' in there.
 		"""
+		htmlManager = None
 		if len(args) > 3:
 			out_html_file = args[3] #Galaxy-generated	
-			# args[5] = html_template, default from galaxy xml is 'templates.html_report', but testing can receive 'None' value
-			if len(args) > 5 and len(args[5].strip()) > 0 and not args[5].strip() == 'None': 
-					
-				html_template = args[5] #User-selected
-				if not html_template.translate(None, "._-" ).isalnum():
-					common.stop_err("The HTML Report template name is not correct.  It should be a python class path like templates.html_report)! : " + html_template)
-				
-			else:
-				html_template = 'templates.html_report'
-			
-			try:
-				# See http://stackoverflow.com/questions/769534/dynamic-loading-of-python-modules
-				HTMLReportModule = __import__(html_template, fromlist=['does not in fact matter what goes here!'])
-				# Now create final tabular, html (or future: xml) data
-				htmlManager = HTMLReportModule.HTMLReport(tagGroup, options, query_stats)	
-				# htmlManager might not be initialized if the caller couldn't provide all the data the particular template needed.
-				htmlManager.render(out_tabular_file, out_html_file)
-				
-			except ImportError:
-				common.stop_err("Unable to locate HTML Report template! : " + html_template)
-		
-		
-		common.fileTabular(out_tabular_file, tagGroup, options)
-		
-		print('Execution time (seconds): ' + str(int(time.time()-time_start)))
+			HTMLReportModule = self.templateModule(args)
+			# Now create final tabular, html (or future: xml) data
+			htmlManager = HTMLReportModule.HTMLReport(tagGroup, options, query_stats)	
+
+			# htmlManager might not be initialized if the caller couldn't provide all the data the particular template needed.
+			# Templates with a begin()/rows()/end() streaming interface are fed in the same pass as the other outputs.
+			if options.html_pages and hasattr(htmlManager, 'rows'):
+				# Pages are compressed as the index page is, whether by the -z option or by the HTML output file's suffix.
+				page_options = copy.copy(options)
+				page_options.compression = common.outputCompression(out_html_file, options.compression)
+				html_base = out_html_file
+				if os.path.splitext(html_base)[1].lower() in common.COMPRESSION_SUFFIXES:
+					html_base = os.path.splitext(html_base)[0]
+				page_dir = options.html_page_dir or os.path.splitext(html_base)[0] + '_files'
+				workers = self.workerCount(options)
+				# Each page gets a new template instance; the index page lists the query_stats instead.
+				template_factory = lambda: HTMLReportModule.HTMLReport(tagGroup, page_options, [])
+				try:
+					sinks.append(report_pages.PagedTemplateSink(template_factory, tagGroup, query_stats, out_html_file, page_dir, options.html_pages, workers, page_options.compression))
+				except ValueError as e:
+					common.stop_err(str(e))
+
+			elif hasattr(htmlManager, 'rows'):
+				sinks.append(common.TemplateSink(htmlManager, out_html_file))
+
+		if self.column_store != None:
+			timings.extend(common.rowSinks(self.column_store.rows(), sinks))
+		else:
+			timings.extend(common.fileSinks(work_file, tagGroup, sinks))
+
+		# Older templates only have render(), which reads the sorted work file itself.
+		if htmlManager != None and not hasattr(htmlManager, 'rows'):
+			time_html = time.time()
+			if self.column_store != None:
+				self.column_store.writeTabular(work_file)
+			htmlManager.render(work_file, out_html_file)
+			timings.append(['html', time.time() - time_html])
 		
-     
+		os.remove(work_file)
+		if tagGroup.sequence_sidecar != None:
+			tagGroup.sequence_sidecar.close()
+		if self.column_store != None:
+			self.column_store.close()
+
+		if self.resultCache != None:
+			self.resultCache.store(self.result_outputs)
+
+		print('Output seconds: ' + ', '.join(['%s %0.2f' % (name, seconds) for (name, seconds) in timings]))
+
+
+# XMLRecordScan prototype shared by batch mode jobs; set before the worker pool forks, see ReportEngine.runBatch().
+_batch_tag_group = None
+
+def runBatchJob(job):
+	""" Worker pool function producing one batch mode report.  Its messages are collected rather than printed,
+	 so that they can be listed per input.
+
+	 @param job array	[options, args] of the report
+	 @return array	[messages, error description or None]
+	"""
+	(options, args) = job
+	log = StringIO.StringIO()
+	(stdout, stderr) = (sys.stdout, sys.stderr)
+	sys.stdout = sys.stderr = log
+	error = None
+	try:
+		# Filters are parsed into options, so each report gets its own copy.
+		ReportEngine().runReport(copy.copy(options), args, _batch_tag_group)
+	except SystemExit as e:
+		error = 'exit status %s' % e.code
+	except Exception:
+		error = traceback.format_exc()
+	finally:
+		(sys.stdout, sys.stderr) = (stdout, stderr)
+
+	return [log.getvalue(), error]
+
+
 if __name__ == '__main__':
 	# Command line access
     reportEngine = ReportEngine()
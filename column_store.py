@@ -0,0 +1,205 @@
+"""In-memory typed columns of report rows, sorted without a work file.
+
+By default the report engine writes processed HSP records to a tab-delimited
+work file, sorts it with the linux "sort" command, and has every output sink
+re-split its lines.  ColumnStore (-C option) instead keeps the records in
+memory as columns:
+
+	- Fields derived from raw XML values (evalue, bitscore, pident, ppos, pcov)
+	  are stored unformatted in an array('d'), and other numeric fields
+	  (length, qstart, score ...) in an array('l').
+	- Text column values are dictionary encoded: each distinct value is stored
+	  once, and rows hold an array('I') of 4 byte codes.
+	- Aligned sequences (qseq, sseq, mseq), which rarely repeat, are appended to
+	  a binary file, with typed offset and length arrays.
+
+Numeric columns sort by value, and text columns by rank of their distinct
+values in "sort -V" order, as the default work file sort does, so that the
+report's rows come out in the same order either way.  Numbers are only
+formatted (see common.NUMERIC_FORMATS) when the sorted rows are handed to
+the output sinks.
+
+Nothing is spilled to disk but the sequences (about 4 to 8 bytes per value,
+plus each distinct text value once), so the -C option suits reports whose
+rows fit in memory; the default work file has no such limit.
+"""
+import os
+import re
+import array
+import mmap
+import common
+
+# Text sort keys emulating GNU sort -V (gnulib filevercmp)
+re_version_parts = re.compile(r'(\D*)(\d*)')
+re_file_suffix = re.compile(r'^(.*?)((?:\.[A-Za-z~][A-Za-z0-9~]*)*)$', re.S)
+
+
+def versionOrder(c):
+	""" Character weight in version comparison: letters first, then other characters; '~' before everything """
+	if c.isalpha() and c < '\x80': return ord(c)
+	if c == '~': return -1
+	return ord(c) + 256
+
+
+def versionParts(s):
+	""" Flat list of character weights, each non-digit run ending in 0, alternating with digit run values.
+	 Trailing zeros are dropped so that e.g. "a" and "a0" compare equal, as they do in sort -V, and an end
+	 marker sorts the end of a value after '~' but before anything else.
+	"""
+	key = []
+	for (text, digits) in re_version_parts.findall(s):
+		key.extend([versionOrder(c) for c in text])
+		key.append(0)
+		key.append(int(digits) if digits else 0)
+	while len(key) and key[-1] == 0:
+		key.pop()
+	key.append(-0.5)
+	return key
+
+
+def versionKey(s):
+	""" @return sort key of text value s, ordered as by "sort -V": empty, ".", "..", other values starting with ".",
+	 then the rest.  Values are compared without any file name like suffix (e.g. ".txt") first, then in full.
+	"""
+	if s == '': return (0,)
+	if s == '.': return (1,)
+	if s == '..': return (2,)
+	prefix = re_file_suffix.match(s).group(1)
+	return (3 if s[0] == '.' else 4, versionParts(prefix), versionParts(s))
+
+
+def numericKey(s):
+	""" @return sort key of numeric field text s, ordered as by "sort -g": values that aren't numbers first. """
+	try:
+		return (1, float(s))
+	except ValueError:
+		return (0,)
+
+
+class ColumnStore(object):
+
+	def __init__(self, columns, file_path):
+		"""
+		 @param columns array	tagGroup.columns
+		 @param file_path string	Temporary file for aligned sequences
+		"""
+		self.columns = columns
+		self.count = 0
+		self.order = None
+		self.file_path = file_path
+		self.fp = open(file_path, 'w+b')
+		self.offset = 0
+		self.store = []
+
+		for field in columns:
+			name = field['field']
+			if name in common.SEQUENCE_FIELDS and not field['sort']:
+				self.store.append({'kind': 'sequence', 'field': name, 'offsets': array.array('L'), 'lengths': array.array('L')})
+			elif name in common.NUMERIC_FORMATS:
+				self.store.append({'kind': 'float', 'field': name, 'values': array.array('d')})
+			elif field['type'] == 'numeric':
+				self.store.append({'kind': 'integer', 'field': name, 'values': array.array('l')})
+			else:
+				self.store.append({'kind': 'dictionary', 'field': name, 'codes': array.array('I'), 'values': [], 'lookup': {}})
+
+
+	def add(self, record):
+		""" @param record object	Processed record, as XMLRecordScan.record.  Its numeric_values, if any, supply unformatted
+		 evalue, bitscore etc.; otherwise (e.g. numeric_batch values) the formatted text is read back.
+		"""
+		numeric_values = getattr(record, 'numeric_values', None)
+		for column in self.store:
+			kind = column['kind']
+			if kind == 'float':
+				if numeric_values != None:
+					column['values'].append(numeric_values[column['field']])
+				else:
+					column['values'].append(float(getattr(record, column['field'])))
+			elif kind == 'integer':
+				column['values'].append(int(getattr(record, column['field'])))
+			elif kind == 'sequence':
+				value = getattr(record, column['field'])
+				self.fp.write(value)
+				column['offsets'].append(self.offset)
+				column['lengths'].append(len(value))
+				self.offset += len(value)
+			else:
+				value = getattr(record, column['field'])
+				code = column['lookup'].get(value)
+				if code == None:
+					code = column['lookup'][value] = len(column['values'])
+					column['values'].append(value)
+				column['codes'].append(code)
+		self.count += 1
+
+
+	def sort(self):
+		""" Sort rows by the columns' sort settings, primary sort first.  A stable sort, as fileSort() is. """
+		rankings = []
+		for (column, field) in zip(self.store, self.columns):
+			if not field['sort']: continue
+			sign = 1 if field['sort'] == 'asc' else -1
+			if column['kind'] == 'float':
+				# Compared at their displayed precision, as "sort -g" compares the work file's text.
+				format = common.NUMERIC_FORMATS[column['field']]
+				rankings.append([sign * float(format(value)) for value in column['values']])
+				continue
+			if column['kind'] == 'integer':
+				rankings.append(column['values'] if sign == 1 else [-value for value in column['values']])
+				continue
+
+			keys = [versionKey(value) for value in column['values']]
+			# Rank distinct values; equal sort keys share a rank, which keeps the sort stable.
+			rank = [0] * len(keys)
+			ptr = -1
+			previous = None
+			for code in sorted(range(len(keys)), key = keys.__getitem__):
+				if ptr < 0 or keys[code] != previous:
+					ptr += 1
+					previous = keys[code]
+				rank[code] = sign * ptr
+			rankings.append([rank[code] for code in column['codes']])
+
+		if len(rankings) == 0:
+			self.order = None
+		elif len(rankings) == 1:
+			self.order = sorted(range(self.count), key = rankings[0].__getitem__)
+		else:
+			row_keys = zip(*rankings)
+			self.order = sorted(range(self.count), key = row_keys.__getitem__)
+
+
+	def rows(self):
+		""" @return iterator of row arrays in sorted order, with values as strings, for common.rowSinks() """
+		order = self.order if self.order != None else xrange(self.count)
+		self.fp.flush()
+		# Sequences are sliced out of a memory map of the sequence file, rather than with a seek() and read() each.
+		sequences = mmap.mmap(self.fp.fileno(), 0, access = mmap.ACCESS_READ) if self.offset else ''
+		getters = []
+		for column in self.store:
+			if column['kind'] == 'float':
+				getters.append(lambda ptr, values = column['values'], format = common.NUMERIC_FORMATS[column['field']]: format(values[ptr]))
+			elif column['kind'] == 'integer':
+				getters.append(lambda ptr, values = column['values']: str(values[ptr]))
+			elif column['kind'] == 'sequence':
+				getters.append(lambda ptr, offsets = column['offsets'], lengths = column['lengths']: sequences[offsets[ptr]:offsets[ptr] + lengths[ptr]])
+			else:
+				getters.append(lambda ptr, values = column['values'], codes = column['codes']: values[codes[ptr]])
+
+		for ptr in order:
+			yield [getter(ptr) for getter in getters]
+
+		if self.offset:
+			sequences.close()
+
+
+	def writeTabular(self, file_path):
+		""" Writes sorted rows in the engine's tab-delimited work file format, for templates that read one. """
+		with open(file_path, 'wb') as fp_out:
+			for row in self.rows():
+				fp_out.write('\t'.join(row) + '\n')
+
+
+	def close(self):
+		self.fp.close()
+		os.remove(self.file_path)
@@ -5,6 +5,15 @@ import optparse
 import subprocess
 from shutil import move
 import csv
+import collections
+import time
+import gzip
+import threading
+import Queue
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 re_default_query_id = re.compile("^Query_\d+$")
 	#assert re_default_query_id.match("Query_101")
@@ -21,10 +30,40 @@ re_default_ncbi_id = re.compile("^gi\|\d+\|[a-z]+\|[a-zA-Z0-9_]+(\.\d+)?\|")
 re_default_ref_id = re.compile("^ref\|[a-zA-Z0-9_]+\|[a-zA-Z0-9_]+(\.\d+)?\|")
 
 
+# Aligned sequence fields, which can be stored out-of-line in a SequenceSidecar file
+SEQUENCE_FIELDS = ['_qseq', '_sseq', '_mseq']
+
+# Text formats of the numeric fields derived from raw XML values (see XMLRecordScan.getNumericValues()), as in BLAST tabular output.
+NUMERIC_FORMATS = {
+	'evalue': lambda value: "0.0" if value == 0 else "%0.0e" % value,
+	# BLAST shows one decimal place for lower bitscores; higher ones are truncated, not rounded, to integers.
+	'bitscore': lambda value: "%0.1f" % value if value < 100 else "%i" % value,
+	'pident': lambda value: "%0.2f" % value,
+	'ppos': lambda value: "%0.2f" % value,
+	'pcov': lambda value: "%0.2f" % value
+}
+
+# Output file compression, chosen by file name suffix unless given explicitly.  See openOutput().
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Background writer: size of the data batches handed to the writer thread, and the number of batches queued before write() waits.
+WRITER_BATCH_BYTES = 262144
+WRITER_QUEUE_SIZE = 16
+
 def stop_err( msg ):
     sys.stderr.write("%s\n" % msg)
     sys.exit(1)
 
+def queryId(query_id, query_def):
+	""" @return string	A query's qseqid: its <Iteration_query-ID>, or if that is a place holder like "Query_1", the first word
+	 of its <Iteration_query-def>.  Shared by the report engine and the iteration index (-Q option), so that queries are
+	 selected by the same qseqid the report shows.
+	"""
+	if re_default_query_id.match(query_id):
+		return query_def.split(None, 1)[0] if query_def else ''
+	return query_id
+
 class MyParser(optparse.OptionParser):
 	"""
 	 From http://stackoverflow.com/questions/1857346/python-optparse-how-to-include-additional-info-in-usage-output
@@ -35,6 +74,193 @@ class MyParser(optparse.OptionParser):
 
 
 
+def outputCompression(file_path, compression = ''):
+	""" @return string	The compression openOutput() applies to file_path: 'gzip', 'zstd' or 'none' """
+	if compression == '':
+		compression = COMPRESSION_SUFFIXES.get(os.path.splitext(file_path)[1].lower(), 'none')
+	return compression
+
+
+def openOutput(file_path, compression = '', background = False, append = False):
+	""" Opens an output file for writing, compressed on the fly if asked for by compression or by a
+	 .gz / .zst file name suffix.  zstd compression uses all CPUs and needs the zstandard module.
+
+	@param file_path string	Full file path
+	@param compression string	'gzip', 'zstd', 'none', or '' to go by file name suffix
+	@param background boolean	Write (and compress) in a BackgroundWriter thread
+	@param append boolean	Add to the end of an existing uncompressed file
+	@return file-like object with write() and close()
+	"""
+	compression = outputCompression(file_path, compression)
+
+	if compression == 'gzip':
+		fp_out = gzip.open(file_path, 'wb', GZIP_LEVEL)
+
+	elif compression == 'zstd':
+		if zstandard == None:
+			stop_err('zstd output compression needs the python "zstandard" module, which is not installed.')
+		fp_out = ZstdOutput(file_path)
+
+	else:
+		fp_out = open(file_path, 'ab' if append else 'wb')
+
+	if background:
+		return BackgroundWriter(fp_out)
+	return fp_out
+
+
+
+class BackgroundWriter(object):
+	"""
+	 Writes to a file object from a separate thread, so that the caller (e.g. the XML parse loop) doesn't
+	 wait on slow (e.g. NFS) file systems.  Written data is gathered into batches which go through a
+	 bounded queue; when the writer thread falls behind, write() waits for room in the queue.
+	 A write error in the thread is raised by the next write(), flush() or close().
+	"""
+	def __init__(self, fp_out):
+		self.fp_out = fp_out
+		self.batch = []
+		self.batch_bytes = 0
+		self.error = None
+		self.queue = Queue.Queue(WRITER_QUEUE_SIZE)
+		self.thread = threading.Thread(target = self._writer)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _writer(self):
+		while True:
+			data = self.queue.get()
+			if data == None:
+				self.queue.task_done()
+				break
+			if self.error == None:
+				try:
+					self.fp_out.write(data)
+				except Exception as e: # e.g. compressor errors as well as IOError
+					self.error = e # Keep draining the queue so that write() doesn't block.
+			self.queue.task_done()
+
+	def write(self, data):
+		if self.error != None: raise self.error
+		self.batch.append(data)
+		self.batch_bytes += len(data)
+		if self.batch_bytes >= WRITER_BATCH_BYTES:
+			self.queueBatch()
+
+	def queueBatch(self):
+		if len(self.batch):
+			self.queue.put(''.join(self.batch))
+		self.batch = []
+		self.batch_bytes = 0
+
+	def flush(self):
+		""" Wait until everything written so far is in the file. """
+		self.queueBatch()
+		self.queue.join()
+		if self.error != None: raise self.error
+		self.fp_out.flush()
+
+	def close(self):
+		self.queueBatch()
+		self.queue.put(None)
+		self.thread.join()
+		self.fp_out.close()
+		if self.error != None: raise self.error
+
+
+
+class ZstdOutput(object):
+	""" Multithreaded zstd compressed output file """
+	def __init__(self, file_path):
+		self.fp = open(file_path, 'wb')
+		self.writer = zstandard.ZstdCompressor(level = ZSTD_LEVEL, threads = -1).stream_writer(self.fp)
+
+	def write(self, data):
+		self.writer.write(data)
+
+	def flush(self):
+		self.writer.flush(zstandard.FLUSH_BLOCK)
+		self.fp.flush()
+
+	def close(self):
+		self.writer.flush(zstandard.FLUSH_FRAME)
+		self.fp.close()
+
+
+
+class LRUCache(object):
+	"""
+	 Bounded least-recently-used cache with hit-rate statistics.  Used to memoize values derived
+	 from XML fields that repeat across many records, e.g. subject ids shared by many queries.
+	"""
+	def __init__(self, size = 10000):
+		self.size = size
+		self.cache = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		""" @return cached value for key (now marked most recently used) or None """
+		try:
+			value = self.cache.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+		self.cache[key] = value
+		self.hits += 1
+		return value
+
+	def set(self, key, value):
+		self.cache[key] = value
+		if len(self.cache) > self.size:
+			self.cache.popitem(last = False) # Drop least recently used
+
+	def __str__(self):
+		lookups = self.hits + self.misses
+		return "%i lookups, %i hits (%0.1f%%), %i entries" % (lookups, self.hits, 100.0 * self.hits / lookups if lookups else 0, len(self.cache))
+
+
+
+class SequenceSidecar(object):
+	"""
+	 Out-of-line storage of aligned sequences.  Sequences are appended to a sidecar file and
+	 the tabular file only carries an "offset:length" reference to each, which keeps the
+	 rows that fileSort() has to move around small.  readTabular() resolves references for
+	 the final tabular, HTML and selection outputs.
+	"""
+	def __init__(self, file_path, offset = 0):
+		""" @param offset integer	Size to truncate an existing sidecar file to and add to, e.g. when resuming from a checkpoint """
+		self.file_path = file_path
+		if offset:
+			self.fp = open(file_path, 'r+b')
+			self.fp.truncate(offset)
+			self.fp.seek(offset)
+		else:
+			self.fp = open(file_path, 'w+b')
+		self.offset = offset
+
+	def store(self, seq):
+		""" @return string reference to stored sequence """
+		self.fp.write(seq)
+		ref = '%i:%i' % (self.offset, len(seq))
+		self.offset += len(seq)
+		return ref
+
+	def flush(self):
+		self.fp.flush()
+
+	def fetch(self, ref):
+		(offset, length) = ref.split(':')
+		self.fp.seek(int(offset))
+		return self.fp.read(int(length))
+
+	def close(self):
+		""" Done with sequences; removes sidecar file. """
+		self.fp.close()
+		os.remove(self.file_path)
+
+
+
 ## *********************************** FieldFilter ****************************
 class FieldFilter(object):
 	
@@ -122,6 +348,24 @@ class FieldFilter(object):
 	def excludesPhrase(self, source, commastring):	
 		return not self.includesPhrase(source, commastring)
 		
+	def markMatch(self, record):
+		""" Record that a query-accession match has been seen, for dropping redundant hits.
+		 Called for every record reaching the filters, even if it then fails a filter constraint.
+
+		 @param record object	needs .qseqid and .accessionid
+		 @return boolean	False if redundant hits are being dropped and this match was seen before.
+		"""
+		# Block out repeated hits
+		# THIS ASSUMES BLASTn XML file is listing BEST HIT FIRST.  Only appropriate for searching for single hits within a reference sequence.
+		if self.drop_redundant_hits == True:
+			# parsing succession id from e.g. gi|57163783|ref|NP_001009242.1| rhodopsin [Felis catus]
+			#acc = str(record.sseqid.split('|')[3:4]).strip()
+			key = record.qseqid + '-' + record.accessionid #acc
+			if key in self.matches:
+				return False
+			self.matches[key] = True
+		return True
+
 	def process(self, record):
 		""" For given record (an object) cycle through filters to see if any of record's attributes fail filter conditions.
 
@@ -135,15 +379,8 @@ class FieldFilter(object):
 		
 		"""
 		
-		# Block out repeated hits
-		# THIS ASSUMES BLASTn XML file is listing BEST HIT FIRST.  Only appropriate for searching for single hits within a reference sequence.
-		if self.drop_redundant_hits == True:
-			# parsing succession id from e.g. gi|57163783|ref|NP_001009242.1| rhodopsin [Felis catus]
-			#acc = str(record.sseqid.split('|')[3:4]).strip()
-			key = record.qseqid + '-' + record.accessionid #acc
-			if key in self.matches:
-				return False
-			self.matches[key] = True
+		if not self.markMatch(record):
+			return False
 		
 		for key, constraints in self.dict.items():
 			try:	# The .loc table of fields has fieldnames without leading _ underscore. 
@@ -366,7 +603,8 @@ def fileSort (out_file, fields):
 		-n numeric
 		-k[start col],[end col] range of text that sort will be performed on
 		-s stabilize sort : "If checked, this will stabilize sort by disabling its last-resort comparison so that lines in which all fields compare equal are left in their original relative order." Note, this might not be available on all linux flavours?
-		-V sorts numbers within text - if number is leading then field essentially treated as numeric.  This means we don't have to specify -n for numeric fields in particular
+		-V sorts numbers within text - if number is leading then field essentially treated as numeric.  Used for text fields.
+		-g sorts by general numeric value, including scientific notation (evalues) and decimals.  Used for numeric fields.
 
 	 Note: some attention may need to be given to locale settings for command line sort
 	 May need to set export LC_ALL=C or export LANG=C to ensure same results on all systems 
@@ -386,8 +624,9 @@ def fileSort (out_file, fields):
 			#print "sort term:" + field + ":" + str(prelim_columns)
 			ordering = '' if field['sort'] == "asc" else 'r'
 			column = str(colPtr+1)
-			# V sorts numbers AND text (check server's version of sort
-			sortparam.append('-k' + column + 'V' + ordering + ',' + column)
+			# V sorts numbers AND text (check server's version of sort); numeric fields are compared by value.
+			method = 'g' if field['type'] == 'numeric' else 'V'
+			sortparam.append('-k' + column + method + ordering + ',' + column)
 
 	if len(sortparam) > 0:
 		args = ['sort','-s','-f','-V','-t\t'] + sortparam + ['-o' + out_file, out_file]
@@ -395,24 +634,99 @@ def fileSort (out_file, fields):
 
 
 
-def fileTabular (in_file, tagGroup, options):
-	"""Produces tabular report format.  Takes in tabular data + metainformation about that file, and iterates through rows.  Not a query-based approach.
-	It trims off the sort-only columns (prelim - final), 
-	It optionally adds column label header. (not done in fileSort() because it gets mixed into sort there.)
-	NOTE: RUN THIS AFTER fileHTML() BECAUSE IT MAY TRIM FIELDS THAT HTML REPORT NEEDS
+def readTabular (fp_in, tagGroup, fields = None):
+	""" Iterate through rows of the engine's tabular file, resolving any sequence sidecar references.
+	 Report templates should read the tabular file this way rather than with csv.reader() directly.
 
-	@param in_file string	Full file path
-	@param tagGroup	object Includes prelim_columns, final_columns
-	@param options object Includes label_flag and row_limit
+	 @param fp_in file	Opened tabular file
+	 @param tagGroup object	Includes columns, and sequence_sidecar, sidecar_fields if sequences are stored out-of-line
+	 @param fields array	Resolve only these sidecar fields (default: all)
+	 @return iterator of row arrays
+	"""
+	reader = csv.reader(fp_in, delimiter="\t")
+	sidecar = getattr(tagGroup, 'sequence_sidecar', None)
+	if sidecar == None:
+		return reader
+
+	seq_cols = [idx for (idx, field) in enumerate(tagGroup.columns) 
+		if field['field'] in tagGroup.sidecar_fields and (fields == None or field['field'] in fields)]
+
+	def resolve():
+		for row in reader:
+			for idx in seq_cols:
+				row[idx] = sidecar.fetch(row[idx])
+			yield row
 
+	return resolve()
+
+
+
+def fileSinks (in_file, tagGroup, sinks):
+	""" Single pass output pipeline: reads the sorted tabular file once and pushes each row to every sink.
+
+	@param in_file string	Full file path of sorted engine tabular file
+	@param tagGroup	object Includes columns
+	@param sinks array	e.g. [TabularSink(...), SelectionSink(...)]
+	@return array of [name, seconds] timings, reading first.
 	"""
 	fp_in = open(in_file, "rb")
-	fp_out = open(in_file + '.tmp', 'wb')
+	timings = rowSinks(readTabular(fp_in, tagGroup), sinks)
+	fp_in.close()
+	return timings
+
+
+
+def rowSinks (reader, sinks):
+	""" Pushes each row from reader to every sink, then closes the sinks.
+	Each sink has .name, .seconds, and row(row), close() methods.  Time spent reading rows
+	(including resolving sidecar sequences) and in each sink is accumulated for reporting.
+
+	@param reader iterator	Sorted row arrays, e.g. from readTabular() or column_store.ColumnStore.rows()
+	@param sinks array	e.g. [TabularSink(...), SelectionSink(...)]
+	@return array of [name, seconds] timings, reading first.
+	"""
+	read_seconds = 0.0
 
 	try:
+		clock = time.time()
+		for row in reader:
+			now = time.time()
+			read_seconds += now - clock
+			for sink in sinks:
+				sink.row(row)
+				clock = time.time()
+				sink.seconds += clock - now
+				now = clock
+			clock = now
+
+	except IOError as e:
+		print 'Operation failed: %s' % e.strerror
+
+	for sink in sinks:
+		now = time.time()
+		sink.close()
+		sink.seconds += time.time() - now
+
+	return [['read', read_seconds]] + [[sink.name, sink.seconds] for sink in sinks]
 
-		reader = csv.reader(fp_in, delimiter="\t")
-		writer = csv.writer(fp_out, delimiter="\t")
+
+
+class TabularSink(object):
+	"""Produces tabular report format, with optional column label header (not done in fileSort() because it gets mixed into sort there.)
+
+	@param out_file string	Full file path
+	@param tagGroup	object Includes columns
+	@param options object Includes column_labels, compression, background_writer, report_notice
+	"""
+	def __init__(self, out_file, tagGroup, options):
+		self.name = 'tabular'
+		self.seconds = 0.0
+		self.fp_out = openOutput(out_file, options.compression, options.background_writer)
+		self.writer = csv.writer(self.fp_out, delimiter="\t")
+
+		# e.g. a preview's label, as a comment line
+		if getattr(options, 'report_notice', ''):
+			self.fp_out.write('# ' + options.report_notice + '\n')
 
 		# WRITE TABULAR HEADER
 		if options.column_labels: # options.column_labels in ['name','field']:
@@ -422,68 +736,111 @@ def fileTabular (in_file, tagGroup, options):
 				# Tabular data header: strip leading underscores off of any labels...
 				tabHeader = [field['field'].lstrip('_') for field in tagGroup.columns]
 
-			writer.writerow(tabHeader)
-
-		for row in reader:
-
-			rowdata=[]
-			for (idx, field) in enumerate(tagGroup.columns): # Exclude hidden columns here?
-				rowdata.append(row[idx])
-			writer.writerow(rowdata)
+			self.writer.writerow(tabHeader)
 
-		move(in_file + '.tmp', in_file) # Overwrites in_file
-	
-	except IOError as e:
-		print 'Operation failed: %s' % e.strerror
+	def row(self, row):
+		self.writer.writerow(row)
 
-	fp_in.close()
-	fp_out.close()
+	def close(self):
+		self.fp_out.close()
 
 
 
-def fileSelections (in_file, selection_file, tagGroup, options):
+class SelectionSink(object):
 	""" Produces selection report format.  
 	For selection file we need: qseqid, qseq, sseqid, sseq, and #
 
-	@param in_file string	Full file path
-	@param tagGroup	object Includes prelim_columns, final_columns
-	@param options object Includes label_flag and row_limit
+	@param selection_file string	Full file path
+	@param tagGroup	object Includes columns
+	@param compression string	See openOutput()
+	"""
+	def __init__(self, selection_file, tagGroup, compression = ''):
+		self.name = 'selections'
+		self.seconds = 0.0
+		self.fp_out = openOutput(selection_file, compression)
+		self.writer = csv.writer(self.fp_out, delimiter="\t")
 
+		for (idx, field) in enumerate(tagGroup.columns): 
+			fieldname = field['field']
+			if fieldname == 'qseqid': self.qseqid_col = idx
+			elif fieldname == '_qseq': 	self.qseq_col = idx
+			elif fieldname == 'sseqid': self.sseqid_col = idx
+			elif fieldname == '_sseq': 	self.sseq_col = idx
+
+		self.selectrow_count = 0
+		self.grouping = -1
+		self.old_section = ''
+
+	def row(self, row):
+		self.selectrow_count +=1
+		if row[self.qseqid_col] != self.old_section:
+			self.old_section = row[self.qseqid_col]
+			self.grouping +=1
+			self.writer.writerow([row[self.qseqid_col], row[self.qseq_col], self.grouping, self.selectrow_count])
+			self.selectrow_count +=1
+
+		self.writer.writerow([row[self.sseqid_col], row[self.sseq_col], self.grouping, self.selectrow_count])
+
+	def close(self):
+		self.fp_out.close()
+
+
+
+class TemplateSink(object):
+	""" Feeds rows to an HTML report template's streaming interface: begin(out_html_file), rows(batch), end().
+
+	@param template object	e.g. templates.html_report.HTMLReport instance
+	@param out_html_file string	Full file path
+	@param batch_size integer	Number of rows passed to each template.rows() call
 	"""
+	def __init__(self, template, out_html_file, batch_size = 1000):
+		self.name = 'html'
+		now = time.time()
+		self.template = template
+		self.batch_size = batch_size
+		self.batch = []
+		template.begin(out_html_file)
+		self.seconds = time.time() - now
 
-	fp_in = open(in_file, "rb")
-	fp_out = open(selection_file, 'w')
-	
-	try:
+	def row(self, row):
+		self.batch.append(row)
+		if len(self.batch) >= self.batch_size:
+			self.template.rows(self.batch)
+			self.batch = []
 
-		reader = csv.reader(fp_in, delimiter="\t")
-		writer = csv.writer(fp_out, delimiter="\t")
+	def flush(self):
+		""" Pass any batched rows to the template now """
+		if len(self.batch):
+			self.template.rows(self.batch)
+			self.batch = []
 
-		for (idx, field) in enumerate(tagGroup.columns): 
-			fieldname = field['field']
-			if fieldname == 'qseqid': qseqid_col = idx
-			elif fieldname == '_qseq': 	qseq_col = idx
-			elif fieldname == 'sseqid': sseqid_col = idx
-			elif fieldname == '_sseq': 	sseq_col = idx
-
-		selectrow_count = 0
-		grouping = -1
-		old_section = ''
-		for row in reader:
+	def close(self):
+		self.flush()
+		self.template.end()
 
-			selectrow_count +=1
-			if row[qseqid_col] != old_section:
-				old_section = row[qseqid_col]
-				grouping +=1
-				writer.writerow([row[qseqid_col], row[qseq_col], grouping, selectrow_count])
-				selectrow_count +=1
 
-			writer.writerow([row[sseqid_col], row[sseq_col], grouping, selectrow_count])
 
-	
-	except IOError as e:
-		print 'Operation failed: %s' % e.strerror
+def fileTabular (in_file, tagGroup, options):
+	"""Rewrites given tabular file in tabular report format, via TabularSink.
 
-	fp_in.close()
-	fp_out.close()
+	@param in_file string	Full file path
+	@param tagGroup	object Includes columns
+	@param options object Includes column_labels
+
+	"""
+	fileSinks(in_file, tagGroup, [TabularSink(in_file + '.tmp', tagGroup, options)])
+	move(in_file + '.tmp', in_file) # Overwrites in_file
+
+
+
+def fileSelections (in_file, selection_file, tagGroup, options):
+	""" Produces selection report format from given tabular file, via SelectionSink.
+
+	@param in_file string	Full file path
+	@param selection_file string	Full output file path
+	@param tagGroup	object Includes columns
+	@param options object
+
+	"""
+	fileSinks(in_file, tagGroup, [SelectionSink(selection_file, tagGroup, options.compression)])
 
@@ -0,0 +1,55 @@
+"""Reading a BLAST XML file while BLAST is still writing it (-F option).
+
+A regular file is tailed: at the current end of file, reading waits for more
+data instead of ending, until the file holds the end of the XML document
+(</BlastOutput>).  If the file doesn't grow for FOLLOW_IDLE_SECONDS, reading
+fails, so that a job whose BLAST run died doesn't wait forever.
+
+A FIFO, or "-" for standard input, is read as it is; reads already wait for
+the writer, and end when it closes.
+"""
+import os
+import sys
+import stat
+import time
+
+FOLLOW_POLL_SECONDS = 0.5
+FOLLOW_IDLE_SECONDS = 3600
+DOCUMENT_END = '</BlastOutput>'
+
+
+def openInput(file_path):
+	""" @return file-like object with read() for ElementTree.iterparse() """
+	if file_path == '-':
+		return sys.stdin
+	if stat.S_ISFIFO(os.stat(file_path).st_mode):
+		return open(file_path, 'rb')
+	return FollowReader(file_path)
+
+
+
+class FollowReader(object):
+
+	def __init__(self, file_path):
+		self.file_path = file_path
+		self.fp = open(file_path, 'rb')
+		self.tail = '' # Last bytes read, to spot the end of the document.
+
+	def read(self, size = -1):
+		idle_since = time.time()
+		while True:
+			data = self.fp.read(size)
+			if data:
+				self.tail = (self.tail + data)[-64:]
+				return data
+
+			if self.tail.rstrip().endswith(DOCUMENT_END):
+				return ''
+			if time.time() - idle_since > FOLLOW_IDLE_SECONDS:
+				raise IOError('BLAST XML input has not grown for %i seconds: %s' % (FOLLOW_IDLE_SECONDS, self.file_path))
+
+			time.sleep(FOLLOW_POLL_SECONDS)
+			self.fp.seek(0, os.SEEK_CUR) # Clears the end of file state, so the next read sees new data.
+
+	def close(self):
+		self.fp.close()
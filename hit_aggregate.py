@@ -0,0 +1,88 @@
+"""Hit-level report rows: one row per subject hit rather than per HSP (-H option).
+
+A <Hit> of a BLAST XML query can hold many HSPs.  In hit mode the engine
+processes each <Hsp> as usual, then adds it to a HitAggregate instead of
+filtering and writing it.  When the </Hit> closes, the aggregate gives the
+record one row's worth of fields for the whole hit:
+
+	- pcov: query coverage of all the hit's HSPs, as BLAST's qcovs, i.e. the
+	  length of the union of their query intervals (_qstart to _qend), merged in
+	  sorted order, over the query length;
+	- bitscore: the sum of the HSP bitscores;
+	- evalue: the best (lowest) HSP evalue;
+	- every other field: that of the HSP with the top bitscore.
+
+The row is then filtered and written like an HSP row would be.  Only the
+current hit's intervals and top HSP are kept, whatever the size of the input.
+"""
+
+import common
+
+class HitAggregate(object):
+
+	def __init__(self):
+		self.reset()
+
+
+	def reset(self):
+		self.best = None # Field values of the hit's top bitscore HSP
+		self.best_bitscore = None
+		self.bitscore = 0.0
+		self.evalue = None # Lowest evalue
+		self.intervals = [] # [start, end] query interval of each HSP
+
+
+	def add(self, record):
+		""" Add an HSP to the current hit.
+		 @param record object	processed <Hsp> record, with raw _bitscore, _evalue, _qstart, _qend values
+		"""
+		bitscore = float(record._bitscore)
+		if self.best == None or bitscore > self.best_bitscore:
+			self.best = dict(record.__dict__)
+			self.best_bitscore = bitscore
+		self.bitscore += bitscore
+
+		evalue = float(record._evalue)
+		if self.evalue == None or evalue < self.evalue:
+			self.evalue = evalue
+
+		(start, end) = (int(record._qstart), int(record._qend))
+		self.intervals.append([min(start, end), max(start, end)])
+
+
+	def apply(self, record):
+		""" Set the record's fields to those of the hit's row, and start a new hit.
+		 @return boolean	False if the hit had no HSPs.
+		"""
+		if self.best == None:
+			return False
+
+		record.__dict__.update(self.best)
+
+		hit_values = {
+			'evalue': self.evalue,
+			'bitscore': self.bitscore,
+			'pcov': float(self.coverage()) / int(record._qlen) * 100
+		}
+		if record.numeric_values != None:
+			record.numeric_values = dict(record.numeric_values, **hit_values)
+		# Formatted as XMLRecordScan.getNumericFields() does for an HSP.
+		for (field, value) in hit_values.items():
+			setattr(record, field, common.NUMERIC_FORMATS[field](value))
+
+		self.reset()
+		return True
+
+
+	def coverage(self):
+		""" @return int	Number of query positions covered by the union of the HSP intervals """
+		covered = 0
+		(start, end) = (None, None)
+		for (interval_start, interval_end) in sorted(self.intervals):
+			if end == None or interval_start > end + 1:
+				if end != None: covered += end - start + 1
+				(start, end) = (interval_start, interval_end)
+			elif interval_end > end:
+				end = interval_end
+		if end != None: covered += end - start + 1
+		return covered
@@ -0,0 +1,209 @@
+"""Byte offset index of the queries (<Iteration> elements) of a BLAST XML file.
+
+Reporting on a few queries of a large BLAST XML file otherwise means parsing
+all of it.  The index lists each <Iteration>'s byte range along with its
+query id, definition, length, and hit and HSP counts.  It is built by a scan
+for tags, much faster than an XML parse, and stored next to the input as
+[input file]INDEX_SUFFIX.  The index records the input's size and
+modification time, and is rebuilt when they change.  If the input's folder
+isn't writable the index is only kept in memory.
+
+With the -Q option the report engine parses a QueryReader instead of the
+input file: the XML document with only the selected <Iteration> elements,
+read directly from their byte ranges.
+
+Usage, to build or refresh an index and list the queries:
+	python iteration_index.py [blastxml_input_file]
+"""
+import os
+import re
+import sys
+import xml.sax.saxutils
+import common
+
+INDEX_VERSION = '1'
+INDEX_SUFFIX = '.iterations'
+SCAN_BLOCK_SIZE = 8 * 1048576
+
+re_scan_tag = re.compile(r'<(/?)(Iteration|Iteration_query-ID|Iteration_query-def|Iteration_query-len|Hit|Hsp)>')
+# Query fields whose text is kept
+QUERY_FIELDS = {'Iteration_query-ID': 'query_id', 'Iteration_query-def': 'query_def', 'Iteration_query-len': 'query_len'}
+XML_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+def queryName(iteration):
+	""" @return string	The query's qseqid, as XMLRecordScan.setIdFields() derives it """
+	return common.queryId(iteration['query_id'], iteration['query_def'])
+
+
+
+class IterationIndex(object):
+
+	def __init__(self, in_file):
+		"""
+		 @param in_file string	BLAST XML file path
+		"""
+		self.in_file = in_file
+		self.index_file = in_file + INDEX_SUFFIX
+		self.iterations = [] # {'start', 'end', 'query_id', 'query_def', 'query_len', 'hits', 'hsps'} per <Iteration>
+		self.prolog_end = 0 # Byte offset of the first <Iteration>
+		self.epilog_start = 0 # Byte offset after the last </Iteration>
+
+
+	def load(self):
+		""" Read the stored index, or build and store it if it's missing or out of date.
+		 @return boolean	True if the stored index was used.
+		"""
+		stat = os.stat(self.in_file)
+		signature = '\t'.join(['#iterations', INDEX_VERSION, str(stat.st_size), repr(stat.st_mtime)])
+
+		try:
+			with open(self.index_file, 'rb') as fp_in:
+				if fp_in.readline().rstrip('\n') == signature:
+					self.readIndex(fp_in)
+					return True
+		except (IOError, ValueError, IndexError):
+			pass
+
+		self.build()
+		try:
+			temp_file = '%s.%i.tmp' % (self.index_file, os.getpid())
+			with open(temp_file, 'wb') as fp_out:
+				fp_out.write(signature + '\n')
+				self.writeIndex(fp_out)
+			os.rename(temp_file, self.index_file)
+		except (IOError, OSError) as e:
+			print 'Iteration index not stored (%s): %s' % (e.strerror, self.index_file)
+		return False
+
+
+	def build(self):
+		""" Scan the input for <Iteration> byte ranges and query fields. """
+		self.iterations = []
+		self.prolog_end = self.epilog_start = 0
+		iteration = None
+		field_start = None # [field, absolute offset of its text]
+
+		with open(self.in_file, 'rb') as fp_in:
+			buffer = ''
+			offset = 0 # Absolute offset of buffer[0]
+			scanned = 0 # Buffer position up to which tags were scanned
+			while True:
+				block = fp_in.read(SCAN_BLOCK_SIZE)
+				buffer += block
+				# A tag can be cut at the last '<' of the buffer, so scan up to it and keep the rest for the next block.
+				limit = buffer.rfind('<') if block else len(buffer)
+				if limit < scanned: limit = scanned
+
+				for match in re_scan_tag.finditer(buffer, scanned, limit):
+					(closing, tag) = match.groups()
+					if tag == 'Hsp':
+						if not closing and iteration != None: iteration['hsps'] += 1
+					elif tag == 'Hit':
+						if not closing and iteration != None: iteration['hits'] += 1
+					elif tag == 'Iteration':
+						if not closing:
+							iteration = {'start': offset + match.start(), 'end': None, 'query_id': '', 'query_def': '', 'query_len': '', 'hits': 0, 'hsps': 0}
+						elif iteration != None:
+							iteration['end'] = offset + match.end()
+							self.iterations.append(iteration)
+							iteration = None
+					elif iteration != None:
+						if not closing:
+							field_start = [QUERY_FIELDS[tag], offset + match.end()]
+						elif field_start != None:
+							text = buffer[field_start[1] - offset: match.start()]
+							iteration[field_start[0]] = ' '.join(xml.sax.saxutils.unescape(text, XML_ENTITIES).split())
+							field_start = None
+
+				# Keep the unscanned rest of the buffer, and the text of a query field that isn't closed yet.
+				keep = limit if field_start == None else min(limit, field_start[1] - offset)
+				buffer = buffer[keep:]
+				offset += keep
+				scanned = limit - keep
+				if not block: break
+
+		if len(self.iterations):
+			self.prolog_end = self.iterations[0]['start']
+			self.epilog_start = self.iterations[-1]['end']
+
+
+	def readIndex(self, fp_in):
+		(self.prolog_end, self.epilog_start) = [int(value) for value in fp_in.readline().split('\t')]
+		self.iterations = []
+		for line in fp_in:
+			values = line.rstrip('\n').split('\t')
+			self.iterations.append({'start': int(values[0]), 'end': int(values[1]), 'query_id': values[2], 'query_def': values[3],
+				'query_len': values[4], 'hits': int(values[5]), 'hsps': int(values[6])})
+
+
+	def writeIndex(self, fp_out):
+		fp_out.write('%i\t%i\n' % (self.prolog_end, self.epilog_start))
+		for iteration in self.iterations:
+			fp_out.write('%(start)i\t%(end)i\t%(query_id)s\t%(query_def)s\t%(query_len)s\t%(hits)i\t%(hsps)i\n' % iteration)
+
+
+	def select(self, names):
+		""" Find the queries named by qseqid, query id or query definition.
+		 @param names array	query names
+		 @return (array of selected iterations in file order, array of names not found)
+		"""
+		wanted = set(names)
+		found = set()
+		selected = []
+		for iteration in self.iterations:
+			matches = wanted.intersection([queryName(iteration), iteration['query_id'], iteration['query_def']])
+			if matches:
+				selected.append(iteration)
+				found.update(matches)
+		return (selected, [name for name in names if not name in found])
+
+
+	def reader(self, iterations):
+		""" @return QueryReader of the XML document with just the given iterations """
+		ranges = [[0, self.prolog_end]] + [[iteration['start'], iteration['end']] for iteration in iterations]
+		ranges.append([self.epilog_start, os.path.getsize(self.in_file)])
+		return QueryReader(self.in_file, ranges)
+
+
+
+class QueryReader(object):
+	""" File-like object reading the given byte ranges of a file, one after the other, for ElementTree.iterparse() """
+
+	def __init__(self, file_path, ranges):
+		self.fp = open(file_path, 'rb')
+		self.ranges = ranges
+		self.remaining = 0
+
+	def read(self, size = -1):
+		while self.remaining == 0:
+			if not len(self.ranges):
+				return ''
+			(start, end) = self.ranges.pop(0)
+			self.fp.seek(start)
+			self.remaining = end - start
+
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.fp.read(size)
+		if not data:
+			raise IOError('BLAST XML input is shorter than its iteration index: ' + self.fp.name)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.fp.close()
+
+
+
+if __name__ == '__main__':
+
+	if len(sys.argv) != 2:
+		print __doc__
+		sys.exit(1)
+
+	index = IterationIndex(sys.argv[1])
+	index.load()
+	print 'Query Id\tLength\tHits\tHSPs'
+	for iteration in index.iterations:
+		print '%s\t%s\t%i\t%i' % (queryName(iteration), iteration['query_len'], iteration['hits'], iteration['hsps'])
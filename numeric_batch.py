@@ -0,0 +1,110 @@
+"""Batched numpy calculation of the numeric fields derived from BLAST XML <Hsp> values.
+
+Instead of converting and formatting evalue, bitscore, pident, ppos and pcov
+one HSP at a time, the raw XML values of up to N HSPs of a query are gathered
+into numpy arrays and the derived ratios are calculated together.  Numeric
+filters on these fields are applied to the whole batch as a mask, and only
+the surviving HSPs get their values formatted to text.
+
+A mask only drops HSPs that certainly fail a filter: filters compare the
+formatted (rounded) values, so each mask compares against the range of
+values the rounding could produce.  Surviving HSPs still go through
+common.FieldFilter.process(), so output is identical to unbatched processing.
+"""
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# For each field, a function giving (low, high) bounds on its formatted value, from its unformatted values.
+BOUNDS = {
+	'pident': lambda values: (values - 0.01, values + 0.01), # "%0.2f"
+	'ppos': lambda values: (values - 0.01, values + 0.01),
+	'pcov': lambda values: (values - 0.01, values + 0.01),
+	'bitscore': lambda values: (values - 1, values + 0.1), # "%0.1f", or truncated to integer at >= 100
+	'evalue': lambda values: (values * 0.5, values * 2) # "%0.0e" keeps 1 significant digit
+}
+
+# Filter comparators as masks of rows that may pass, given (low, high) bounds and the filter value.
+MASKS = {
+	'gt': lambda low, high, value: high > value,
+	'gte': lambda low, high, value: high >= value,
+	'lt': lambda low, high, value: low < value,
+	'lte': lambda low, high, value: low <= value,
+	'==': lambda low, high, value: (low <= value) & (high >= value)
+}
+
+
+class NumericBatch(object):
+
+	def __init__(self, fieldFilter, size):
+		"""
+		 @param fieldFilter object	common.FieldFilter whose numeric constraints become batch masks
+		 @param size integer	Maximum number of HSPs per batch
+		"""
+		self.size = size
+		self.records = []
+		self.constraints = []
+		for (field, constraints) in fieldFilter.dict.items():
+			if field in BOUNDS:
+				for (comparator, value) in constraints:
+					if comparator in MASKS:
+						self.constraints.append([field, comparator, float(value)])
+
+	def add(self, raw_values):
+		""" @param raw_values dictionary	an HSP's raw XML values, from XMLRecordScan.getRawValues() """
+		self.records.append(raw_values)
+
+	def full(self):
+		return len(self.records) >= self.size
+
+	def compute(self):
+		""" Calculate numeric fields of batched HSPs and empty the batch.
+
+		 @return list of [raw_values, numeric fields dictionary] in input order.
+		 	The dictionary is None for HSPs that certainly fail a numeric filter.
+		"""
+		records = self.records
+		self.records = []
+		if len(records) == 0: return []
+
+		def column(name):
+			return numpy.array([raw_values[name] for raw_values in records], dtype=float)
+
+		length = column('_length')
+		evalue = column('_evalue')
+		bitscore = column('_bitscore')
+		values = {
+			'evalue': evalue,
+			'bitscore': bitscore,
+			# Same operation order as XMLRecordScan.getNumericFields() for identical rounding.
+			'pident': 100 * column('_nident') / length,
+			'ppos': 100 * column('_positive') / length,
+			'pcov': (column('_qend') - column('_qstart') + 1) / column('_qlen') * 100
+		}
+
+		mask = numpy.ones(len(records), dtype=bool)
+		for (field, comparator, value) in self.constraints:
+			(low, high) = BOUNDS[field](values[field])
+			mask &= MASKS[comparator](low, high, value)
+
+		results = [[raw_values, None] for raw_values in records]
+		surviving = numpy.flatnonzero(mask)
+		if len(surviving) == 0: return results
+
+		# Format surviving rows only, from python floats.
+		evalue = evalue[surviving].tolist()
+		bitscore = bitscore[surviving].tolist()
+		pident = values['pident'][surviving].tolist()
+		ppos = values['ppos'][surviving].tolist()
+		pcov = values['pcov'][surviving].tolist()
+		for (i, ptr) in enumerate(surviving.tolist()):
+			results[ptr][1] = {
+				'evalue': "0.0" if records[ptr]['_evalue'] == "0" else "%0.0e" % evalue[i],
+				'bitscore': "%0.1f" % bitscore[i] if bitscore[i] < 100 else "%i" % bitscore[i],
+				'pident': "%0.2f" % pident[i],
+				'ppos': "%0.2f" % ppos[i],
+				'pcov': "%0.2f" % pcov[i]
+			}
+
+		return results
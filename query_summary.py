@@ -0,0 +1,143 @@
+"""Per-query summary statistics, gathered as report rows are written (-s option).
+
+Each row that passes the filters updates its query's running aggregates:
+best hit by bitscore, minimum, mean and maximum pident, a histogram of pcov
+in 1% steps for its quartiles, and a count of rows per reference bin.  These
+take the same small amount of memory however many HSPs a query has.  When
+a query's rows are done its aggregates are reduced to a 'summary' array
+of values in its query_stats entry, which the summary table and the HTML
+report headers (see summaryHTML()) are written from, so no extra pass over
+the rows is needed.
+
+Rows of one query always arrive together, so a query is done when a row of
+another query arrives, or at close().
+"""
+import cgi
+import common
+
+PCOV_STEPS = 100
+# pcov quartiles reported
+PCOV_QUANTILES = [0.25, 0.5, 0.75]
+
+# Maximum number of queries in an HTML report's summary table
+HTML_ROWS = 1000
+
+SUMMARY_LABELS = ['Best Hit', 'Top Bit Score', 'Best Hit E-value', 'Min. % Identical', 'Mean % Identical', 'Max. % Identical',
+	'Coverage Q1', 'Median Coverage', 'Coverage Q3']
+
+
+class QuerySummary(object):
+
+	def __init__(self, tagGroup, rows_label = 'HSPs'):
+		"""
+		 @param tagGroup object	XMLRecordScan, whose bin columns are counted
+		 @param rows_label string	Label of the query_stats 'rows' count: 'Hits' in hit mode (-H)
+		"""
+		self.rows_label = rows_label
+		self.bin_columns = [[col['field'], col['label']] for col in tagGroup.columns if col['type'] == 'bin']
+		self.query_stat = None # query_stats entry being summarized
+
+
+	def labels(self):
+		""" @return array	Summary column labels, ending with reference bin names """
+		return SUMMARY_LABELS + [label for (field, label) in self.bin_columns]
+
+
+	def add(self, record, query_stat):
+		""" Add a report row to its query's aggregates.
+		 @param record object	with sseqid, evalue, bitscore, pident, pcov and bin fields
+		 @param query_stat dictionary	query_stats entry of the row's query
+		"""
+		if not query_stat is self.query_stat:
+			self.close()
+			self.query_stat = query_stat
+			self.best = None # [bitscore, sseqid, evalue]
+			self.pident_min = self.pident_max = None
+			self.pident_total = 0.0
+			self.count = 0
+			self.pcov_counts = [0] * (PCOV_STEPS + 1)
+			self.bin_counts = [0] * len(self.bin_columns)
+
+		bitscore = float(record.bitscore)
+		if self.best == None or bitscore > self.best[0]:
+			self.best = [bitscore, record.sseqid, record.evalue]
+
+		pident = float(record.pident)
+		if self.pident_min == None or pident < self.pident_min: self.pident_min = pident
+		if self.pident_max == None or pident > self.pident_max: self.pident_max = pident
+		self.pident_total += pident
+		self.count += 1
+
+		step = int(round(float(record.pcov) * PCOV_STEPS / 100))
+		self.pcov_counts[min(max(step, 0), PCOV_STEPS)] += 1
+
+		for (idx, (field, label)) in enumerate(self.bin_columns):
+			if getattr(record, field) != '': self.bin_counts[idx] += 1
+
+
+	def close(self):
+		""" Reduce the aggregates of the query being summarized to its query_stats entry's 'summary':
+		 values in labels() order.
+		"""
+		if self.query_stat == None: return
+
+		(bitscore, sseqid, evalue) = self.best
+		summary = [sseqid, "%0.1f" % bitscore if bitscore < 100 else "%i" % bitscore, evalue,
+			'%0.2f' % self.pident_min, '%0.2f' % (self.pident_total / self.count), '%0.2f' % self.pident_max]
+
+		for fraction in PCOV_QUANTILES:
+			# Lowest histogram step with the given fraction of rows at or below it
+			target = fraction * self.count
+			seen = 0
+			for (step, step_count) in enumerate(self.pcov_counts):
+				seen += step_count
+				if seen >= target: break
+			summary.append('%i' % (step * 100 / PCOV_STEPS))
+
+		summary.extend(str(count) for count in self.bin_counts)
+		self.query_stat['summary'] = summary
+		self.query_stat = None
+
+
+	def values(self, query):
+		""" @return array	A query_stats entry's summary values, blank for a query without report rows """
+		return query.get('summary') or [''] * (len(SUMMARY_LABELS) + len(self.bin_columns))
+
+
+	def write(self, out_file, query_stats, compression = ''):
+		""" Write the summary table: one row per query, with its row counts and summary. """
+		fp_out = common.openOutput(out_file, compression)
+		fp_out.write('\t'.join(['Query', self.rows_label, 'Reported Rows'] + self.labels()) + '\n')
+		for query in query_stats:
+			values = [query['id'], str(query['rows']), str(query['filtered_rows'])] + self.values(query)
+			fp_out.write('\t'.join(values) + '\n')
+		fp_out.close()
+
+
+
+def summaryHTML(tagGroup, query_stats):
+	""" @return string	HTML table of per-query summary statistics for a report header, for up to HTML_ROWS queries,
+	 or '' if the engine didn't gather them (-s option).
+	"""
+	if not any('summary' in query for query in query_stats): return ''
+
+	summary = QuerySummary(tagGroup)
+	rows = []
+	for query in query_stats[0:HTML_ROWS]:
+		values = [query['id'], str(query['filtered_rows'])] + summary.values(query)
+		rows.append('<tr><td>' + '</td><td>'.join(cgi.escape(value) for value in values) + '</td></tr>')
+
+	more = ''
+	if len(query_stats) > HTML_ROWS:
+		more = '<p>The first %i of %i queries; the summary table output lists them all.</p>' % (HTML_ROWS, len(query_stats))
+
+	return """
+			<div class="headerMessage">Query summary
+				<table class="querySummary" style="font-size: .9rem; font-weight:normal; display:block; max-height: 20em; overflow-y: auto">
+					<thead class="top"><tr><th>%s</th></tr></thead>
+					<tbody>
+					%s
+					</tbody>
+				</table>
+				%s
+			</div>""" % ('</th><th>'.join(cgi.escape(label) for label in ['Query', 'Rows'] + summary.labels()), '\n\t\t\t\t\t'.join(rows), more)
@@ -0,0 +1,167 @@
+"""Parse-once cache of processed BLAST XML records.
+
+Re-running a report on the same BLAST XML file with different filters,
+columns, bins, row limit or template doesn't change any field derived from
+the XML.  With a cache folder (-K option), the first run stores every HSP's
+derived field values (all of XMLRecordScan.columns_in, and the raw evalue,
+bitscore and query length for the database output), and later runs on the
+same input replay them straight into filtering, sorting and output, skipping
+the XML parse.  Reference bin columns are looked up again on replay, since
+they depend on the selected bins.
+
+A cache entry is keyed by a hash of the XML file's content, of the field
+specification file (blast_reporting_fields.tab), and CACHE_VERSION, which
+must be increased whenever field derivation code changes.  Entries are
+columnar: for each field a list of its distinct values and an array of value
+codes, one per HSP; the whole is marshal serialized and zlib compressed.
+
+Entries unused for CACHE_MAX_DAYS are removed, as are least recently used
+entries beyond a CACHE_MAX_BYTES total.
+"""
+import os
+import time
+import shutil
+import array
+import marshal
+import hashlib
+import zlib
+
+CACHE_VERSION = '2'
+CACHE_SUFFIX = '.records'
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+CACHE_MAX_DAYS = 30
+
+
+def fileHash(file_path, digest = None):
+	""" @return hashlib digest object updated with file content """
+	if digest == None: digest = hashlib.sha1()
+	with open(file_path, 'rb') as fp_in:
+		while True:
+			block = fp_in.read(1048576)
+			if not block: break
+			digest.update(block)
+	return digest
+
+
+def entrySize(path):
+	""" @return byte size of a cache entry file, or of all files in a cache entry folder """
+	if not os.path.isdir(path):
+		return os.path.getsize(path)
+	return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def evictEntries(cache_dir, suffix, keep_path, max_bytes, max_days):
+	""" Remove cache entries (files or folders named with suffix) unused for max_days, then least recently used
+	 entries until the rest fit max_bytes.  An entry's modification time is its last use.
+
+	 @param keep_path string	Entry that is never removed, i.e. the one just written.
+	"""
+	entries = []
+	for name in os.listdir(cache_dir):
+		if name.endswith(suffix):
+			path = os.path.join(cache_dir, name)
+			entries.append([os.path.getmtime(path), entrySize(path), path])
+
+	expiry = time.time() - max_days * 86400
+	total = sum(size for (mtime, size, path) in entries)
+	for (mtime, size, path) in sorted(entries):
+		if mtime < expiry or total > max_bytes:
+			if path != keep_path:
+				if os.path.isdir(path):
+					shutil.rmtree(path)
+				else:
+					os.remove(path)
+				total -= size
+
+
+
+class RecordCache(object):
+
+	def __init__(self, cache_dir, input_hash, field_spec_file):
+		"""
+		 @param cache_dir string	Cache folder; created if necessary.
+		 @param input_hash string	fileHash() hex digest of the BLAST XML input
+		 @param field_spec_file string	blast_reporting_fields.tab path
+		"""
+		self.cache_dir = cache_dir
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+		digest = hashlib.sha1(CACHE_VERSION)
+		fileHash(field_spec_file, digest)
+		digest.update(input_hash)
+		self.file_path = os.path.join(cache_dir, digest.hexdigest() + CACHE_SUFFIX)
+
+		self.fields = None
+		self.columns = None
+
+
+	def load(self):
+		""" @return [query_stats, records iterator] of the cached input, or None if not cached.
+		 query_stats are [query id, HSP count] in input order; records are {field: value} dictionaries of HSPs in input order.
+		"""
+		try:
+			with open(self.file_path, 'rb') as fp_in:
+				entry = marshal.loads(zlib.decompress(fp_in.read()))
+		except (IOError, EOFError, ValueError, TypeError, zlib.error):
+			return None
+
+		if entry.get('version') != CACHE_VERSION: return None
+		os.utime(self.file_path, None) # Marks entry as recently used
+
+		fields = entry['fields']
+		columns = []
+		for (values, code_string) in entry['columns']:
+			codes = array.array('I')
+			codes.fromstring(code_string)
+			columns.append([values, codes])
+
+		def records():
+			for ptr in xrange(entry['count']):
+				yield dict((field, values[codes[ptr]]) for (field, (values, codes)) in zip(fields, columns))
+
+		return [entry['query_stats'], records()]
+
+
+	def startRecording(self, fields):
+		""" @param fields array	record attributes to store for each HSP """
+		self.fields = fields
+		self.columns = [[[], {}, array.array('I')] for field in fields]
+		self.count = 0
+
+
+	def add(self, record):
+		""" Add a processed record (XMLRecordScan.record) """
+		for (field, (values, lookup, codes)) in zip(self.fields, self.columns):
+			value = getattr(record, field)
+			code = lookup.get(value)
+			if code == None:
+				code = lookup[value] = len(values)
+				values.append(value)
+			codes.append(code)
+		self.count += 1
+
+
+	def save(self, query_stats):
+		""" Write recorded entry, then evict old entries.
+		 @param query_stats array	{'id', 'rows'} per query, as collected by the parse loop.
+		"""
+		entry = {
+			'version': CACHE_VERSION,
+			'fields': self.fields,
+			'count': self.count,
+			'query_stats': [[query['id'], query['rows']] for query in query_stats],
+			'columns': [[values, codes.tostring()] for (values, lookup, codes) in self.columns]
+		}
+		self.columns = None
+
+		with open(self.file_path + '.tmp', 'wb') as fp_out:
+			fp_out.write(zlib.compress(marshal.dumps(entry), 1))
+		os.rename(self.file_path + '.tmp', self.file_path)
+
+		self.evict()
+
+
+	def evict(self):
+		""" Remove entries unused for CACHE_MAX_DAYS, then least recently used entries until the cache fits CACHE_MAX_BYTES. """
+		evictEntries(self.cache_dir, CACHE_SUFFIX, self.file_path, CACHE_MAX_BYTES, CACHE_MAX_DAYS)
@@ -1,8 +1,37 @@
 import os.path
+import sys
+import time
+import marshal
 import common
 
+# Compiled bin index files, written alongside a bin's accession_ids.tab by the compiler below.
+BIN_SOURCE_FILE = 'accession_ids.tab'
+BIN_INDEX_FILE = 'accession_ids.idx'
+BIN_META_FILE = 'accession_ids.idx.meta'
+BIN_INDEX_VERSION = '2'
+
+
+def normalizeAccession(seqid):
+	""" Reduce a sequence id to the general accession id used as a bin lookup key.
+	 Same rules as ReferenceBins.setStatus(): gi|..|ref|ACC.1| and ref|..|ACC.1| forms yield ACC,
+	 anything else has only its fractional version component removed.
+
+	 @param seqid string e.g. 'gi|444439670|ref|NR_074985.1|' or 'NR_074985.1'
+	 @return string e.g. 'NR_074985'
+	"""
+	if common.re_default_ncbi_id.match(seqid):
+		seqid = seqid.split('|')[3]
+	elif common.re_default_ref_id.match(seqid):
+		seqid = seqid.split('|')[1]
+	return seqid.split('.')[0]
+
+
 class ReferenceBins:
 
+	# Optional {bin name: [binVersion(), lookup]} dictionary shared by all instances, so that a long-lived process
+	# (see report_server.py) loads each bin once, and again only when it changes.  None = no sharing.
+	lookup_cache = None
+
 	def __init__(self, db_spec_path = None):
 		"""
 	 	@param db_spec_path string path to fasta databases specification file.  This file has format:
@@ -16,7 +45,58 @@ class ReferenceBins:
 			db_spec_path = os.path.join(os.path.dirname(__file__), 'fasta_reference_dbs.tab') 	
 		self.fieldSpec = common.FieldSpec(db_spec_path)
 
-	def __main__(self): pass
+	def __main__(self):
+
+		parser = common.MyParser(
+			description = 'Compiles reference bin accession lists into fast lookup indexes.',
+			usage = 'python reference_bins.py [options] [bin_name] [source_file]',
+			epilog="""Details:
+
+			Compiles a reference bin listed in fasta_reference_dbs.tab from a FASTA file, a plain 
+			accession list (one id per line) or an existing accession_ids.tab (id [tab] description).  
+			Accession ids are normalized as they are when matching search hits (gi|..|ref|ACC.1| -> ACC), 
+			de-duplicated (last description wins, as when an uncompiled bin is read) and sorted.  The bin folder then gets:
+			   accession_ids.tab       : normalized source list (not rewritten if it was the source)
+			   accession_ids.idx       : fast index loaded by blast_reporting.py
+			   accession_ids.idx.meta  : index metadata used to detect stale indexes
+
+			With no source_file the bin's own accession_ids.tab is compiled.
+			Use -C to check that every bin in fasta_reference_dbs.tab is compiled and current.
+
+		""")
+
+		parser.add_option('-t', '--type', type='choice', dest='source_type', choices=['fasta','list','tab'],
+			help='Source file type: fasta, list or tab.  Default: detected from the first line of the file.')
+
+		parser.add_option('-a', '--all', dest='compile_all', default=False, action='store_true',
+			help='Compile every bin listed in the reference database specification file from its accession_ids.tab.')
+
+		parser.add_option('-C', '--check', dest='check', default=False, action='store_true',
+			help='Report whether each listed bin is compiled and current.  Exits with status 1 if any is not.')
+
+		options, args = parser.parse_args()
+
+		if options.check:
+			stale = 0
+			for bin_name in sorted(self.fieldSpec.dict.keys()):
+				status = self.indexStatus(bin_name)
+				if status != 'current': stale += 1
+				print(bin_name + '\t' + status)
+			sys.exit(1 if stale else 0)
+
+		if options.compile_all:
+			for bin_name in sorted(self.fieldSpec.dict.keys()):
+				self.compileBin(bin_name)
+			return
+
+		if len(args) < 1:
+			common.stop_err("Expecting a bin name (see fasta_reference_dbs.tab), or the -a or -C option.")
+
+		bin_name = args[0]
+		if not bin_name in self.fieldSpec.dict:
+			common.stop_err("No such reference bin in reference database specification: " + bin_name)
+
+		self.compileBin(bin_name, args[1] if len(args) > 1 else None, options.source_type)
 	
 	# Could double check to see if it exists?
 	def build_bins(self, bins, columns):
@@ -75,55 +155,188 @@ class ReferenceBins:
 	
 		"""
 		bin = ReferenceBin(self.fieldSpec, bin_folder_name, bin_filter)
-		
+
+		if ReferenceBins.lookup_cache != None:
+			version = self.binVersion(bin_folder_name)
+			cached = ReferenceBins.lookup_cache.get(bin_folder_name)
+			if cached == None or cached[0] != version:
+				bin.lookup = self.loadLookup(bin)
+				ReferenceBins.lookup_cache[bin_folder_name] = [version, bin.lookup]
+			else:
+				bin.lookup = cached[1]
+		else:
+			bin.lookup = self.loadLookup(bin)
+
+		return bin
+
+
+	def loadLookup(self, bin):
+		""" @return dictionary	accession id: description lookup of a bin, from its index if current, else its accession_ids.tab """
+		if self.indexStatus(bin.folder) == 'current':
+			with open(bin.index_path, 'rb') as file_in:
+				return marshal.load(file_in)
+
+		# Read and normalized as compileBin() reads accession_ids.tab, so that matches don't depend on whether the bin is compiled.
+		lookup = {}
 		try:
 			with open(bin.file_path) as file_in:
-				for line in file_in: # Should always contains succession id
-					#FUTURE: Preprocess so accession ID ready to go.
-					keyValue = line.rstrip().split("\t",1)
- 					# keep only first term minus integer portion of id
-					accGeneralId = keyValue[0].split('.')[0]
-					if len(keyValue) >1: description = keyValue[1]
-					else: description = ''
-					bin.lookup[accGeneralId] = description
-				
-				file_in.close()
-			
+				for (accession, description) in readAccessions(file_in, 'tab'):
+					accGeneralId = normalizeAccession(accession)
+					if accGeneralId != '':
+						lookup[accGeneralId] = description
+
 		except IOError:
-		   stop_err("Reference bin could not be found or opened: " + self.path + bin_folder_name + '/accession_ids.tab')
+		   common.stop_err("Reference bin could not be found or opened: " + bin.file_path)
 		
-		return bin
+		return lookup
+
+
+	def compileBin(self, bin_folder_name, source_path = None, source_type = None):
+		""" Compile a bin's accession ids into its fast index + metadata files, reporting build time, key count and index size.
+
+		 @param bin_folder_name string name of bin in fasta_reference_dbs.tab, e.g. 16S_ncbi
+		 @param source_path string FASTA, accession list or .tab file.  Defaults to the bin's accession_ids.tab 
+		 @param source_type string 'fasta', 'list' or 'tab'; detected from first line if not given.
+		"""
+		time_start = time.time()
+		bin = ReferenceBin(self.fieldSpec, bin_folder_name, '')
+		if source_path == None: source_path = bin.file_path
+
+		lookup = {}
+		try:
+			with open(source_path) as file_in:
+				for (accession, description) in readAccessions(file_in, source_type):
+					accGeneralId = normalizeAccession(accession)
+					# Last description of a duplicate accession wins, as in loadLookup()'s reading of an uncompiled bin.
+					if accGeneralId != '':
+						lookup[accGeneralId] = description
+
+		except IOError:
+			common.stop_err("Reference bin source could not be found or opened: " + source_path)
+
+		if not os.path.isdir(os.path.dirname(bin.file_path)):
+			os.makedirs(os.path.dirname(bin.file_path))
+
+		# Keep accession_ids.tab as the human-readable master list unless it was the source itself.
+		if os.path.abspath(source_path) != os.path.abspath(bin.file_path):
+			with open(bin.file_path, 'w') as file_out:
+				for key in sorted(lookup):
+					file_out.write(key + '\t' + lookup[key] + '\n')
+
+		with open(bin.index_path + '.tmp', 'wb') as file_out:
+			marshal.dump(lookup, file_out)
+		os.rename(bin.index_path + '.tmp', bin.index_path)
+
+		source_stat = os.stat(bin.file_path)
+		meta = [
+			['version', BIN_INDEX_VERSION],
+			['source', os.path.abspath(source_path)],
+			['tab_size', str(source_stat.st_size)],
+			['tab_mtime', repr(source_stat.st_mtime)],
+			['keys', str(len(lookup))],
+			['index_size', str(os.path.getsize(bin.index_path))],
+			['build_seconds', '%0.3f' % (time.time() - time_start)],
+			['built', time.strftime('%Y/%m/%d %H:%M:%S')]
+		]
+		with open(bin.meta_path, 'w') as file_out:
+			for (key, value) in meta:
+				file_out.write(key + '\t' + value + '\n')
+
+		print('%s: %s keys, index %s bytes, built in %s seconds' % (bin_folder_name, meta[4][1], meta[5][1], meta[6][1]))
+
+
+	def indexStatus(self, bin_folder_name):
+		""" Check a bin's compiled index against its accession_ids.tab.
+		 @return string 'current', 'missing' (not compiled), 'stale' (accession_ids.tab changed since) or 'no source' 
+		"""
+		bin = ReferenceBin(self.fieldSpec, bin_folder_name, '')
+		if not os.path.isfile(bin.index_path) or not os.path.isfile(bin.meta_path):
+			return 'missing'
+		if not os.path.isfile(bin.file_path):
+			return 'no source'
+
+		meta = {}
+		with open(bin.meta_path) as file_in:
+			for line in file_in:
+				keyValue = line.rstrip('\n').split('\t',1)
+				if len(keyValue) > 1: meta[keyValue[0]] = keyValue[1]
+
+		source_stat = os.stat(bin.file_path)
+		if meta.get('version') != BIN_INDEX_VERSION \
+			or meta.get('tab_size') != str(source_stat.st_size) \
+			or meta.get('tab_mtime') != repr(source_stat.st_mtime):
+			return 'stale'
+		return 'current'
+
+
+	def binVersion(self, bin_folder_name):
+		""" @return string identifying the content of a bin's lookup data: its index metadata if the index is current,
+		 otherwise its accession_ids.tab size and modification time.
+		"""
+		if not bin_folder_name in self.fieldSpec.dict:
+			return 'unknown'
+		bin = ReferenceBin(self.fieldSpec, bin_folder_name, '')
+		if self.indexStatus(bin_folder_name) == 'current':
+			with open(bin.meta_path) as file_in:
+				return file_in.read()
+		if not os.path.isfile(bin.file_path):
+			return 'missing'
+		source_stat = os.stat(bin.file_path)
+		return '%i %r' % (source_stat.st_size, source_stat.st_mtime)
 
 	def setStatus(self, record):
+		""" Set each bin's column and description attributes on the record.
+		 @return boolean False if record was matched to an "exclude" bin.
+		"""
+		(values, excluded) = self.getStatus(record.sseqid, record.sallseqid)
+		for (field, value) in values:
+			setattr(record, field, value)
+		return not excluded
+
 
-		if len(self.reference_bins) == 0: return #no bins
+	def getStatus(self, sseqid, sallseqid):
+		""" Check each accession in sallseqid against each bin.
+		 Kept separate from setStatus() so that results can be cached per subject id.
+
+		 @param sseqid string	first subject id, which determines how sallseqid ids are split
+		 @param sallseqid string	';' delimited subject ids
+		 @return ([[field, value],...], excluded) bin attribute values to set on a record, and exclusion flag
+		"""
+		values = []
+		if len(self.reference_bins) == 0: return (values, False) #no bins
 
 		# Use of "extended slices" http://docs.python.org/2.3/whatsnew/section-slices.html
 		# Example sallseqid is 'gi|194753780|ref|XR_046072.1|;gi|195119578|ref|XR_047594.1|;gi|195154052|ref|XR_047967.1|'
  		# Example accs is ['XR_046072.1', 'XR_047594.1', 'XR_047967.1']
 		# Original code was "[1::2][1::2]" (select every 2nd item, then every 2nd item of that)
-		accs = record.sallseqid.split('|')
+		accs = sallseqid.split('|')
 
-		if common.re_default_ncbi_id.match(record.sseqid):
+		if common.re_default_ncbi_id.match(sseqid):
 			accs = accs[3::4] #Select every 4th item starting offset 4
 			
-		elif common.re_default_ref_id.match(record.sseqid):
+		elif common.re_default_ref_id.match(sseqid):
 			accs = accs[1::2]
 		
 
 		# Check each accession # against each bin.  
 		for ptr, bin in enumerate(self.reference_bins):		
-				setattr(record, bin.field, '') #Using '','1' not FALSE/TRUE because of tab delim output
-				setattr(record, bin.field + '_desc', '')			
+				binValue = '' #Using '','1' not FALSE/TRUE because of tab delim output
+				binDesc = ''
 				for acc in accs:
 					accGeneralId = acc.split('.')[0]
 					if accGeneralId in bin.lookup:
-						if bin.exclude: return False
-						setattr(record, bin.field, str(ptr+1))
+						if bin.exclude:
+							values.extend([[bin.field, ''], [bin.field + '_desc', '']])
+							return (values, True)
+						binValue = str(ptr+1)
 						# Include any bin notes for this item
-						setattr(record, bin.field + '_desc', bin.lookup[accGeneralId])
+						binDesc = bin.lookup[accGeneralId]
 						break # This result has been binned to this bin so break.
 
+				values.extend([[bin.field, binValue], [bin.field + '_desc', binDesc]])
+
+		return (values, False)
+
 
 
 
@@ -139,7 +352,31 @@ class ReferenceBin:
 		self.path = fieldSpec.getAttribute(bin_folder_name, 'path')
 		self.exclude = bin_filter
 		#absolute path to reference bins folder: /usr/local/galaxy/shared/ngs_data/
-		self.file_path = os.path.join(self.path + self.folder + '/accession_ids.tab')
+		self.file_path = os.path.join(self.path + self.folder, BIN_SOURCE_FILE)
+		self.index_path = os.path.join(self.path + self.folder, BIN_INDEX_FILE)
+		self.meta_path = os.path.join(self.path + self.folder, BIN_META_FILE)
+
+
+def readAccessions(file_in, source_type = None):
+	""" Yield (accession, description) pairs from a FASTA file, a plain accession list, or a .tab file.
+	 FASTA: '>[accession] [description]' header lines; sequence lines are skipped.
+	 list/tab: first tab-delimited term (or first word if no tab) is the accession, the remainder its description.
+	"""
+	for line in file_in:
+		line = line.rstrip('\r\n')
+		if source_type == None and line.strip() != '':
+			source_type = 'fasta' if line[0] == '>' else 'tab'
+
+		if source_type == 'fasta':
+			if line[:1] != '>': continue
+			line = line[1:]
+		elif line[:1] == '#':
+			continue
+
+		keyValue = line.split('\t',1) if '\t' in line else line.strip().split(None,1)
+		if len(keyValue) == 0 or keyValue[0].strip() == '': continue
+		yield (keyValue[0].strip(), keyValue[1].strip() if len(keyValue) > 1 else '')
+
 		
 if __name__ == '__main__':
 
@@ -0,0 +1,157 @@
+"""Checkpoints of a report's XML parse, for resuming a long run that was stopped (-k and -R options).
+
+The slow part of a large report is the parse of its BLAST XML input into the
+unsorted work file.  Every -k seconds, at the end of an <Iteration>,
+the engine flushes its work file (and sequence sidecar) and saves a
+checkpoint next to the tabular output as [tabular output file]CHECKPOINT_SUFFIX:
+
+	- the input byte offset just after that </Iteration>, and the offset of
+	  the first <Iteration>, which ends the XML prolog;
+	- the work file and sidecar sizes, and the number of rows committed to
+	  the SQLite database output (see report_database.py);
+	- query_stats so far, and FieldFilter.matches, the query-accession pairs
+	  seen for dropping redundant hits.
+
+No other parse state lasts from one query to the next.  A resumed run
+truncates the work file, sidecar and database to the checkpoint sizes and
+parses the XML prolog followed by the input from the checkpoint offset, so
+its work file, and the final outputs written from it, are the same as those
+of an uninterrupted run.  A checkpoint is only used by a run with the same input
+file (size and modification time), arguments and options.  It is removed
+when the parse is complete.
+"""
+import os
+import time
+import marshal
+import collections
+
+CHECKPOINT_VERSION = '2'
+CHECKPOINT_SUFFIX = '.checkpoint'
+# Seconds between checkpoints when resuming (-R) without a -k interval
+CHECKPOINT_DEFAULT_SECONDS = 600
+
+ITERATION_START = '<Iteration>'
+ITERATION_END = '</Iteration>'
+
+
+
+class ReportCheckpoint(object):
+
+	def __init__(self, out_tabular_file, signature, interval):
+		"""
+		 @param out_tabular_file string	Report's tabular output file path, next to which the checkpoint is kept.
+		 @param signature string	Identifies the input file and report settings the checkpoint is valid for.
+		 @param interval float	Seconds between checkpoints.
+		"""
+		self.file_path = out_tabular_file + CHECKPOINT_SUFFIX
+		self.signature = signature
+		self.interval = interval
+		self.state = None # Loaded checkpoint being resumed from
+		self.reader = None
+		self.offset = 0 # Input offset after the last completed <Iteration>
+		self.due = time.time() + interval
+
+
+	def load(self):
+		""" Read a checkpoint to resume from.
+		 @return dictionary	checkpoint state, or None if there is no checkpoint for this report.
+		"""
+		try:
+			with open(self.file_path, 'rb') as fp_in:
+				state = marshal.load(fp_in)
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+
+		if not isinstance(state, dict) or state.get('version') != CHECKPOINT_VERSION or state.get('signature') != self.signature:
+			print 'Checkpoint is for another input or other report settings, ignored: ' + self.file_path
+			return None
+
+		self.state = state
+		self.offset = state['input_offset']
+		return state
+
+
+	def queryStats(self):
+		""" @return array	query_stats at the checkpoint resumed from, or a new array """
+		return self.state['query_stats'] if self.state != None else []
+
+
+	def openInput(self, in_file):
+		""" @return BoundaryReader of the input, from the loaded checkpoint's offset if resuming """
+		if self.state != None:
+			self.reader = BoundaryReader(in_file, self.state['prolog_end'], self.state['input_offset'])
+		else:
+			self.reader = BoundaryReader(in_file)
+		return self.reader
+
+
+	def endIteration(self):
+		""" Note that the parser has passed the end of an <Iteration>.
+		 @return boolean	True if a checkpoint is due.
+		"""
+		self.offset = self.reader.boundaries.popleft()
+		return time.time() >= self.due
+
+
+	def save(self, state):
+		""" Save a checkpoint at the last <Iteration> end passed.
+		 @param state dictionary	The report's work_size, sidecar_size, query_stats and matches; its outputs must be flushed.
+		"""
+		state = dict(state, version = CHECKPOINT_VERSION, signature = self.signature,
+			input_offset = self.offset, prolog_end = self.reader.prolog_end)
+
+		temp_file = '%s.%i.tmp' % (self.file_path, os.getpid())
+		with open(temp_file, 'wb') as fp_out:
+			marshal.dump(state, fp_out)
+		os.rename(temp_file, self.file_path)
+		self.due = time.time() + self.interval
+
+
+	def remove(self):
+		if os.path.exists(self.file_path):
+			os.remove(self.file_path)
+
+
+
+class BoundaryReader(object):
+	""" File-like input for ElementTree.iterparse() that notes the byte offsets of the <Iteration> ends it reads,
+	 so that the parser's position can be known at each 'Iteration' end event.  The parser reads ahead, but
+	 never past data it hasn't reported on yet, so the next offset is always known by the time its event comes.
+
+	 When resuming at offset, the XML prolog (up to prolog_end) is read first.
+	"""
+	def __init__(self, file_path, prolog_end = None, offset = 0):
+		self.fp = open(file_path, 'rb')
+		self.prolog = ''
+		if offset:
+			self.prolog = self.fp.read(prolog_end)
+			self.fp.seek(offset)
+		self.prolog_end = prolog_end # Offset of the first <Iteration>, found while reading if not known.
+		self.offset = offset # Offset of the next byte read from the file
+		self.tail = '' # End of the last data read, shorter than a tag, for tags split across reads.
+		self.boundaries = collections.deque()
+
+	def read(self, size = -1):
+		if len(self.prolog):
+			(data, self.prolog) = (self.prolog, '')
+			return data
+
+		data = self.fp.read(size)
+		text = self.tail + data
+		start = self.offset - len(self.tail)
+		self.offset += len(data)
+
+		if self.prolog_end == None:
+			position = text.find(ITERATION_START)
+			if position >= 0: self.prolog_end = start + position
+
+		position = text.find(ITERATION_END)
+		while position >= 0:
+			self.boundaries.append(start + position + len(ITERATION_END))
+			position = text.find(ITERATION_END, position + len(ITERATION_END))
+
+		self.tail = text[-(len(ITERATION_END) - 1):]
+		return data
+
+	def close(self):
+		self.fp.close()
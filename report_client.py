@@ -0,0 +1,56 @@
+"""Thin blast_reporting.py client for a resident report server.
+
+Takes exactly the blast_reporting.py command line.  If the
+BLAST_REPORTING_SOCKET environment variable names the Unix socket of a
+running report_server.py, the job is run there, with the server's field
+spec, templates and reference bins already loaded; its messages and exit
+status are passed on as if the report had run here.  Without a server the
+report is run in this process, as blast_reporting.py would.
+
+Requests and responses are one line of JSON each, with strings (bytes) coded
+as latin-1 so that any byte value passes unchanged:
+
+	request: {"argv": [arguments], "cwd": working folder, "env": environment}
+	response: {"stdout": text, "stderr": text, "status": exit status}
+"""
+import os
+import sys
+import json
+import socket
+
+SOCKET_ENV = 'BLAST_REPORTING_SOCKET'
+
+
+def sendRequest(socket_path, argv):
+	""" @return dictionary	server response, or None if no server is listening on socket_path """
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		client.connect(socket_path)
+	except socket.error:
+		return None
+
+	request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+	client.sendall(json.dumps(request, encoding = 'latin-1') + '\n')
+	client.shutdown(socket.SHUT_WR)
+
+	response = client.makefile('rb').readline()
+	client.close()
+	if response == '':
+		return {'stdout': '', 'stderr': 'Report server closed the connection without a response.\n', 'status': 1}
+	return json.loads(response)
+
+
+if __name__ == '__main__':
+	socket_path = os.environ.get(SOCKET_ENV)
+	response = sendRequest(socket_path, sys.argv[1:]) if socket_path else None
+
+	if response == None:
+		# No report server: run the report here.
+		sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+		import blast_reporting
+		blast_reporting.ReportEngine().__main__()
+
+	else:
+		sys.stdout.write(response['stdout'].encode('latin-1'))
+		sys.stderr.write(response['stderr'].encode('latin-1'))
+		sys.exit(response['status'])
@@ -0,0 +1,150 @@
+"""SQLite database output of report rows.
+
+Loading the processed HSP records into an indexed SQLite database lets
+follow-up questions (e.g. all hits of a query, or all queries hitting an
+accession) be answered with SQL instead of re-parsing or scanning the tabular
+output.  The database has three tables:
+
+	hsps: one row per reported HSP, one column per report field, plus qseqid
+		and accessionid if the report doesn't show them.  evalue, bitscore,
+		pident, ppos and pcov are REAL columns of the unrounded values derived
+		from the raw XML tags, rather than of their formatted text; other
+		numeric fields have NUMERIC affinity, so they are stored as integers.
+	query_stats: query id, number of HSPs, number reported (after filters).
+	options: the report's command line settings, as name and value.
+
+Rows are loaded from the engine's processed records as they are written to
+the work file, in input order, rather than from the sorted report rows.
+Indexes on qseqid, accessionid, evalue and any reference bin columns are
+created after the rows are loaded.
+
+A report with checkpoints (see report_checkpoint.py) commits the loaded rows
+at each checkpoint, and a resumed run deletes any rows loaded after it.
+"""
+import os
+import sqlite3
+import common
+
+# Rows per executemany() call
+INSERT_BATCH_ROWS = 10000
+# Report fields to index, if they are in the report; reference bin columns are indexed too.
+INDEXED_FIELDS = ['qseqid', 'accessionid', 'evalue']
+# Fields loaded whether or not the report shows them, for lookups by query or accession.
+REQUIRED_FIELDS = ['qseqid', 'accessionid']
+
+
+def rowCount(db_file):
+	""" @return int	Number of rows in a report database's hsps table, or None if it can't be read. """
+	try:
+		db = sqlite3.connect(db_file)
+		try:
+			return db.execute('SELECT COUNT(*) FROM hsps').fetchone()[0]
+		finally:
+			db.close()
+	except sqlite3.Error:
+		return None
+
+
+class ReportDatabase(object):
+	""" Bulk loads a report's processed records into a SQLite database.
+
+	@param db_file string	Full file path; an existing file is replaced, unless resuming.
+	@param tagGroup object	XMLRecordScan; includes columns, and derives numeric values of records that lack them.
+	@param resume_rows int	Rows of an existing database to keep, when resuming from a checkpoint; None for a new database.
+	@param checkpoints boolean	Whether the database is committed at checkpoints, and so needs a rollback journal.
+	"""
+	def __init__(self, db_file, tagGroup, resume_rows = None, checkpoints = False):
+		self.tagGroup = tagGroup
+		self.batch = []
+		self.count = resume_rows or 0
+
+		self.fields = [field['field'] for field in tagGroup.columns]
+		types = [field['type'] for field in tagGroup.columns]
+		for field in REQUIRED_FIELDS:
+			if not field in self.fields:
+				self.fields.append(field)
+				types.append('text')
+
+		self.names = [field.lstrip('_') for field in self.fields]
+		self.real_cols = [idx for (idx, field) in enumerate(self.fields) if field in common.NUMERIC_FORMATS]
+		self.numeric_cols = [idx for (idx, value_type) in enumerate(types) if value_type == 'numeric' and not idx in self.real_cols]
+		self.indexed = [name for (name, value_type) in zip(self.names, types) if name in INDEXED_FIELDS or value_type == 'bin']
+		self.insert = 'INSERT INTO hsps VALUES (%s)' % ', '.join(['?'] * len(self.names))
+
+		if resume_rows == None and os.path.exists(db_file):
+			os.remove(db_file)
+		self.db = sqlite3.connect(db_file)
+		self.db.text_factory = str
+		# No need to sync during loading.  A new output file doesn't need a rollback journal either, unless it must
+		# survive being stopped after a checkpoint.
+		if not checkpoints:
+			self.db.execute('PRAGMA journal_mode = OFF')
+		self.db.execute('PRAGMA synchronous = OFF')
+
+		if resume_rows != None:
+			self.db.execute('DELETE FROM hsps WHERE rowid > ?', (resume_rows,))
+			self.db.commit()
+			return
+
+		definitions = []
+		for (idx, name) in enumerate(self.names):
+			affinity = 'REAL' if idx in self.real_cols else 'NUMERIC' if idx in self.numeric_cols else 'TEXT'
+			definitions.append('"%s" %s' % (name, affinity))
+		self.db.execute('CREATE TABLE hsps (%s)' % ', '.join(definitions))
+		self.db.execute('CREATE TABLE query_stats (query TEXT, rows INTEGER, filtered_rows INTEGER)')
+		self.db.execute('CREATE TABLE options (name TEXT, value TEXT)')
+		self.db.commit()
+
+
+	def add(self, record):
+		""" @param record object	Processed record, as XMLRecordScan.record.  Its numeric_values supply evalue, bitscore etc.;
+		 if it has none (e.g. numeric_batch or record cache records), they are derived again from its raw values.
+		"""
+		row = [getattr(record, field) for field in self.fields]
+		for idx in self.numeric_cols:
+			if row[idx] == '': row[idx] = None
+		if len(self.real_cols):
+			numeric_values = getattr(record, 'numeric_values', None)
+			if numeric_values == None:
+				numeric_values = self.tagGroup.getNumericValues(record)
+			for idx in self.real_cols:
+				row[idx] = numeric_values[self.fields[idx]]
+
+		self.batch.append(row)
+		self.count += 1
+		if len(self.batch) >= INSERT_BATCH_ROWS:
+			self.flush()
+
+
+	def flush(self):
+		if len(self.batch):
+			self.db.executemany(self.insert, self.batch)
+			self.batch = []
+
+
+	def checkpoint(self):
+		""" Commit the rows loaded so far.  @return int	Number of rows, to resume from. """
+		self.flush()
+		self.db.commit()
+		return self.count
+
+
+	def close(self, query_stats, settings):
+		"""
+		 @param query_stats array	Per-query {'id', 'rows', 'filtered_rows'} counts
+		 @param settings dictionary	Run settings to store in the options table, e.g. vars(options)
+		"""
+		self.flush()
+
+		self.db.executemany('INSERT INTO query_stats VALUES (?, ?, ?)',
+			[(query['id'], query['rows'], query['filtered_rows']) for query in query_stats])
+		self.db.executemany('INSERT INTO options VALUES (?, ?)',
+			[(name, str(value)) for (name, value) in sorted(settings.items()) if value != None])
+
+		# Indexes are quicker to build once all rows are loaded.
+		for name in self.indexed:
+			self.db.execute('CREATE INDEX "hsps_%s" ON hsps ("%s")' % (name, name))
+		self.db.execute('CREATE INDEX query_stats_query ON query_stats (query)')
+
+		self.db.commit()
+		self.db.close()
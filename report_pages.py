@@ -0,0 +1,144 @@
+"""Paginated HTML report output.
+
+For runs with thousands of queries a single HTML report file is too large
+for browsers to open.  PagedTemplateSink splits the sorted report rows into
+pages, either one per report section (query) or one per fixed number of rows,
+and renders each page with its own instance of the selected HTML report
+template.  Pages are rendered in parallel by a pool of worker processes.  The
+main HTML output file becomes a lightweight index page linking to the pages,
+with per-query row counts and the list of queries that had no results.
+"""
+import os.path
+import cgi
+import multiprocessing
+import common
+import query_summary
+
+# Template factory for page rendering; set before worker processes are forked so that they inherit it.
+_page_template_factory = None
+
+
+def renderPage(page):
+	""" Render one page with a new template instance, via the template's streaming interface.
+	 @param page array	[page file path, rows]
+	"""
+	(page_path, rows) = page
+	template = _page_template_factory()
+	for field in template.columns: # Column dictionaries carry section state from any previous page.
+		field.pop('valueOld', None)
+	template.begin(page_path)
+	template.rows(rows)
+	template.end()
+	return page_path
+
+
+class PagedTemplateSink(object):
+	""" Report engine output sink (see common.fileSinks()) writing paginated HTML.
+
+	@param template_factory function	Returns a new HTML report template instance
+	@param tagGroup object	Includes columns
+	@param query_stats array	Per-query {'id', 'rows', 'filtered_rows'} counts for the index page
+	@param out_html_file string	Index page file path
+	@param page_dir string	Folder for page files
+	@param pages string	'query' for a page per report section, or a number of rows per page
+	@param workers integer	Number of page rendering processes
+	@param compression string	Index and page compression, see common.openOutput().  Compressed pages are named with
+	 the matching suffix (page_00001.html.gz), which the index links to.
+	"""
+	def __init__(self, template_factory, tagGroup, query_stats, out_html_file, page_dir, pages, workers, compression = ''):
+		global _page_template_factory
+		self.name = 'html pages'
+		self.seconds = 0.0
+		self.tagGroup = tagGroup
+		self.query_stats = query_stats
+		self.out_html_file = out_html_file
+		self.compression = compression
+		self.page_suffix = '.html'
+		for (suffix, suffix_compression) in common.COMPRESSION_SUFFIXES.items():
+			if compression == suffix_compression: self.page_suffix += suffix
+		self.page_dir = page_dir
+		if not os.path.isdir(page_dir):
+			os.makedirs(page_dir)
+
+		if pages == 'query':
+			self.page_rows = 0
+		elif pages.isdigit() and int(pages) > 0:
+			self.page_rows = int(pages)
+		else:
+			raise ValueError('Pages should be "query" or a number of rows per page: ' + pages)
+
+		# Page per query: a new page starts when first section column (or qseqid) value changes.
+		self.section_col = 0
+		for (idx, field) in enumerate(tagGroup.columns):
+			if field['group'] == 'section' or field['field'] == 'qseqid':
+				self.section_col = idx
+				break
+
+		self.rows = []
+		self.index = [] # [page file, first section, last section, row count] for index page
+		self.pending = []
+		self.workers = workers
+		_page_template_factory = template_factory
+		self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+	def row(self, row):
+		if len(self.rows):
+			if self.page_rows:
+				if len(self.rows) >= self.page_rows: self.flushPage()
+			elif row[self.section_col] != self.rows[-1][self.section_col]:
+				self.flushPage()
+		self.rows.append(row)
+
+	def flushPage(self):
+		page_path = os.path.join(self.page_dir, 'page_%05i%s' % (len(self.index) + 1, self.page_suffix))
+		self.index.append([page_path, self.rows[0][self.section_col], self.rows[-1][self.section_col], len(self.rows)])
+		page = [page_path, self.rows]
+		self.rows = []
+
+		if self.pool == None:
+			renderPage(page)
+			return
+
+		self.pending.append(self.pool.apply_async(renderPage, (page,)))
+		# Bound the number of pages held in memory waiting for a worker.
+		while len(self.pending) > 2 * self.workers:
+			self.pending.pop(0).get()
+
+	def close(self):
+		if len(self.rows): self.flushPage()
+		if self.pool != None:
+			for result in self.pending:
+				result.get() # Raises any page rendering error
+			self.pool.close()
+			self.pool.join()
+		self.writeIndex()
+
+	def writeIndex(self):
+		index_dir = os.path.dirname(os.path.abspath(self.out_html_file))
+		html = ['<!DOCTYPE html>\n<html>\n<head>\n\t<meta charset="utf-8">\n\t<title>BLAST Report Index</title>\n</head>\n<body>\n']
+
+		html.append('\t<h2>Report pages</h2>\n\t<table>\n\t\t<tr><th>Page</th><th>Sections</th><th>Rows</th></tr>\n')
+		for (ptr, (page_path, first, last, row_count)) in enumerate(self.index):
+			sections = cgi.escape(first) if first == last else cgi.escape(first) + ' &ndash; ' + cgi.escape(last)
+			link = os.path.relpath(os.path.abspath(page_path), index_dir)
+			html.append('\t\t<tr><td><a href="%s">%i</a></td><td>%s</td><td>%i</td></tr>\n' % (cgi.escape(link, True), ptr + 1, sections, row_count))
+		html.append('\t</table>\n')
+
+		html.append('\t<h2>Queries</h2>\n\t<table>\n\t\t<tr><th>Query</th><th>Hits</th><th>Reported</th></tr>\n')
+		for query in self.query_stats:
+			html.append('\t\t<tr><td>%s</td><td>%i</td><td>%i</td></tr>\n' % (cgi.escape(query['id']), query['rows'], query['filtered_rows']))
+		html.append('\t</table>\n')
+		# Per-query summary statistics, if the engine gathered them (-s option)
+		html.append(query_summary.summaryHTML(self.tagGroup, self.query_stats))
+
+		empty_queries = [query['id'] for query in self.query_stats if query['filtered_rows'] == 0]
+		if len(empty_queries):
+			html.append('\t<h2>The following %i queries yielded 0 results (check filters):</h2>\n\t<ul>\n' % len(empty_queries))
+			for name in empty_queries:
+				html.append('\t\t<li>' + cgi.escape(name) + '</li>\n')
+			html.append('\t</ul>\n')
+
+		html.append('</body>\n</html>\n')
+		fp_out = common.openOutput(self.out_html_file, self.compression)
+		fp_out.write(''.join(html))
+		fp_out.close()
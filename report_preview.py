@@ -0,0 +1,201 @@
+"""Preview reports from a sample of the queries of a large BLAST XML file (-p option).
+
+To check a report's filters and columns before a long run, a preview parses
+a deterministic sample of <Iteration> elements spread across the input,
+until a budget of report rows or seconds is spent.  PreviewReader seeks to
+sample positions in the order 0, 1/2, 1/4, 3/4, 1/8, 3/8 ... of the way
+through the input's iterations, so that the sample is spread evenly however
+soon it stops, and reads the first <Iteration> starting at or after each
+position, between the XML prolog and epilog.  Once a whole round of
+positions finds no new <Iteration>, the rest are read in file order.  The
+engine calls endIteration() after each one; once the budget is spent the
+reader goes on to the epilog.
+
+The outputs are labeled as a preview, with estimates of the full report's
+queries, rows and parse time, scaled from the sample by input bytes.
+"""
+import os
+import time
+import common
+
+PREVIEW_READ_SIZE = 1048576
+
+ITERATION_START = '<Iteration>'
+ITERATION_END = '</Iteration>'
+
+
+def parseBudget(text):
+	""" @return (rows, seconds) budget from e.g. "1000" (rows) or "30s" (seconds); the other is 0 """
+	text = text.strip().lower()
+	try:
+		if text.endswith('s'):
+			seconds = float(text[:-1])
+			if seconds > 0: return (0, seconds)
+		else:
+			rows = int(text)
+			if rows > 0: return (rows, 0)
+	except ValueError:
+		pass
+	common.stop_err('The preview budget should be a number of rows (e.g. 1000) or of seconds (e.g. 30s): ' + text)
+
+
+def samplePositions():
+	""" Generate fractions 0, 1/2, 1/4, 3/4, 1/8, 3/8 ..., with the level (power of 2) each belongs to. """
+	yield (0.0, 0)
+	level = 1
+	while True:
+		steps = 2 ** level
+		for step in range(1, steps, 2):
+			yield (float(step) / steps, level)
+		level += 1
+
+
+
+class PreviewReader(object):
+
+	def __init__(self, file_path, rows, seconds):
+		"""
+		 @param file_path string	BLAST XML input
+		 @param rows int	Budget of report rows, or 0
+		 @param seconds float	Budget of seconds, or 0
+		"""
+		self.fp = open(file_path, 'rb')
+		self.file_size = os.path.getsize(file_path)
+		self.rows = rows
+		self.seconds = seconds
+		self.time_start = time.time()
+		self.positions = samplePositions()
+		self.sampled = set() # Start offsets of sampled iterations
+		self.sampled_bytes = 0
+		self.level = 0
+		self.level_new = False # Whether the current level of positions found any new iteration
+		self.sequential = None # Offset to read remaining iterations from in file order, once sample positions find no new ones
+		self.stopped = False # Budget spent
+		self.finished = False # Epilog reached
+		self.complete = False # Every iteration was sampled
+		self.ranges = [] # Byte ranges still to read
+
+		prolog_end = self.find(ITERATION_START, 0)
+		if prolog_end == None:
+			# No queries: read the whole document.
+			(self.prolog_end, self.epilog_start) = (self.file_size, self.file_size)
+			self.ranges = [[0, self.file_size]]
+			self.finished = self.complete = True
+			return
+
+		self.prolog_end = prolog_end
+		self.epilog_start = self.findLast(ITERATION_END) + len(ITERATION_END)
+		self.ranges = [[0, self.prolog_end]]
+
+
+	def find(self, text, position):
+		""" @return offset of text's first occurrence at or after position, or None """
+		overlap = len(text) - 1
+		while position < self.file_size:
+			self.fp.seek(position)
+			data = self.fp.read(PREVIEW_READ_SIZE)
+			found = data.find(text)
+			if found >= 0: return position + found
+			if len(data) < PREVIEW_READ_SIZE: break
+			position += len(data) - overlap
+		return None
+
+
+	def findLast(self, text):
+		""" @return offset of text's last occurrence """
+		end = self.file_size
+		while end > 0:
+			start = max(0, end - PREVIEW_READ_SIZE)
+			self.fp.seek(start)
+			data = self.fp.read(end - start + len(text) - 1)
+			found = data.rfind(text)
+			if found >= 0: return start + found
+			end = start
+		return None
+
+
+	def nextSample(self):
+		""" @return [start, end] byte range of the next sampled <Iteration>, or None if all have been sampled """
+		body = self.epilog_start - self.prolog_end
+		while self.sequential == None:
+			(fraction, level) = self.positions.next()
+			if level != self.level:
+				if level > 1 and not self.level_new:
+					# Sample positions are now too close together to find new iterations.
+					self.sequential = self.prolog_end
+					break
+				(self.level, self.level_new) = (level, False)
+
+			start = self.find(ITERATION_START, self.prolog_end + int(fraction * body))
+			if start != None and start < self.epilog_start and not start in self.sampled:
+				self.level_new = True
+				return self.sample(start)
+
+		while True:
+			start = self.find(ITERATION_START, self.sequential)
+			if start == None or start >= self.epilog_start:
+				return None
+			self.sequential = start + len(ITERATION_START)
+			if not start in self.sampled:
+				return self.sample(start)
+
+
+	def sample(self, start):
+		""" @return [start, end] byte range of the <Iteration> at start """
+		end = self.find(ITERATION_END, start) + len(ITERATION_END)
+		self.sampled.add(start)
+		self.sampled_bytes += end - start
+		return [start, end]
+
+
+	def endIteration(self, query_stats):
+		""" After each parsed <Iteration>, stop sampling if the budget is spent.
+		 @param query_stats array	The report's {'id', 'rows', 'filtered_rows'} per query
+		"""
+		if self.rows and sum(query['filtered_rows'] for query in query_stats) >= self.rows:
+			self.stopped = True
+		if self.seconds and time.time() - self.time_start >= self.seconds:
+			self.stopped = True
+
+
+	def read(self, size = -1):
+		# Reads never go past the end of a range, so the parser has reported on each <Iteration> before the next one is chosen.
+		while not len(self.ranges):
+			if self.finished:
+				return ''
+			sample = None if self.stopped else self.nextSample()
+			if sample != None:
+				self.ranges.append(sample)
+			else:
+				self.complete = not self.stopped
+				self.finished = True
+				self.ranges.append([self.epilog_start, self.file_size])
+
+		(start, end) = self.ranges[0]
+		if size < 0 or size > end - start:
+			size = end - start
+		self.fp.seek(start)
+		data = self.fp.read(size)
+		if len(data) < size:
+			raise IOError('BLAST XML input changed while being previewed: ' + self.fp.name)
+		if start + size >= end:
+			self.ranges.pop(0)
+		else:
+			self.ranges[0][0] = start + size
+		return data
+
+
+	def notice(self, query_stats):
+		""" @return string	Label for the preview's outputs, with estimates for the full report """
+		rows = sum(query['filtered_rows'] for query in query_stats)
+		if self.complete:
+			return 'Preview: all %i queries were sampled, so this is the complete report (%i rows).' % (len(query_stats), rows)
+
+		# Scale sample figures up by the share of the input's query bytes sampled.
+		scale = float(self.epilog_start - self.prolog_end) / max(self.sampled_bytes, 1)
+		return ('Preview from a sample of %i queries (%.1f%% of the input).  Full report estimate: about %i queries, %i rows, %i seconds of XML parsing.'
+			% (len(query_stats), 100.0 / scale, len(query_stats) * scale, rows * scale, (time.time() - self.time_start) * scale))
+
+
+	def close(self):
+		self.fp.close()
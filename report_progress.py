@@ -0,0 +1,85 @@
+"""Progressive report outputs while following a growing BLAST XML file (-F option).
+
+Final outputs are sorted across all queries (by qseqid first, by default),
+so they can only be written once the input is complete.  While following
+input, each query's rows are written as soon as its <Iteration> is complete
+instead: sorted within the query, and appended to the tabular output and to
+the HTML report of a streaming template, which are flushed so that they can
+be viewed while BLAST is running.  When the input is complete the engine
+writes the final outputs over them as usual.
+
+Rows within a query are sorted in Python, with column_store's "sort -g" and
+"sort -V" sort keys, in the same order as in the final outputs.
+"""
+import copy
+import common
+import column_store
+
+
+class ProgressReport(object):
+
+	def __init__(self, tagGroup, options, out_tabular_file, template_module = None, out_html_file = None):
+		"""
+		 @param tagGroup object	Includes columns, record
+		 @param options object	Includes column_labels, compression, filters_HTML
+		 @param template_module module	HTML report template module; only templates with a begin()/rows()/end()
+		  streaming interface get a progressive HTML report.
+		"""
+		# Outputs are flushed after each query, which a background writer doesn't support.
+		options = copy.copy(options)
+		options.background_writer = False
+
+		self.tagGroup = tagGroup
+		self.fields = [field['field'] for field in tagGroup.columns]
+		self.sorts = []
+		for (idx, field) in enumerate(tagGroup.columns):
+			if field['sort']:
+				key = column_store.numericKey if field['type'] == 'numeric' else column_store.versionKey
+				self.sorts.append([idx, key, field['sort'] == 'desc'])
+
+		self.sinks = [common.TabularSink(out_tabular_file, tagGroup, options)]
+		self.template = None
+		if template_module != None and out_html_file != None:
+			# Templates keep section state in the column dictionaries, so this one gets its own copy of them,
+			# leaving the final report's template to start afresh.
+			templateGroup = copy.copy(tagGroup)
+			templateGroup.columns = copy.deepcopy(tagGroup.columns)
+			# The selection file id is only known to the final report.
+			if not hasattr(options, 'dataset_selection_id'):
+				options.dataset_selection_id = None
+			template = template_module.HTMLReport(templateGroup, options, [])
+			if hasattr(template, 'rows'):
+				self.template = template
+				self.sinks.append(common.TemplateSink(template, out_html_file))
+
+		self.rows = []
+
+
+	def add(self):
+		""" Note the current record of tagGroup, which the engine has just written to its work file. """
+		record = self.tagGroup.record
+		self.rows.append([getattr(record, field) for field in self.fields])
+
+
+	def endQuery(self):
+		""" Write the rows of the query just completed. """
+		rows = self.rows
+		self.rows = []
+		# Stable sorts, least significant sort column first.
+		for (idx, key, descending) in reversed(self.sorts):
+			rows.sort(key = lambda row: key(row[idx]), reverse = descending)
+
+		for row in rows:
+			for sink in self.sinks:
+				sink.row(row)
+
+		self.sinks[0].fp_out.flush()
+		if self.template != None:
+			self.sinks[1].flush()
+			self.template.fp_out.flush()
+
+
+	def close(self):
+		self.endQuery()
+		for sink in self.sinks:
+			sink.close()
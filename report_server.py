@@ -0,0 +1,247 @@
+"""Resident report server: runs blast_reporting.py jobs sent over a local Unix socket.
+
+Each blast_reporting.py job starts Python, reads the field specification,
+imports its template and loads its reference bins before it reads any XML.
+This server does that once and keeps it in memory: it accepts jobs from
+report_client.py (which takes the usual blast_reporting.py command line),
+and runs each one in a forked child process, so jobs run concurrently and
+can't disturb the server's state.
+
+Kept in memory:
+	- XMLRecordScan prototypes (field specification, columns and bins) per
+	  distinct out format, custom columns and bins, which jobs clone().
+	- Reference bin lookups (ReferenceBins.lookup_cache).  A bin is reloaded
+	  when its accession_ids.tab or compiled index changes, and prototypes
+	  using it are rebuilt.
+	- HTML report templates, imported by the server when a single report job
+	  first uses one, and other modules.
+
+Usage:
+	python report_server.py [options] [socket_path]
+	BLAST_REPORTING_SOCKET=[socket_path] python report_client.py [blast_reporting.py arguments]
+"""
+import os
+import sys
+
+# Jobs run in their client's working folder, so this folder's modules must be imported by absolute path.
+sys.path[0] = os.path.dirname(os.path.abspath(__file__))
+
+import copy
+import json
+import time
+import socket
+import signal
+import traceback
+import StringIO
+import multiprocessing
+import common
+import reference_bins
+import report_client
+import blast_reporting
+
+# Seconds between checks for finished jobs while waiting for connections
+REAP_INTERVAL = 1.0
+# Maximum number of XMLRecordScan prototypes kept
+PROTOTYPE_CACHE_SIZE = 32
+
+
+def toBytes(value):
+	""" Convert a decoded JSON request value back to byte strings (see report_client.py) """
+	if isinstance(value, unicode): return value.encode('latin-1')
+	if isinstance(value, list): return [toBytes(item) for item in value]
+	if isinstance(value, dict): return dict((toBytes(key), toBytes(item)) for (key, item) in value.items())
+	return value
+
+
+
+class ReportServer(object):
+
+	def __init__(self, socket_path, max_jobs):
+		"""
+		 @param socket_path string	Unix socket file path; an existing file is replaced.
+		 @param max_jobs int	Maximum number of jobs running at once.
+		"""
+		self.socket_path = socket_path
+		self.max_jobs = max_jobs
+		self.jobs = set()
+		self.prototypes = common.LRUCache(PROTOTYPE_CACHE_SIZE)
+		self.field_spec_path = os.path.join(os.path.dirname(os.path.abspath(blast_reporting.__file__)), 'blast_reporting_fields.tab')
+		reference_bins.ReferenceBins.lookup_cache = {}
+
+
+	def serve(self):
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(self.socket_path)
+		os.chmod(self.socket_path, 0600)
+		self.server.listen(16)
+		self.server.settimeout(REAP_INTERVAL)
+		print 'Report server listening on ' + self.socket_path
+		sys.stdout.flush()
+
+		# Stop on SIGTERM as on Ctrl-C, removing the socket file.
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+		try:
+			while True:
+				self.reapJobs(len(self.jobs) >= self.max_jobs)
+				try:
+					(conn, address) = self.server.accept()
+				except socket.timeout:
+					continue
+				conn.settimeout(None)
+				self.handle(conn)
+		finally:
+			self.server.close()
+			os.remove(self.socket_path)
+
+
+	def reapJobs(self, wait):
+		""" Collect finished job processes.  @param wait boolean	Block until at least one has finished. """
+		while len(self.jobs):
+			(pid, status) = os.waitpid(-1, 0 if wait else os.WNOHANG)
+			if pid == 0: break
+			self.jobs.discard(pid)
+			wait = False
+
+
+	def handle(self, conn):
+		""" Read a job request; prepare its options and XMLRecordScan prototype here, where they stay cached,
+		 then run the job in a child process, which sends the response.
+		"""
+		try:
+			request = toBytes(json.loads(conn.makefile('rb').readline()))
+			argv = request['argv']
+		except (ValueError, KeyError, TypeError):
+			self.respond(conn, '', 'Invalid report server request.\n', 1)
+			conn.close()
+			return
+
+		# Option parsing and prototype errors exit via common.stop_err(); report them to the client.
+		(status, stdout, stderr, prepared) = capture(self.prepare, argv)
+		if status != 0 or prepared == None: # An error, or e.g. --help
+			self.respond(conn, stdout, stderr, status)
+			conn.close()
+			return
+
+		(options, args, prototype) = prepared
+		pid = os.fork()
+		if pid == 0:
+			self.server.close()
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			os.chdir(request['cwd'])
+			os.environ.clear()
+			os.environ.update(request['env'])
+			(status, stdout, stderr, result) = capture(self.runJob, argv, options, args, prototype)
+			self.respond(conn, stdout, stderr, status)
+			conn.close()
+			os._exit(status)
+
+		self.jobs.add(pid)
+		conn.close()
+
+
+	def prepare(self, argv):
+		""" Parse a job's command line, and get its XMLRecordScan prototype for single report jobs.
+		 Prototypes are keyed by the options that determine columns and bins, and by the field spec and bin
+		 versions, so that a changed bin or field spec is reloaded.
+
+		 The job's HTML report template is imported here too, so that it stays loaded for later jobs.
+
+		 @return (options, args, XMLRecordScan prototype or None)
+		"""
+		parser = blast_reporting.ReportEngine().commandParser()
+		(options, args) = parser.parse_args(argv)
+		prototype = None
+
+		if not (options.info or options.report_list or options.manifest) and len(args) >= 3:
+			output_format = args[1]
+			binManager = reference_bins.ReferenceBins()
+			bin_names = [spec.split(':')[0].strip() for spec in (options.reference_bins or '').split(';')]
+			spec_stat = os.stat(self.field_spec_path)
+			key = (output_format, options.custom_fields, options.reference_bins, spec_stat.st_size, spec_stat.st_mtime,
+				tuple(binManager.binVersion(name) for name in bin_names if name != ''))
+
+			prototype = self.prototypes.get(key)
+			if prototype == None:
+				prototype = blast_reporting.XMLRecordScan(copy.copy(options), output_format)
+				self.prototypes.set(key, prototype)
+
+			# Forked job processes find it in sys.modules rather than importing it again.
+			blast_reporting.ReportEngine().templateModule(args)
+
+		return (options, args, prototype)
+
+
+	def runJob(self, argv, options, args, prototype):
+		""" Run a job as blast_reporting.py would, with a prototype for single report jobs. """
+		if prototype == None:
+			sys.argv = ['blast_reporting.py'] + argv
+			blast_reporting.ReportEngine().__main__()
+			return
+
+		time_start = time.time()
+		blast_reporting.ReportEngine().runReport(options, args, prototype)
+		print('Execution time (seconds): ' + str(int(time.time()-time_start)))
+
+
+	def respond(self, conn, stdout, stderr, status):
+		response = {'stdout': stdout, 'stderr': stderr, 'status': status}
+		try:
+			conn.sendall(json.dumps(response, encoding = 'latin-1') + '\n')
+		except socket.error:
+			pass # Client has gone.
+
+
+def capture(function, *args):
+	""" Call function, collecting what it prints.
+	 @return (exit status, stdout text, stderr text, function result)
+	"""
+	(stdout, stderr) = (sys.stdout, sys.stderr)
+	(sys.stdout, sys.stderr) = (StringIO.StringIO(), StringIO.StringIO())
+	(status, result) = (0, None)
+	try:
+		result = function(*args)
+	except SystemExit as e:
+		if e.code == None: status = 0
+		elif isinstance(e.code, int): status = e.code
+		else:
+			sys.stderr.write('%s\n' % e.code)
+			status = 1
+	except Exception:
+		sys.stderr.write(traceback.format_exc())
+		status = 1
+	finally:
+		(output, errors) = (sys.stdout.getvalue(), sys.stderr.getvalue())
+		(sys.stdout, sys.stderr) = (stdout, stderr)
+
+	return (status, output, errors, result)
+
+
+if __name__ == '__main__':
+
+	parser = common.MyParser(
+		description = 'Runs blast_reporting.py jobs sent by report_client.py over a Unix socket, keeping field specs, templates and reference bins loaded.',
+		usage = 'python report_server.py [options] [socket_path]',
+		epilog = """Details:
+
+		The socket path defaults to $BLAST_REPORTING_SOCKET.  Clients find the server through the same
+		environment variable, e.g.:
+
+		   export BLAST_REPORTING_SOCKET=/tmp/blast_reporting.sock
+		   python report_server.py &
+		   python report_client.py [blast_reporting.py arguments]
+
+	""")
+
+	parser.add_option('-j', '--jobs', type='int', dest='max_jobs', default=0,
+		help='Maximum number of jobs running at once.  The default 0=the number of CPUs.')
+
+	options, args = parser.parse_args()
+
+	socket_path = args[0] if len(args) else os.environ.get(report_client.SOCKET_ENV)
+	if not socket_path:
+		common.stop_err('Expecting a socket path argument, or $' + report_client.SOCKET_ENV)
+
+	ReportServer(socket_path, options.max_jobs or multiprocessing.cpu_count()).serve()
@@ -0,0 +1,105 @@
+"""Cache of final report outputs for identical re-runs.
+
+Galaxy workflows often re-run a report with exactly the same input dataset
+and parameters.  With a cache folder (-K option), the tabular, HTML and
+selection outputs of each report are kept there, under a key made of:
+
+	- a hash of the BLAST XML input content,
+	- the normalized settings that shape the output: format, filters, columns,
+	  bins, labels, row limit, redundant hit removal, template, compression,
+	- a hash of the field specification file (blast_reporting_fields.tab),
+	- a hash of the engine code and of the HTML template's folder, so that
+	  outputs of an older version of either aren't reused,
+	- each selected reference bin's version: its compiled index metadata, or
+	  its accession_ids.tab size and modification time if not compiled.
+
+A later run with the same key hard links (or, across file systems, copies)
+the cached files to its output paths instead of parsing, sorting and
+rendering.  Settings that don't change output content (e.g. -w, -S, -N, -W)
+are not part of the key.
+
+Entries unused for RESULT_MAX_DAYS are removed, as are least recently used
+entries beyond a RESULT_MAX_BYTES total.
+"""
+import os
+import shutil
+import hashlib
+import record_cache
+
+RESULT_VERSION = '1'
+RESULT_SUFFIX = '.results'
+RESULT_MAX_BYTES = 2 * 1024 ** 3
+RESULT_MAX_DAYS = 30
+
+
+def normalizeSpec(spec):
+	""" Normalize a ';' delimited list of ':' delimited field, filter or bin specifications: whitespace around
+	 each part and empty specifications are dropped.
+	 @return string
+	"""
+	if spec == None: return ''
+	parts = [':'.join(part.strip() for part in item.split(':')) for item in spec.split(';')]
+	return ';'.join(part for part in parts if part != '')
+
+
+def materialize(source, destination):
+	""" Hard link source file to destination, or copy it if it can't be linked (e.g. another file system). """
+	if os.path.lexists(destination):
+		os.remove(destination)
+	try:
+		os.link(source, destination)
+	except OSError:
+		shutil.copyfile(source, destination)
+
+
+
+class ResultCache(object):
+
+	def __init__(self, cache_dir, settings):
+		"""
+		 @param cache_dir string	Cache folder; created if necessary.
+		 @param settings array	[name, value] string pairs that determine output content, in a fixed order.
+		"""
+		self.cache_dir = cache_dir
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+		digest = hashlib.sha1(RESULT_VERSION)
+		for (name, value) in settings:
+			digest.update('%s=%r\n' % (name, value))
+		self.entry_path = os.path.join(cache_dir, digest.hexdigest() + RESULT_SUFFIX)
+
+
+	def fetch(self, outputs):
+		""" Materialize cached outputs at their output paths.
+		 @param outputs array	[name, file path] of the report's outputs, e.g. [['tabular', '/.../out.tab'], ...]
+		 @return boolean	False if outputs aren't cached.
+		"""
+		if not os.path.isdir(self.entry_path): return False
+
+		# Outputs that the cached run didn't write (e.g. no selection file) aren't in the entry.
+		for (name, file_path) in outputs:
+			source = os.path.join(self.entry_path, name)
+			if os.path.isfile(source):
+				materialize(source, file_path)
+
+		os.utime(self.entry_path, None) # Marks entry as recently used
+		return True
+
+
+	def store(self, outputs):
+		""" Add the outputs of a completed run, then evict old entries.
+		 @param outputs array	[name, file path] of the report's outputs; missing files are skipped.
+		"""
+		temp_path = self.entry_path + '.tmp%i' % os.getpid()
+		os.makedirs(temp_path)
+		for (name, file_path) in outputs:
+			if os.path.isfile(file_path):
+				materialize(file_path, os.path.join(temp_path, name))
+
+		try:
+			os.rename(temp_path, self.entry_path)
+		except OSError: # A concurrent identical run stored it first.
+			shutil.rmtree(temp_path)
+
+		record_cache.evictEntries(self.cache_dir, RESULT_SUFFIX, self.entry_path, RESULT_MAX_BYTES, RESULT_MAX_DAYS)
@@ -0,0 +1,156 @@
+import os.path
+import time
+import json
+import zlib
+import base64
+import common
+import query_summary
+
+HTML_REPORT_HEADER_FILE = 'html_json_report_header.html'
+# Rows per embedded data chunk.  The browser parses (and decompresses) a chunk only when it is scrolled into view.
+CHUNK_ROWS = 5000
+
+class HTMLReport(object):
+
+	""" Compact HTML report: instead of <table> markup, sorted rows are embedded as columnar JSON chunks
+	which are rendered in the browser with a virtual scrolling table, so very large reports open quickly.
+
+	Report section and table columns keep the grouping of the standard HTML report (a change in a
+	section column's value starts a new section and resets all the grouping columns after it; a change in
+	a table column's value starts a new table section).  Their values are stored run-length encoded,
+	since rows are sorted by them.  Displayed column values are stored per chunk, one array per column.
+	"""
+	compress = False # gzip + base64 encode chunk data; see html_json_report_gz.py
+
+	def __init__(self, tagGroup, options, query_stats = []):
+
+		self.tagGroup = tagGroup
+		self.columns = tagGroup.columns
+		self.group_cols = [idx for (idx, field) in enumerate(self.columns) if field['group'] in ['section','table']]
+		self.data_cols = [idx for (idx, field) in enumerate(self.columns) if field['group'] == 'column']
+		self.query_stats = query_stats
+		self.empty_queries = [query['id'] for query in query_stats if query['filtered_rows'] == 0]
+		self.chunk = []
+		self.compression = options.compression
+		self.background_writer = options.background_writer
+		self.initialized = False
+		self.errorNotice = ''
+
+		# Report description for the browser side renderer.
+		self.meta = {
+			'groups': [{'label': self.columns[idx]['label'], 'group': self.columns[idx]['group']} for idx in self.group_cols],
+			'columns': [{'label': self.columns[idx]['label'], 'type': self.columns[idx]['type']} for idx in self.data_cols],
+			'empty_queries': self.empty_queries,
+			'filters': 'Filters: ' + options.filters_HTML if len(options.filters_HTML) else '',
+			'timestamp': time.strftime('%Y/%m/%d'),
+			'notice': getattr(options, 'report_notice', '') # e.g. labels a preview
+		}
+		# Per-query summary statistics table (-s option), or ''; written into the header as is.
+		self.summary = query_summary.summaryHTML(tagGroup, query_stats)
+
+		self.initialized = True
+
+
+	############################### HTML REPORT RENDERING ##############################
+	""" render() produces the html from a sorted tabular file.
+
+	@param in_file string	Full file path
+	@param out_html_file string	Full output html data file path to write to.
+	"""
+	def render (self, in_file, out_html_file):
+
+		self.begin(out_html_file)
+
+		try:
+			fp_in = open(in_file, "rb")
+			self.rows(common.readTabular(fp_in, self.tagGroup))
+			fp_in.close()
+
+		except IOError as e:
+			print 'Operation failed: %s' % e.strerror
+
+		self.end()
+
+
+	""" Streaming interface: the report engine calls begin(), then rows() with successive batches of
+	row arrays (one value per self.columns entry, in sorted order), then end().
+
+	@param out_html_file string	Full output html data file path to write to.
+	"""
+	def begin (self, out_html_file):
+
+		self.fp_out = common.openOutput(out_html_file, self.compression, self.background_writer)
+		self.fp_out.write( self._header(HTML_REPORT_HEADER_FILE) )
+
+		if self.initialized:
+			self.fp_out.write( self._script('report_meta', self.meta) )
+
+		#Not initialized here, so just write created error notice.
+		else:
+			self.fp_out.write('<body><h3>' + self.errorNotice + '</h3></body></html>')
+
+
+	def rows (self, batch):
+
+		if not self.initialized: return
+
+		for row in batch:
+			self.chunk.append(row)
+			if len(self.chunk) >= CHUNK_ROWS:
+				self._writeChunk()
+
+
+	def end (self):
+
+		if self.initialized:
+			if len(self.chunk):
+				self._writeChunk()
+			self.fp_out.write("""\n\t</body>\n</html>""")
+
+		self.fp_out.close()
+
+
+	############################### HTML REPORT PARTS ##############################
+	def _header(self, filename):
+
+		with open(os.path.join(os.path.dirname(__file__), filename), "r") as fphtml:
+			data = fphtml.read()
+
+		return data.replace('<div id="querySummary"></div>', '<div id="querySummary">' + self.summary + '</div>')
+
+
+	def _script(self, cssClass, data, encoding = ''):
+		""" JSON data in a non-executed script element.  "</" is escaped so data can't close the element. """
+		if encoding == '':
+			data = json.dumps(data, separators=(',',':')).replace('</', '<\\/')
+		return '\n\t\t<script type="application/json" class="%s" data-encoding="%s">%s</script>' % (cssClass, encoding, data)
+
+
+	def _writeChunk(self):
+		""" Each chunk is written as a small group runs element, read when the page loads, and a data element
+		holding display column arrays, read when the chunk is first displayed.
+		"""
+		chunk = self.chunk
+		self.chunk = []
+
+		groups = []
+		for idx in self.group_cols:
+			runs = []
+			for row in chunk:
+				if len(runs) and runs[-1][0] == row[idx]:
+					runs[-1][1] += 1
+				else:
+					runs.append([row[idx], 1])
+			groups.append(runs)
+
+		data = [[row[idx] for row in chunk] for idx in self.data_cols]
+
+		html = self._script('report_groups', {'rows': len(chunk), 'groups': groups})
+		if self.compress:
+			compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip format, for the browser's DecompressionStream
+			gz = compressor.compress(json.dumps(data, separators=(',',':'))) + compressor.flush()
+			html += self._script('report_data', base64.b64encode(gz), 'gzip')
+		else:
+			html += self._script('report_data', data)
+
+		self.fp_out.write(html)
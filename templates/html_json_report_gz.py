@@ -0,0 +1,6 @@
+import html_json_report
+
+class HTMLReport(html_json_report.HTMLReport):
+
+	""" Compact HTML report with gzip compressed chunk data; needs a browser with DecompressionStream support. """
+	compress = True
@@ -3,8 +3,12 @@ import time
 import csv
 import collections
 import re
+import common
+import query_summary
 
 HTML_REPORT_HEADER_FILE = 'html_report_header.html'
+# Accession id within a cell value, for a search link
+re_accession = re.compile(r'[a-z]+[0-9]+(.[0-9]+)*', re.I)
 
 class HTMLReport(object):
 	
@@ -13,9 +17,13 @@ class HTMLReport(object):
 	"""
 	def __init__(self, tagGroup, options, query_stats = []):
 
+		self.tagGroup = tagGroup
 		self.columns = tagGroup.columns
 		self.display_columns = [field for field in self.columns if field['group']=='column']
+		self.cell_plan = self._cellPlan()
 		self.row_limit = options.row_limit
+		self.compression = options.compression
+		self.background_writer = options.background_writer
 		self.section_bins = {}
 		self.todo = collections.deque([]) # stack of things to do
 		self.query_stats = query_stats
@@ -39,7 +47,8 @@ class HTMLReport(object):
 			'cssClass':'',
 			'table_header': self._tableHeader(),
 			'section_bins':'',
-			'section_counter':1
+			'section_counter':1,
+			'notice': getattr(options, 'report_notice', '') # e.g. labels a preview
 		}
 		
 		self.initialized = True
@@ -75,108 +84,124 @@ class HTMLReport(object):
 	"""
 	def render (self, in_file, out_html_file):
 
+		self.begin(out_html_file)
+
 		try:
+			fp_in = open(in_file, "rb")
+			self.rows(common.readTabular(fp_in, self.tagGroup))
+			fp_in.close()
 
-			fp_in = open(in_file, "rb")	
-			fp_out = open(out_html_file, 'w')
-			
-			fp_out.write( self._header(HTML_REPORT_HEADER_FILE) )
-				
-			if self.initialized:
-				
-				fp_out.write( self._bodyStart() )
-				self.todo.appendleft([0,'_bodyEnd'])
+		except IOError as e:
+			print 'Operation failed: %s' % e.strerror
 
-		
-				reader = csv.reader(fp_in, delimiter="\t")
+		self.end()
 
-				for row in reader:
 
-					html = ''
-					self.rowdata = []
-					row_bins = []
-					section_reset = False
-					
-					for (idx, field) in enumerate(self.columns):
+	""" Streaming interface: the report engine calls begin(), then rows() with successive batches of
+	row arrays (one value per self.columns entry, in sorted order), then end().
+
+	@param out_html_file string	Full output html data file path to write to.
+	"""
+	def begin (self, out_html_file):
+
+		self.fp_out = common.openOutput(out_html_file, self.compression, self.background_writer)
+		self.fp_out.write( self._header(HTML_REPORT_HEADER_FILE) )
 
-						value = field['value'] = row[idx]
-						depth = idx + 1
+		if self.initialized:
+			self.fp_out.write( self._bodyStart() )
+			self.todo.appendleft([0,'_bodyEnd'])
 
-						# If a bin is mentioned on this row, its put into self.selection_bins.
-						if field['type'] == 'bin' and value != '': 
-							row_bins.append(value)
-							if not value in self.section_bins:
-								self.section_bins[value] = field['label']
+		#Not initialized here, so just write created error notice.
+		else:
+			self.fp_out.write('<body><h3>' + self.errorNotice + '</h3></body></html>')
+
+
+	def rows (self, batch):
+
+		if not self.initialized: return
+
+		html_rows = [] # Written once per batch
+		for row in batch:
 
-						grouping = field['group']
-						# Section or table grouping here: 
-						if grouping == 'section' or grouping == 'table':	
+			html = ''
+			self.rowdata = []
+			row_bins = []
+			section_reset = False
+			
+			for (idx, field) in enumerate(self.columns):
 
-							# Check to see if a new section or table section is triggered by change in field's value:
-							if section_reset or (not 'valueOld' in field) or value != field['valueOld']:
-								
-								self.lookup['value'] = value
-								self.lookup['label'] = field['label']
+				value = field['value'] = row[idx]
+				depth = idx + 1
 
-								html += self._processTagStack(depth)
+				# If a bin is mentioned on this row, its put into self.selection_bins.
+				if field['type'] == 'bin' and value != '': 
+					row_bins.append(value)
+					if not value in self.section_bins:
+						self.section_bins[value] = field['label']
 
-								if grouping == 'section':
-									section_reset = True 
-									self.lookup['section_depth'] = depth
-									self.lookup['section_counter'] += 1
-									self.lookup['table_rows'] = 0
-									self.section_bins = {}
+				grouping = field['group']
+				# Section or table grouping here: 
+				if grouping == 'section' or grouping == 'table':	
 
-									html += self._sectionStart()
+					# Check to see if a new section or table section is triggered by change in field's value:
+					if section_reset or (not 'valueOld' in field) or value != field['valueOld']:
+						
+						self.lookup['value'] = value
+						self.lookup['label'] = field['label']
 
-									html += self._sectionFormStart()
-									self.todo.appendleft([depth,'_sectionFormEnd'])
+						html += self._processTagStack(depth)
 
-									self.todo.appendleft([depth,'_sectionEnd'])
+						if grouping == 'section':
+							section_reset = True 
+							self.lookup['section_depth'] = depth
+							self.lookup['section_counter'] += 1
+							self.lookup['table_rows'] = 0
+							self.section_bins = {}
 
+							html += self._sectionStart()
 
-								elif grouping == 'table': 
-									
-									lastToDo = self.todo[0]
-									if lastToDo[1] == '_sectionEnd': 
-										html += self._tableStart()
-										self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
+							html += self._sectionFormStart()
+							self.todo.appendleft([depth,'_sectionFormEnd'])
 
-									html += self._tbodyHeader() + self._tbodyStart()
-									self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
+							self.todo.appendleft([depth,'_sectionEnd'])
 
-							field['valueOld'] = value
 
-						else:
+						elif grouping == 'table': 
 							
-							if grouping == 'column': self.rowdata.append(row[idx])
-
-					lastToDo = self.todo[0]
-					# No table level, instead going right from section to column field:
-					if lastToDo[1] == '_sectionEnd': 
-						html += self._tableStart() + self._tbodyStart()
-						self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
-						self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
-
-					self.lookup['row_bins'] = ",".join(row_bins)
-					fp_out.write(html)
-					self.lookup['table_rows'] += 1
-					# Now output table row of data:
-					fp_out.write( self._tableRow() )
-					
+							lastToDo = self.todo[0]
+							if lastToDo[1] == '_sectionEnd': 
+								html += self._tableStart()
+								self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
+
+							html += self._tbodyHeader() + self._tbodyStart()
+							self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
+
+					field['valueOld'] = value
+
+				else:
 					
-			#Not initialized here, so just write created error notice.
-			else:
-			
-				fp_out.write('<body><h3>' + self.errorNotice + '</h3></body></html>')
+					if grouping == 'column': self.rowdata.append(row[idx])
 
-			fp_out.write( self._processTagStack() )
-	
-		except IOError as e:
-			print 'Operation failed: %s' % e.strerror
+			lastToDo = self.todo[0]
+			# No table level, instead going right from section to column field:
+			if lastToDo[1] == '_sectionEnd': 
+				html += self._tableStart() + self._tbodyStart()
+				self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
+				self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
 
-		fp_in.close()
-		fp_out.close()
+			self.lookup['row_bins'] = ",".join(row_bins)
+			html_rows.append(html)
+			self.lookup['table_rows'] += 1
+			# Now output table row of data:
+			html_rows.append(self._tableRow())
+
+		self.fp_out.write(''.join(html_rows))
+
+
+	def end (self):
+
+		self.fp_out.write( self._processTagStack() )
+		self.fp_out.close()
 
 
 	############################### HTML REPORT PART TEMPLATES ############################## 
@@ -192,6 +217,10 @@ class HTMLReport(object):
 		# The form enables the creation of a dataset from selected entries.  It passes selections (based on a certain column's value) to the "Select tabular rows" tool, which then creates a dataset from the selected rows. 
 		html = """
 		"""
+		if len(self.lookup['notice']):
+			html += """
+			<div class="headerMessage">%(notice)s</div>"""
+
 		if len(self.empty_queries):
 			qnames = ''
 			for name in self.empty_queries:	qnames += '<li>' + name + '</li>\n'
@@ -202,7 +231,8 @@ class HTMLReport(object):
 				</ul>
 			</div>""" % qnames
 
-		return html % self.lookup
+		# Per-query summary statistics, if the engine gathered them (-s option)
+		return html % self.lookup + query_summary.summaryHTML(self.tagGroup, self.query_stats)
 
 	# Repeated for each grouped section table display
 	def _sectionStart(self):
@@ -258,26 +288,36 @@ class HTMLReport(object):
 				<tbody>""" % self.lookup
 
 
+	def _cellPlan(self):
+		""" Compiled once: for each displayed column, its <td> start tag, and whether the cell 
+		gets an accession search link, bin indicator (first column only).
+		"""
+		plan = []
+		for (col, field) in enumerate(self.display_columns):
+			tdStart = '<td class="numeric">' if field['type'] == 'numeric' else '<td>'
+			plan.append([tdStart, col == 0])
+		return plan
+
+
+	def _accessionLink(self, value):
+		accessionID = re_accession.search(value)
+		if (accessionID) :
+			return '<a href="https://google.ca/#q=%s+gene" target="search">%s</a>' % (accessionID.group(), value)
+		return value
+
+
 	def _tableRow(self):
 		self.lookup['select_row'] +=1
 
-		tdTags = ''
-		for (col, field) in enumerate(self.display_columns):
-			value =  self.rowdata[col]
-			self.lookup['value'] = value
-			self.lookup['cssClass'] = ' class="numeric"' if field['type'] == 'numeric' else ''
-			accessionID = re.search(r'[a-z]+[0-9]+(.[0-9]+)*' ,value, re.I)
-			if (accessionID) :
-				self.lookup['link'] = '<a href="https://google.ca/#q=%s+gene" target="search">%s</a>' % (accessionID.group(), value)
-			else:
-				self.lookup['link'] = value
-			# First column optionally gets bin indicator as well as row checkbox selector 
-			if (col == 0):
-				tdTags += '<td%(cssClass)s>%(link)s<span class="super">%(row_bins)s</span></td>' % self.lookup
+		tdTags = []
+		for (value, (tdStart, firstColumn)) in zip(self.rowdata, self.cell_plan):
+			# First column optionally gets bin indicator 
+			if firstColumn:
+				tdTags.append(tdStart + self._accessionLink(value) + '<span class="super">' + self.lookup['row_bins'] + '</span></td>')
 			else:
-				tdTags += '<td%(cssClass)s>%(value)s</td>' % self.lookup
+				tdTags.append(tdStart + value + '</td>')
 
-		return """\n\t\t\t<tr>%s</tr>""" % tdTags
+		return '\n\t\t\t<tr>' + ''.join(tdTags) + '</tr>'
 
 	def _tbodyEnd (self):
 		return """
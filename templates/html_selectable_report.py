@@ -4,8 +4,11 @@ import csv
 import collections
 import re
 import common
+import query_summary
 
 HTML_REPORT_HEADER_FILE = 'html_report_header.html'
+# Accession id within a cell value, for a search link
+re_accession = re.compile(r'[a-z]+[_]?[0-9]+(.[0-9]+)*', re.I)
 
 class HTMLReport(object):
 	
@@ -14,9 +17,13 @@ class HTMLReport(object):
 	"""
 	def __init__(self, tagGroup, options, query_stats = []):
 
+		self.tagGroup = tagGroup
 		self.columns = tagGroup.columns
 		self.display_columns = [field for field in self.columns if field['group']=='column']
+		self.cell_plan = self._cellPlan()
 		self.row_limit = options.row_limit
+		self.compression = options.compression
+		self.background_writer = options.background_writer
 		self.section_bins = {}
 		self.todo = collections.deque([]) # stack of things to do
 		self.query_stats = query_stats
@@ -40,6 +47,7 @@ class HTMLReport(object):
 			'table_header': self._tableHeader(),
 			'section_bins':'',
 			'section_counter':1,
+			'notice': getattr(options, 'report_notice', ''), # e.g. labels a preview
 			'target_form':'select_subsets'
 		}
 		
@@ -83,109 +91,123 @@ class HTMLReport(object):
 	"""
 	def render (self, in_file, out_html_file):
 
+		self.begin(out_html_file)
+
 		try:
-			
 			fp_in = open(in_file, "rb")
-			fp_out = open(out_html_file, 'w')
+			self.rows(common.readTabular(fp_in, self.tagGroup))
+			fp_in.close()
+
+		except IOError as e:
+			print 'Operation failed: %s' % e.strerror
 
-			fp_out.write( self._header(HTML_REPORT_HEADER_FILE) )
-				
-			if self.initialized:
+		self.end()
 
-				fp_out.write( self._bodyStart() )
-				self.todo.appendleft([0,'_bodyEnd'])
-				
-				reader = csv.reader(fp_in, delimiter="\t")
 
-				for row in reader:
+	""" Streaming interface: the report engine calls begin(), then rows() with successive batches of
+	row arrays (one value per self.columns entry, in sorted order), then end().
 
-					html = ''
-					self.rowdata = []
-					row_bins = []
-					section_reset = False
-					
-					for (idx, field) in enumerate(self.columns):
+	@param out_html_file string	Full output html data file path to write to.
+	"""
+	def begin (self, out_html_file):
 
-						value = field['value'] = row[idx]
-						depth = idx + 1
+		self.fp_out = common.openOutput(out_html_file, self.compression, self.background_writer)
+		self.fp_out.write( self._header(HTML_REPORT_HEADER_FILE) )
 
-						# If a bin is mentioned on this row, its put into self.selection_bins.
-						if field['type'] == 'bin' and value != '': 
-							row_bins.append(value)
-							if not value in self.section_bins:
-								self.section_bins[value] = field['label']
+		if self.initialized:
+			self.fp_out.write( self._bodyStart() )
+			self.todo.appendleft([0,'_bodyEnd'])
 
-						grouping = field['group']
-						# Section or table grouping here: 
-						if grouping == 'section' or grouping == 'table':	
+		#Not initialized here, so just write created error notice.
+		else:
+			self.fp_out.write('<h3>' + self.errorNotice + '</body></html>')
+
+
+	def rows (self, batch):
+
+		if not self.initialized: return
 
-							# Check to see if a new section or table section is triggered by change in field's value:
-							if section_reset or (not 'valueOld' in field) or value != field['valueOld']:
-								
-								self.lookup['value'] = value
-								self.lookup['label'] = field['label']
+		html_rows = [] # Written once per batch
+		for row in batch:
 
-								html += self._processTagStack(depth)
+			html = ''
+			self.rowdata = []
+			row_bins = []
+			section_reset = False
+			
+			for (idx, field) in enumerate(self.columns):
+
+				value = field['value'] = row[idx]
+				depth = idx + 1
 
-								if grouping == 'section':
-									section_reset = True 
-									self.lookup['section_depth'] = depth
-									self.lookup['section_counter'] += 1
-									self.lookup['table_rows'] = 0
-									self.section_bins = {}
+				# If a bin is mentioned on this row, its put into self.selection_bins.
+				if field['type'] == 'bin' and value != '': 
+					row_bins.append(value)
+					if not value in self.section_bins:
+						self.section_bins[value] = field['label']
 
-									html += self._sectionStart()
+				grouping = field['group']
+				# Section or table grouping here: 
+				if grouping == 'section' or grouping == 'table':	
 
-									html += self._sectionFormStart()
-									self.todo.appendleft([depth,'_sectionFormEnd'])
+					# Check to see if a new section or table section is triggered by change in field's value:
+					if section_reset or (not 'valueOld' in field) or value != field['valueOld']:
+						
+						self.lookup['value'] = value
+						self.lookup['label'] = field['label']
 
-									self.todo.appendleft([depth,'_sectionEnd'])
+						html += self._processTagStack(depth)
 
-								elif grouping == 'table': 
-									
-									lastToDo = self.todo[0]
-									if lastToDo[1] == '_sectionEnd': #Just started a section
-										html += self._tableStart()
-										self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
+						if grouping == 'section':
+							section_reset = True 
+							self.lookup['section_depth'] = depth
+							self.lookup['section_counter'] += 1
+							self.lookup['table_rows'] = 0
+							self.section_bins = {}
 
-									html += self._tbodyHeader() + self._tbodyStart()
-									self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
+							html += self._sectionStart()
 
-							field['valueOld'] = value
+							html += self._sectionFormStart()
+							self.todo.appendleft([depth,'_sectionFormEnd'])
 
-						else:
+							self.todo.appendleft([depth,'_sectionEnd'])
+
+						elif grouping == 'table': 
 							
-							if grouping == 'column': self.rowdata.append(row[idx])
+							lastToDo = self.todo[0]
+							if lastToDo[1] == '_sectionEnd': #Just started a section
+								html += self._tableStart()
+								self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
+
+							html += self._tbodyHeader() + self._tbodyStart()
+							self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
 
-					lastToDo = self.todo[0]
-					# No table level, instead going right from section to column field:
-					if lastToDo[1] == '_sectionEnd': 
-						html += self._tableStart() + self._tbodyStart()
-						self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
-						self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
+					field['valueOld'] = value
 
-					self.lookup['row_bins'] = ",".join(row_bins)
+				else:
+					
+					if grouping == 'column': self.rowdata.append(row[idx])
 
-					fp_out.write(html)
+			lastToDo = self.todo[0]
+			# No table level, instead going right from section to column field:
+			if lastToDo[1] == '_sectionEnd': 
+				html += self._tableStart() + self._tbodyStart()
+				self.todo.appendleft([lastToDo[0]+1,'_tableEnd'])
+				self.todo.appendleft([lastToDo[0]+2,'_tbodyEnd'])
 
-					self.lookup['table_rows'] += 1
+			self.lookup['row_bins'] = ",".join(row_bins)
+			html_rows.append(html)
+			self.lookup['table_rows'] += 1
+			# Now output table row of data:
+			html_rows.append(self._tableRow())
 
-					# Now output table row of data:
-					fp_out.write( self._tableRow() )
+		self.fp_out.write(''.join(html_rows))
 
-		
-			#Not initialized here, so just write created error notice.
-			else:
 
-				fp_out.write('<h3>' + self.errorNotice + '</body></html>')
-				
-			fp_out.write( self._processTagStack() )
-				
-		except IOError as e:
-			print 'Operation failed: %s' % e.strerror
+	def end (self):
 
-		fp_in.close()
-		fp_out.close()
+		self.fp_out.write( self._processTagStack() )
+		self.fp_out.close()
 
 
 	############################### HTML REPORT PART TEMPLATES ############################## 
@@ -245,6 +267,10 @@ class HTMLReport(object):
 					<input type="hidden" name="incl_excl" value="1"/>
 		""" % self.lookup
 
+		if len(self.lookup['notice']):
+			html += """
+			<div class="headerMessage">%(notice)s</div>"""
+
 		if len(self.empty_queries):
 			qnames = ''
 			for name in self.empty_queries:	qnames += '<li>' + name + '</li>\n'
@@ -255,7 +281,8 @@ class HTMLReport(object):
 				</ul>
 			</div>""" % (len(self.empty_queries), qnames)
 
-		return html % self.lookup
+		# Per-query summary statistics, if the engine gathered them (-s option)
+		return html % self.lookup + query_summary.summaryHTML(self.tagGroup, self.query_stats)
 
 	# Repeated for each grouped section table display
 	def _sectionStart(self):
@@ -323,29 +350,38 @@ class HTMLReport(object):
 				<tbody>""" % self.lookup
 
 
+	def _cellPlan(self):
+		""" Compiled once: for each displayed column, its <td> start tag, and whether the cell 
+		gets an accession search link, bin indicator and row checkbox selector (first column only).
+		"""
+		plan = []
+		for (col, field) in enumerate(self.display_columns):
+			tdStart = '<td class="numeric">' if field['type'] == 'numeric' else '<td>'
+			plan.append([tdStart, col == 0])
+		return plan
+
+
+	def _accessionLink(self, value):
+		#See http://www.ncbi.nlm.nih.gov/books/NBK21091/table/ch18.T.refseq_accession_numbers_and_mole/?report=objectonly
+		#See http://www.ncbi.nlm.nih.gov/Sequin/acc.html
+		accessionID = re_accession.search(value)
+		if (accessionID) :
+			return '<a href="https://google.com/#q=%s+gene" target="search">%s</a>' % (accessionID.group(), value)
+		return value
+
+
 	def _tableRow(self):
 		self.lookup['select_row'] +=1
 
-		tdTags = ''
-		for (col, field) in enumerate(self.display_columns):
-			value =  self.rowdata[col]
-			self.lookup['value'] = value
-			self.lookup['cssClass'] = ' class="numeric"' if field['type'] == 'numeric' else ''
-			#See http://www.ncbi.nlm.nih.gov/books/NBK21091/table/ch18.T.refseq_accession_numbers_and_mole/?report=objectonly
-			#See http://www.ncbi.nlm.nih.gov/Sequin/acc.html
-			accessionID = re.search(r'[a-z]+[_]?[0-9]+(.[0-9]+)*' ,value, re.I)
-			if (accessionID) :
-				self.lookup['link'] = '<a href="https://google.com/#q=%s+gene" target="search">%s</a>' % (accessionID.group(), value)
-			else:
-				self.lookup['link'] = value
+		tdTags = []
+		for (value, (tdStart, firstColumn)) in zip(self.rowdata, self.cell_plan):
 			# First column optionally gets bin indicator as well as row checkbox selector 
-			if (col == 0):
-				tdTags += '<td%(cssClass)s><input type="checkbox" name="select" value="%(select_row)s" />%(link)s<span class="super">%(row_bins)s</span></td>' % self.lookup
+			if firstColumn:
+				tdTags.append(tdStart + '<input type="checkbox" name="select" value="' + str(self.lookup['select_row']) + '" />' + self._accessionLink(value) + '<span class="super">' + self.lookup['row_bins'] + '</span></td>')
 			else:
-				tdTags += '<td%(cssClass)s>%(value)s</td>' % self.lookup
-
-		return """\n\t\t\t<tr>%s</tr>""" % tdTags
+				tdTags.append(tdStart + value + '</td>')
 
+		return '\n\t\t\t<tr>' + ''.join(tdTags) + '</tr>'
 
 	def _tbodyEnd (self):
 		return """
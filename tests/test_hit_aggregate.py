@@ -0,0 +1,73 @@
+"""Tests of hit row aggregation (-H option).
+
+Run from the tool folder:
+	python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hit_aggregate
+
+
+class HSP(object):
+	""" Processed <Hsp> record fields that HitAggregate reads """
+	def __init__(self, qstart, qend, bitscore = 50.0, evalue = 1e-10, qlen = 100):
+		(self._qstart, self._qend, self._qlen) = (str(qstart), str(qend), str(qlen))
+		(self._bitscore, self._evalue) = (repr(bitscore), repr(evalue))
+		self.numeric_values = None
+
+
+class CoverageTest(unittest.TestCase):
+
+	def coverage(self, intervals):
+		aggregate = hit_aggregate.HitAggregate()
+		for (qstart, qend) in intervals:
+			aggregate.add(HSP(qstart, qend))
+		return aggregate.coverage()
+
+	def test_single(self):
+		self.assertEqual(self.coverage([[10, 19]]), 10)
+
+	def test_disjoint(self):
+		self.assertEqual(self.coverage([[1, 10], [21, 30]]), 20)
+
+	def test_overlapping(self):
+		self.assertEqual(self.coverage([[1, 10], [5, 14]]), 14)
+
+	def test_contained(self):
+		self.assertEqual(self.coverage([[1, 30], [5, 10]]), 30)
+
+	def test_adjacent(self):
+		self.assertEqual(self.coverage([[1, 10], [11, 20]]), 20)
+
+	def test_reversed(self):
+		# Minus strand HSPs have qstart > qend.
+		self.assertEqual(self.coverage([[20, 11], [1, 10]]), 20)
+		self.assertEqual(self.coverage([[15, 6], [1, 10]]), 15)
+
+	def test_unsorted(self):
+		self.assertEqual(self.coverage([[50, 60], [1, 10], [8, 20]]), 31)
+
+
+class ApplyTest(unittest.TestCase):
+
+	def test_fields(self):
+		aggregate = hit_aggregate.HitAggregate()
+		aggregate.add(HSP(1, 40, bitscore = 60.5, evalue = 1e-20))
+		aggregate.add(HSP(61, 30, bitscore = 45.25, evalue = 1e-12))
+
+		record = HSP(0, 0)
+		self.assertTrue(aggregate.apply(record))
+		# Top bitscore HSP's fields, summed bitscore, best evalue, coverage of the union.
+		self.assertEqual((record._qstart, record._qend), ('1', '40'))
+		self.assertEqual(record.bitscore, '105')
+		self.assertEqual(record.evalue, '1e-20')
+		self.assertEqual(record.pcov, '61.00')
+		# The aggregate starts a new hit.
+		self.assertFalse(aggregate.apply(record))
+
+
+if __name__ == '__main__':
+	unittest.main()
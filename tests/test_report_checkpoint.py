@@ -0,0 +1,117 @@
+"""Tests of resuming a report from a checkpoint (-k and -R options).
+
+Run from the tool folder:
+	python -m unittest discover -s tests
+"""
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+import unittest
+
+TOOL_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INPUT_FILE = os.path.join(TOOL_FOLDER, 'test-data', 'blast_reporting_1.blastxml') # 4 queries
+
+# Runs the report with a checkpoint due after every query, and exits abruptly, as a stopped job would, once
+# STOP_AFTER checkpoints are saved: at the next checkpoint, after the work files and database hold another
+# query's rows, but before the checkpoint is saved.  A resumed run has to drop those rows again.
+INTERRUPTED_RUN = """
+import os, sys
+sys.path.insert(0, %(folder)r)
+import report_checkpoint
+import blast_reporting
+
+save = report_checkpoint.ReportCheckpoint.save
+saved = []
+
+def endIteration(self):
+	self.offset = self.reader.boundaries.popleft()
+	return True
+
+def stoppingSave(self, state):
+	if len(saved) == %(stop_after)i:
+		os._exit(3)
+	save(self, state)
+	saved.append(len(state['query_stats']))
+
+report_checkpoint.ReportCheckpoint.endIteration = endIteration
+report_checkpoint.ReportCheckpoint.save = stoppingSave
+sys.argv = ['blast_reporting.py'] + %(args)r
+blast_reporting.ReportEngine().__main__()
+"""
+STOP_AFTER = 2
+
+
+class ResumeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def run_report(self, name, options):
+		""" Run a report with outputs named name.* in the test folder.  @return string	its console output """
+		path = os.path.join(self.folder, name)
+		args = [INPUT_FILE, 'ext+', path + '.tab', path + '.html', 'None:None:None:None', 'None'] + options
+		process = subprocess.Popen([sys.executable, os.path.join(TOOL_FOLDER, 'blast_reporting.py')] + args, stdout = subprocess.PIPE)
+		output = process.communicate()[0]
+		self.assertEqual(process.returncode, 0, output)
+		return output
+
+	def interrupted_report(self, name, options):
+		path = os.path.join(self.folder, name)
+		args = [INPUT_FILE, 'ext+', path + '.tab', path + '.html', 'None:None:None:None', 'None'] + options
+		code = INTERRUPTED_RUN % {'folder': TOOL_FOLDER, 'stop_after': STOP_AFTER, 'args': args + ['-k', '1']}
+		with open(os.devnull, 'w') as devnull:
+			self.assertEqual(subprocess.call([sys.executable, '-c', code], stdout = devnull), 3)
+		# Stopped part-way: the checkpoint and work file are kept, and there are no final outputs yet.
+		self.assertTrue(os.path.exists(path + '.tab.checkpoint'))
+		self.assertTrue(os.path.exists(path + '.tab.sort'))
+		self.assertFalse(os.path.exists(path + '.tab'))
+
+	def read(self, file_path):
+		with open(file_path, 'rb') as fp_in:
+			return fp_in.read()
+
+	def assertResumed(self, options, outputs = ['.tab', '.html']):
+		""" A report stopped after STOP_AFTER queries, then resumed with -R, has the outputs of an uninterrupted run. """
+		full = lambda suffix: os.path.join(self.folder, 'full' + suffix)
+		resumed = lambda suffix: os.path.join(self.folder, 'resumed' + suffix)
+		self.run_report('full', [option.replace('%s', full('')) for option in options])
+
+		resumed_options = [option.replace('%s', resumed('')) for option in options]
+		self.interrupted_report('resumed', resumed_options)
+		output = self.run_report('resumed', resumed_options + ['-R'])
+		self.assertIn('Resuming from checkpoint: %i queries done.' % STOP_AFTER, output)
+		self.assertFalse(os.path.exists(resumed('.tab.checkpoint')))
+
+		for suffix in outputs:
+			if suffix.endswith('.db'):
+				self.assertEqual(self.dump(resumed(suffix)), self.dump(full(suffix)))
+			else:
+				self.assertEqual(self.read(resumed(suffix)), self.read(full(suffix)), suffix)
+
+	def dump(self, db_file):
+		db = sqlite3.connect(db_file)
+		tables = [db.execute('SELECT * FROM %s' % table).fetchall() for table in ['hsps', 'query_stats']]
+		db.close()
+		return tables
+
+	def test_resume(self):
+		self.assertResumed(['-f', 'pident: gte 97,;'])
+
+	def test_resume_hit_rows(self):
+		self.assertResumed(['-H'])
+
+	def test_resume_sidecar(self):
+		self.assertResumed(['-S'])
+
+	def test_resume_summary_database(self):
+		self.assertResumed(['-s', '%s.summary', '-d', '%s.db'], ['.tab', '.html', '.summary', '.db'])
+
+
+if __name__ == '__main__':
+	unittest.main()